@@ -1,13 +1,35 @@
 import asyncio
 import json
+import logging
+import logging.handlers
 import os
 from datetime import datetime, timezone, timedelta
-from cryptography.fernet import Fernet
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 import base64
+import bisect
+from collections import OrderedDict, deque
+import contextvars
 import hashlib
+import heapq
+import hmac
+import itertools
+import math
+import queue
+import re
+import secrets
+import sqlite3
 import getpass
+import time
 
 from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import (TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter,
+                                TelegramServerError)
 from aiogram.filters import Command
 from aiogram.types import (
     InlineKeyboardButton,
@@ -15,20 +37,132 @@ from aiogram.types import (
     ReplyKeyboardMarkup,
     KeyboardButton,
     ReplyKeyboardRemove,
+    InputMediaPhoto,
+    InputMediaVideo,
 )
+from aiohttp import ClientConnectorError
 from dotenv import load_dotenv
 import threading
 import sys
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 load_dotenv()
 
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD', 'adminpass')
 DATA_FILE = 'data.json'
+# каждая комната хранится в отдельном файле, чтобы сохранение трогало только её данные
+ROOMS_DIR = 'rooms'
+DEFAULT_ROOM = 'main'
+
+# Хранилище состояния: file (data.json + rooms/) или sqlite (WAL) — общее для нескольких
+# процессов-воркеров (python bot.py --frontend + python bot.py --worker N).
+STORE_BACKEND = os.getenv('STORE_BACKEND', 'file').lower()
+STORE_PATH = os.getenv('STORE_PATH', 'bot.db')
+WORKERS = int(os.getenv('WORKERS', '1'))
+# если задан, фронтенд принимает обновления вебхуком, иначе сам опрашивает getUpdates
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+# секрет вебхука (заголовок X-Telegram-Bot-Api-Secret-Token); если не задан, генерируется при запуске
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+# номер воркера (shard), None — обычный одиночный процесс с polling
+WORKER_SHARD = None
 FOOTER = 'У нас новые слухи? Или мне кажется?🐶'
+# сколько ждать остальные части альбома (media group), прежде чем показать превью
+ALBUM_WINDOW = float(os.getenv('ALBUM_WINDOW', '1.0'))
+# Исходящие запросы: общий лимит скорости Bot API (на все воркеры вместе) и число параллельных отправок при рассылке
+SEND_RATE = float(os.getenv('SEND_RATE', '25'))
+SEND_CONCURRENCY = int(os.getenv('SEND_CONCURRENCY', '8'))
+# Параллельность рассылки подстраивается сама (AIMD) от SEND_CONCURRENCY в этих пределах: растёт,
+# пока ответы быстрее SEND_LATENCY_TARGET сек, и падает вдвое на 429 и ошибках сервера/сети.
+# Получатель, на котором сработал лимит, отправляется повторно до SEND_RETRIES раз.
+SEND_CONCURRENCY_MIN = int(os.getenv('SEND_CONCURRENCY_MIN', '2'))
+SEND_CONCURRENCY_MAX = int(os.getenv('SEND_CONCURRENCY_MAX', '32'))
+SEND_LATENCY_TARGET = float(os.getenv('SEND_LATENCY_TARGET', '1.0'))
+SEND_RETRIES = int(os.getenv('SEND_RETRIES', '3'))
+# HTTP-сессия Bot API: свой сервер (telegram-bot-api --local), размер пула keep-alive соединений,
+# таймауты запроса (сек, для отправки медиа — отдельный), сколько держать соединение и DNS-ответ
+BOT_API_URL = os.getenv('BOT_API_URL')
+BOT_API_LOCAL = os.getenv('BOT_API_LOCAL', '1') == '1'
+API_POOL_SIZE = int(os.getenv('API_POOL_SIZE', str(SEND_CONCURRENCY_MAX + 4)))
+API_TIMEOUT = float(os.getenv('API_TIMEOUT', '15'))
+API_MEDIA_TIMEOUT = float(os.getenv('API_MEDIA_TIMEOUT', '60'))
+API_KEEPALIVE = float(os.getenv('API_KEEPALIVE', '60'))
+API_DNS_TTL = int(os.getenv('API_DNS_TTL', '300'))
+# после стольких сетевых ошибок подряд запросы к Bot API сразу отклоняются на CIRCUIT_COOLDOWN сек
+CIRCUIT_FAILURES = int(os.getenv('CIRCUIT_FAILURES', '5'))
+CIRCUIT_COOLDOWN = float(os.getenv('CIRCUIT_COOLDOWN', '30'))
+# Входящие обновления: сколько обрабатывается одновременно, сколько может ждать всего
+# (дальше polling не забирает новые) и сколько — от одного пользователя (лишние отбрасываются)
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '32'))
+UPDATE_QUEUE_LIMIT = int(os.getenv('UPDATE_QUEUE_LIMIT', '1000'))
+UPDATE_USER_QUEUE = int(os.getenv('UPDATE_USER_QUEUE', '20'))
+# кнопки, нажатие которых должно сработать один раз, даже если его повторили
+IDEMPOTENT_CALLBACKS = ('confirm_', 'cancel_', 'dup_ok_', 'dup_no_', 'purge_')
+IDEMPOTENCY_TTL = 600
+# правки, пришедшие подряд с интервалом меньше этого, уходят получателям одной правкой
+EDIT_COALESCE_DELAY = float(os.getenv('EDIT_COALESCE_DELAY', '2'))
+# жалобы, пришедшие за это время, уходят админам одним уведомлением; по сколько жалоб на странице
+COMPLAINT_NOTIFY_DELAY = float(os.getenv('COMPLAINT_NOTIFY_DELAY', '5'))
+COMPLAINTS_PAGE = 8
+# Дайджест: пользователь может получать посты не сразу, а пачкой раз в N минут (варианты через запятую)
+DIGEST_INTERVALS = tuple(int(m) for m in os.getenv('DIGEST_INTERVALS', '15,60').split(',') if m.strip())
+DIGEST_TICK = 30
+# сколько последних текстовых дайджестов пользователя помнить — для ответов, жалоб и удалений
+DIGEST_KEEP = 30
+DIGEST_TEXT_LIMIT = 3500
+# очередь, взятая в отправку, помечается; если процесс упал, через столько секунд её возьмут снова
+DIGEST_SEND_TIMEOUT = 600
+# Догоняющая лента: сколько последних постов прислать новому участнику (при входе в комнату —
+# если CATCHUP_ON_JOIN=1, и по кнопке «Недавнее») и сколько таких постов пользователь может получить за сутки
+CATCHUP_POSTS = int(os.getenv('CATCHUP_POSTS', '10'))
+CATCHUP_ON_JOIN = os.getenv('CATCHUP_ON_JOIN', '1') == '1'
+CATCHUP_BUDGET = int(os.getenv('CATCHUP_BUDGET', '50'))
+CATCHUP_CACHE = 256
+SEARCH_PAGE = 5
+# Повторы: что делать с постом, который уже был в комнате недавно — warn (предупредить автора),
+# block (не принимать), approve (отправить на проверку админу) или off; сколько последних
+# отпечатков помнить на комнату, допустимое расхождение simhash в битах и минимальная длина текста
+DUP_ACTION = os.getenv('DUP_ACTION', 'warn').lower()
+DUP_WINDOW = int(os.getenv('DUP_WINDOW', '2000'))
+DUP_TEXT_DISTANCE = int(os.getenv('DUP_TEXT_DISTANCE', '3'))
+DUP_MIN_TEXT = int(os.getenv('DUP_MIN_TEXT', '20'))
+# Черновики: сколько живёт неподтверждённый (сек), сколько их держать в памяти и писать ли их на диск
+DRAFT_TTL = int(os.getenv('DRAFT_TTL', '3600'))
+# сколько повтор ждёт решения администратора (сек), потом снимается с проверки, автор получает уведомление
+HELD_DRAFT_TTL = int(os.getenv('HELD_DRAFT_TTL', str(3 * 86400)))
+DRAFT_LIMIT = int(os.getenv('DRAFT_LIMIT', '5000'))
+DRAFTS_PERSIST = os.getenv('DRAFTS_PERSIST', '0') == '1'
+# Журнал событий (JSON по строке): файл, ротация по размеру и писать ли в него текст сообщений
+AUDIT_LOG = os.getenv('AUDIT_LOG', 'audit.log')
+AUDIT_LOG_MAX_BYTES = int(os.getenv('AUDIT_LOG_MAX_BYTES', str(5 * 1024 * 1024)))
+AUDIT_LOG_BACKUPS = int(os.getenv('AUDIT_LOG_BACKUPS', '5'))
+AUDIT_LOG_CONTENT = os.getenv('AUDIT_LOG_CONTENT', '1') == '1'
+# Снимки данных: каталог, сколько хранить и как часто снимать по расписанию (сек, 0 — только перед
+# опасными действиями админа)
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', 'snapshots')
+SNAPSHOT_KEEP = int(os.getenv('SNAPSHOT_KEEP', '20'))
+SNAPSHOT_INTERVAL = int(os.getenv('SNAPSHOT_INTERVAL', str(6 * 3600)))
+# Сессии админов: сколько живёт вход и сколько можно бездействовать (сек); попыток пароля за окно
+ADMIN_SESSION_TTL = int(os.getenv('ADMIN_SESSION_TTL', str(12 * 3600)))
+ADMIN_IDLE_TIMEOUT = int(os.getenv('ADMIN_IDLE_TIMEOUT', '3600'))
+ADMIN_LOGIN_ATTEMPTS = int(os.getenv('ADMIN_LOGIN_ATTEMPTS', '5'))
+ADMIN_LOGIN_WINDOW = int(os.getenv('ADMIN_LOGIN_WINDOW', '900'))
 
 # Шифрование data.json
 DATA_KEY_ENV = os.getenv('DATA_KEY')
+# Предыдущий ключ нужен только на время ротации: записи, зашифрованные им,
+# читаются и при следующем сохранении перешифровываются текущим ключом.
+DATA_KEY_PREVIOUS = os.getenv('DATA_KEY_PREVIOUS')
 
 # Если ключа нет в переменной окружения, попросить его в консоли
 if DATA_KEY_ENV is None:
@@ -37,82 +171,2153 @@ if DATA_KEY_ENV is None:
 
 ENCRYPTION_ENABLED = DATA_KEY_ENV is not None
 
+# Формат хранения: каждая запись (пользователь, сообщение чата, черновик, жалоба)
+# шифруется отдельно AES-GCM, ключ выводится из DATA_KEY через scrypt с солью из файла.
+STORAGE_FORMAT = 2
+RECORD_SECTIONS = ('users', 'drafts', 'chat', 'complaints')
+KDF_PARAMS = {'kdf': 'scrypt', 'n': 2 ** 15, 'r': 8, 'p': 1}
+
+# Кодек data.json: auto (orjson, если установлен, иначе json), json, orjson, msgpack.
+# В проде файл пишется компактно; DATA_PRETTY=1 включает отступы для отладки.
+DATA_CODEC = os.getenv('DATA_CODEC', 'auto').lower()
+DATA_PRETTY = os.getenv('DATA_PRETTY', '0') == '1'
+if DATA_CODEC == 'auto':
+    DATA_CODEC = 'orjson' if orjson is not None else 'json'
+if DATA_CODEC == 'orjson' and orjson is None or DATA_CODEC == 'msgpack' and msgpack is None:
+    raise RuntimeError(f'DATA_CODEC={DATA_CODEC} but the package is not installed')
+
 if ENCRYPTION_ENABLED:
-    # Генерируем Fernet ключ из PASSWORD (производная 32 байта, кодируем в base64)
-    key_hash = hashlib.sha256(DATA_KEY_ENV.encode()).digest()
-    cipher_key = base64.urlsafe_b64encode(key_hash)
-    cipher = Fernet(cipher_key)
     print('✅ Шифрование включено')
 else:
-    cipher = None
     print('⚠️ Шифрование отключено')
 
 if not BOT_TOKEN:
     raise RuntimeError('BOT_TOKEN is not set in environment')
 
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
+# методы, которые несут медиа и могут идти дольше обычного запроса
+MEDIA_METHODS = frozenset(('sendPhoto', 'sendVideo', 'sendDocument', 'sendAnimation', 'sendAudio',
+                           'sendVoice', 'sendVideoNote', 'sendSticker', 'sendMediaGroup', 'editMessageMedia'))
+
+
+class ApiSession(AiohttpSession):
+    """aiohttp session with a keep-alive pool sized for fan-out and per-method timeouts.
+
+    Also counts requests in flight, which is how many pooled connections are busy.
+    """
+
+    def __init__(self):
+        api = TelegramAPIServer.from_base(BOT_API_URL, is_local=BOT_API_LOCAL) if BOT_API_URL else None
+        super().__init__(limit=API_POOL_SIZE, timeout=API_TIMEOUT, **({'api': api} if api else {}))
+        self._connector_init.update(
+            limit_per_host=API_POOL_SIZE,
+            keepalive_timeout=API_KEEPALIVE,
+            ttl_dns_cache=API_DNS_TTL,
+        )
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        if timeout is None and method.__api_method__ in MEDIA_METHODS:
+            timeout = API_MEDIA_TIMEOUT
+        self.requests += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            return await super().make_request(bot, method, timeout)
+        finally:
+            self.in_flight -= 1
+
+    def idle_connections(self) -> int:
+        """Open keep-alive connections waiting in the pool (0 before the first request)."""
+        try:
+            return sum(len(conns) for conns in self._session.connector._conns.values())
+        except Exception:
+            return 0
+
+    def stats_text(self) -> str:
+        server = BOT_API_URL or 'api.telegram.org'
+        return (f'Bot API ({server}): занято соединений {self.in_flight}/{API_POOL_SIZE} '
+                f'(макс. {self.peak_in_flight}), в запасе {self.idle_connections()}, запросов {self.requests}')
+
+
+api_session = ApiSession()
+bot = Bot(token=BOT_TOKEN, session=api_session)
+dp = Dispatcher()
+
+
+# Классы исходящих запросов по убыванию приоритета. Класс и «поток» (одна рассылка) задаются
+# контекстом задачи: fan_out выставляет их для своих отправок, остальное — ответы в диалоге.
+SEND_LANES = ('interactive', 'admin', 'broadcast', 'delete', 'catchup')
+send_lane = contextvars.ContextVar('send_lane', default='interactive')
+send_flow = contextvars.ContextVar('send_flow', default=None)
+_flow_ids = itertools.count(1)
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """Token bucket shared by every Bot API call of this process (a worker gets SEND_RATE / WORKERS).
+
+    When calls have to wait, tokens go to the highest-priority lane first and,
+    within a lane, round-robin across flows so concurrent broadcasts share fairly.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        # lane -> OrderedDict flow -> deque of waiting futures
+        self.waiting = {lane: OrderedDict() for lane in SEND_LANES}
+        self.depth = dict.fromkeys(SEND_LANES, 0)
+        self.max_depth = dict.fromkeys(SEND_LANES, 0)
+        self.sent = dict.fromkeys(SEND_LANES, 0)
+        self.pump = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, lane: str = 'interactive', flow=None):
+        self.sent[lane] += 1
+        self._refill()
+        if self.tokens >= 1 and not any(self.depth.values()):
+            self.tokens -= 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self.waiting[lane].setdefault(flow, deque()).append(fut)
+        self.depth[lane] += 1
+        self.max_depth[lane] = max(self.max_depth[lane], self.depth[lane])
+        if self.pump is None or self.pump.done():
+            self.pump = asyncio.create_task(self._pump())
+        await fut
+
+    def _next_waiter(self):
+        for lane in SEND_LANES:
+            flows = self.waiting[lane]
+            while flows:
+                flow, waiters = next(iter(flows.items()))
+                fut = waiters.popleft()
+                self.depth[lane] -= 1
+                if waiters:
+                    flows.move_to_end(flow)
+                else:
+                    del flows[flow]
+                if not fut.cancelled():
+                    return fut
+        return None
+
+    async def _pump(self):
+        while any(self.depth.values()):
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+            fut = self._next_waiter()
+            if fut is not None:
+                self.tokens -= 1
+                fut.set_result(None)
+
+    def stats_text(self) -> str:
+        return 'Очереди отправки: ' + ', '.join(
+            f'{lane} {self.depth[lane]} (макс. {self.max_depth[lane]}, всего {self.sent[lane]})' for lane in SEND_LANES)
+
+    async def __call__(self, make_request, bot, method):
+        await self.acquire(send_lane.get(), send_flow.get())
+        return await make_request(bot, method)
+
+
+class CircuitOpenError(TelegramNetworkError):
+    """Raised without touching the network while the Bot API circuit is open."""
+
+
+class CircuitBreakerMiddleware(BaseRequestMiddleware):
+    """Stop calling the Bot API for a while after repeated network or server errors.
+
+    After `threshold` consecutive failures every call fails fast with CircuitOpenError
+    for `cooldown` seconds; then one trial call decides whether to close the circuit
+    or keep it open for another cooldown. Client errors (blocked user, bad request,
+    flood wait) mean the API is reachable and reset the failure count; a timed-out
+    getUpdates long poll counts neither way.
+    """
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_until = 0.0
+        self.trial = False
+        self.rejected = 0
+        self.trips = 0
+
+    @property
+    def is_open(self) -> bool:
+        return self.failures >= self.threshold
+
+    def _reject(self, method):
+        self.rejected += 1
+        raise CircuitOpenError(method=method, message='Bot API circuit is open')
+
+    def _failed(self, method, error):
+        self.failures += 1
+        if self.failures == self.threshold or self.trial:
+            self.opened_until = time.monotonic() + self.cooldown
+            self.trips += 1
+            logging.warning('Bot API circuit opened after %s failures (%s): %s', self.failures, method.__api_method__, error)
+            audit('api_circuit_open', failures=self.failures, method=method.__api_method__, error=str(error))
+
+    def _succeeded(self):
+        if self.is_open:
+            logging.info('Bot API circuit closed')
+            audit('api_circuit_closed')
+        self.failures = 0
+
+    def stats_text(self) -> str:
+        if self.is_open:
+            left = max(0, int(self.opened_until - time.monotonic()))
+            state = f'открыт, проверка через {left} с' if left else 'открыт, ждёт пробного запроса'
+        else:
+            state = f'закрыт, ошибок подряд {self.failures}'
+        return f'Предохранитель Bot API: {state} (срабатываний {self.trips}, отклонено {self.rejected})'
+
+    async def __call__(self, make_request, bot, method):
+        trial = False
+        if self.is_open:
+            if self.trial or time.monotonic() < self.opened_until:
+                self._reject(method)
+            self.trial = trial = True
+        try:
+            result = await make_request(bot, method)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            # таймаут long polling ничего не говорит о доступности API — не считаем его ошибкой
+            if not (method.__api_method__ == 'getUpdates' and isinstance(e.__cause__, asyncio.TimeoutError)):
+                self._failed(method, e)
+            raise
+        except Exception:
+            self._succeeded()
+            raise
+        else:
+            self._succeeded()
+            return result
+        finally:
+            if trial:
+                self.trial = False
+
+
+class StoreReleaseMiddleware(BaseRequestMiddleware):
+    """Worker mode: a handler's Bot API calls run outside the store transaction.
+
+    Before the request the changes made so far are saved, committed and the store lock is released;
+    afterwards the lock is taken again and documents other workers changed are reloaded.
+    """
+
+    async def __call__(self, make_request, bot, method):
+        held = store_tx.get()
+        # задачи, порождённые обработчиком, наследуют contextvar, но блокировку не держат
+        if held is None or held[1] is not asyncio.current_task():
+            return await make_request(bot, method)
+        await held[0].suspend()
+        try:
+            return await make_request(bot, method)
+        finally:
+            await held[0].resume()
+
+
+# самый внешний слой: блокировка хранилища отпускается ещё до ожидания в предохранителе и лимитере
+bot.session.middleware(StoreReleaseMiddleware())
+# предохранитель снаружи лимитера: пока он открыт, запросы отклоняются, не занимая очередь отправки
+circuit_breaker = CircuitBreakerMiddleware(CIRCUIT_FAILURES, CIRCUIT_COOLDOWN)
+bot.session.middleware(circuit_breaker)
+rate_limiter = RateLimitMiddleware(SEND_RATE)
+bot.session.middleware(rate_limiter)
+
+
+class UpdateScheduler:
+    """Outer update middleware: one user's updates run in arrival order, different users in parallel.
+
+    At most `concurrency` updates run at once; a user waiting for their own earlier update
+    does not hold a slot. Presses of IDEMPOTENT_CALLBACKS buttons are claimed on arrival by
+    (chat, message, data), so a repeated press is answered right away instead of running twice.
+    """
+
+    def __init__(self, concurrency: int, per_user: int):
+        self.slots = asyncio.Semaphore(concurrency)
+        self.per_user = per_user
+        # user id -> [lock, updates queued or running, warned about dropped messages]
+        self.users = {}
+        self.claimed = OrderedDict()  # idempotency key -> [monotonic time of the press, handled]
+        self.running = 0
+        self.dropped = 0
+        self.repeats = 0
+
+    def claim(self, key):
+        """None if the press is new (and now claimed), else whether the earlier one has finished."""
+        now = time.monotonic()
+        while self.claimed and next(iter(self.claimed.values()))[0] < now - IDEMPOTENCY_TTL:
+            self.claimed.popitem(last=False)
+        if key in self.claimed:
+            return self.claimed[key][1]
+        self.claimed[key] = [now, False]
+        return None
+
+    def stats_text(self) -> str:
+        waiting = sum(entry[1] for entry in self.users.values()) - self.running
+        return (f'Обновления: выполняется {self.running}, ждут {max(0, waiting)}, '
+                f'отброшено {self.dropped}, повторных нажатий {self.repeats}')
+
+    async def __call__(self, handler, event, ctx):
+        user = ctx.get('event_from_user')
+        cb = event.callback_query
+        key = None
+        if cb is not None and cb.message is not None and (cb.data or '').startswith(IDEMPOTENT_CALLBACKS):
+            key = (cb.message.chat.id, cb.message.message_id, cb.data)
+            handled = self.claim(key)
+            if handled is not None:
+                self.repeats += 1
+                try:
+                    await cb.answer('Уже выполнено.' if handled else 'Уже выполняется…')
+                except Exception:
+                    pass
+                return None
+        try:
+            if user is None:
+                async with self.slots:
+                    result = await self._run(handler, event, ctx)
+            else:
+                entry = self.users.setdefault(user.id, [asyncio.Lock(), 0, False])
+                if entry[1] >= self.per_user:
+                    # пользователь шлёт быстрее, чем мы успеваем обработать, — лишнее отбрасывается
+                    self.dropped += 1
+                    if key is not None:
+                        self.claimed.pop(key, None)
+                    await self._dropped(event, entry)
+                    return None
+                entry[1] += 1
+                try:
+                    async with entry[0], self.slots:
+                        result = await self._run(handler, event, ctx)
+                finally:
+                    entry[1] -= 1
+                    if not entry[1]:
+                        self.users.pop(user.id, None)
+            if key in self.claimed:
+                self.claimed[key][1] = True
+            return result
+        except BaseException:
+            # упавшее нажатие можно повторить
+            if key is not None:
+                self.claimed.pop(key, None)
+            raise
+
+    @staticmethod
+    async def _dropped(event, entry):
+        # нажатие кнопки получает ответ всегда, о сообщениях — одно предупреждение на очередь
+        try:
+            if event.callback_query is not None:
+                await event.callback_query.answer('Слишком много запросов, нажмите ещё раз чуть позже.')
+            elif event.message is not None and not entry[2]:
+                entry[2] = True
+                await event.message.answer('Слишком много сообщений подряд: часть не обработана, повторите позже.')
+        except Exception:
+            pass
+
+    async def _run(self, handler, event, ctx):
+        self.running += 1
+        try:
+            return await handler(event, ctx)
+        finally:
+            self.running -= 1
+
+
+update_scheduler = UpdateScheduler(UPDATE_CONCURRENCY, UPDATE_USER_QUEUE)
+dp.update.outer_middleware(update_scheduler)
+
+LOCK = asyncio.Lock()
+
+# data structure persisted to JSON
+data = {
+    'users': {},       # key: str(user_id) -> {username, last_message, msg_count, room, delivery, digests}
+    'drafts': {},      # key: str(user_id) -> {type, content, timestamp, room}; oldest first, see put_draft
+    'accepted': [],    # list of ints
+    'enabled': True,
+    'rooms': {},       # key: room_id -> room (see new_room), stored in ROOMS_DIR/<room_id>.json
+    'admin_sessions': {},  # key: str(user_id) -> {login, seen} (epoch seconds); file store only
+}
+
+
+def now_ts():
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+# --- records ---------------------------------------------------------------------
+# Пользователи, записи чата, черновики и жалобы хранятся в памяти не словарями, а объектами
+# со __slots__: на десятках тысяч записей это в разы меньше памяти. Читаются и пишутся они
+# как словари (msg['id'], msg.get('caption')), а на диск уходят тем же JSON-объектом, что и раньше.
+class Record:
+    """Compact record with a fixed set of fields; unknown keys go to a small overflow dict."""
+    __slots__ = ('_extra',)
+    FIELDS = ()
+
+    def __init_subclass__(cls, **kw):
+        super().__init_subclass__(**kw)
+        cls._field_set = frozenset(cls.FIELDS)
+
+    def __init__(self, values=None, **kw):
+        self._extra = None
+        for key, value in (values or {}).items():
+            self[key] = value
+        for key, value in kw.items():
+            self[key] = value
+
+    @classmethod
+    def of(cls, value):
+        """Record for a value loaded from storage; records are returned as they are."""
+        return value if isinstance(value, Record) else cls(value)
+
+    def __getitem__(self, key):
+        if key in self._field_set:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self._field_set:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._field_set:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in self._field_set:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            self[key] = default
+            return default
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def update(self, other=(), **kw):
+        for key, value in dict(other, **kw).items():
+            self[key] = value
+
+    def keys(self):
+        return [k for k in self.FIELDS if hasattr(self, k)] + list(self._extra or ())
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (Record, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def to_dict(self) -> dict:
+        return dict(self.items())
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.to_dict()!r})'
+
+
+class User(Record):
+    FIELDS = ('username', 'last_message', 'msg_count', 'room', 'delivery', 'digests', 'catchup',
+              'awaiting_admin_password', 'awaiting_complaint', 'awaiting_complaint_for')
+    __slots__ = FIELDS
+
+
+class ChatMessage(Record):
+    FIELDS = ('id', 'from_id', 'username', 'type', 'content', 'caption', 'timestamp', 'delivered',
+              'reply_target_id', 'src_mid', 'fp', 'edited', 'digest')
+    __slots__ = FIELDS
+
+
+class Draft(Record):
+    FIELDS = ('type', 'content', 'caption', 'timestamp', 'room', 'src_mid', 'confirm_mid',
+              'reply_target_id', 'fp', 'dup_of', 'held')
+    __slots__ = FIELDS
+
+
+class Complaint(Record):
+    FIELDS = ('id', 'target', 'status', 'reports', 'created', 'updated')
+    __slots__ = FIELDS
+
+
+def _record_default(obj):
+    # для json/orjson/msgpack: записи сериализуются как обычные объекты
+    if isinstance(obj, Record):
+        return obj.to_dict()
+    raise TypeError(f'{type(obj).__name__} is not serializable')
+
+
+def get_user(uid: str) -> User:
+    users = data.setdefault('users', {})
+    user = users.get(uid)
+    if not isinstance(user, User):
+        user = users[uid] = User(user)
+    return user
+
+
+def hydrate_room(room: dict):
+    # на месте: индексы комнаты привязаны к этим списку и словарю
+    chat = room.setdefault('chat', [])
+    chat[:] = [ChatMessage.of(m) for m in chat]
+    comps = room.get('complaints')
+    if isinstance(comps, dict):
+        for cid, comp in comps.items():
+            comps[cid] = Complaint.of(comp)
+
+
+def hydrate_core(doc: dict):
+    doc['users'] = {uid: User.of(u) for uid, u in doc.get('users', {}).items()}
+    doc['drafts'] = {uid: Draft.of(d) for uid, d in doc.get('drafts', {}).items()}
+
+
+# --- rooms -----------------------------------------------------------------------
+ROOM_ID_RE = re.compile(r'^[a-z0-9]{1,16}$')
+
+
+def new_room(room_id: str, title: str) -> dict:
+    return {
+        'id': room_id,
+        'title': title,
+        'members': [],     # list of ints
+        'chat': [],        # list of {id, from_id, username, type, content, timestamp, delivered}
+        'seq': 0,          # last chat entry id
+        'complaints': {},  # str(cid) -> complaint, see add_complaint_report
+        'complaint_seq': 0,
+        'banned': [],      # list of ints
+        'settings': {'enabled': True, 'cooldown': 30},
+        'digest': {},      # str(user_id) -> {since, ids}: posts waiting for the user's next digest
+    }
+
+
+def migrate_data():
+    """Bring data loaded from an older single-chat data.json to the rooms layout."""
+    rooms = data.setdefault('rooms', {})
+    # черновики могут не храниться на диске (DRAFTS_PERSIST)
+    data.setdefault('drafts', {})
+    legacy_chat = data.pop('chat', None)
+    legacy_complaints = data.pop('complaints', None)
+    legacy_banned = data.pop('banned', None)
+    if DEFAULT_ROOM not in rooms:
+        rooms[DEFAULT_ROOM] = new_room(DEFAULT_ROOM, 'Общий чат')
+    if legacy_chat is not None:
+        main = rooms[DEFAULT_ROOM]
+        # раньше сообщения адресовались индексом в списке, теперь — постоянным id (= индекс + 1)
+        for idx, msg in enumerate(legacy_chat):
+            msg['id'] = idx + 1
+            if 'reply_target_idx' in msg:
+                msg['reply_target_id'] = msg.pop('reply_target_idx') + 1
+        for comp in legacy_complaints or []:
+            if comp.get('target') is not None:
+                comp['target'] = comp['target'] + 1
+        main['chat'] = legacy_chat
+        main['seq'] = len(legacy_chat)
+        main['complaints'] = legacy_complaints or []
+        main['banned'] = legacy_banned or []
+        # раньше рассылка шла всем пользователям, они и становятся участниками общей комнаты
+        main['members'] = [int(u) for u in data.get('users', {})]
+        for uinfo in data.get('users', {}).values():
+            uinfo.setdefault('room', DEFAULT_ROOM)
+    for room in rooms.values():
+        # плоский список жалоб -> жалобы, сгруппированные по сообщению
+        if isinstance(room.get('complaints'), list):
+            room['complaints'], room['complaint_seq'] = group_complaints(room['complaints'])
+        hydrate_room(room)
+    hydrate_core(data)
+    for draft in data.get('drafts', {}).values():
+        if 'reply_target_idx' in draft:
+            draft['reply_target_id'] = draft.pop('reply_target_idx') + 1
+
+
+def get_room(room_id: str) -> dict:
+    rooms = data.setdefault('rooms', {})
+    if room_id not in rooms:
+        room_id = DEFAULT_ROOM
+        rooms.setdefault(DEFAULT_ROOM, new_room(DEFAULT_ROOM, 'Общий чат'))
+    return rooms[room_id]
+
+
+def user_room_id(uid: str) -> str:
+    room_id = data.get('users', {}).get(str(uid), {}).get('room')
+    return room_id if room_id in data.get('rooms', {}) else DEFAULT_ROOM
+
+
+def user_room(uid) -> dict:
+    return get_room(user_room_id(str(uid)))
+
+
+def join_room(uid: str, room_id: str):
+    uid_int = int(uid)
+    old = data.get('rooms', {}).get(data.get('users', {}).get(uid, {}).get('room'))
+    if old is not None and old['id'] != room_id and uid_int in old['members']:
+        old['members'].remove(uid_int)
+    room = get_room(room_id)
+    if uid_int not in room['members']:
+        room['members'].append(uid_int)
+    get_user(uid)['room'] = room['id']
+    return room
+
+
+def find_chat(room: dict, msg_id: int):
+    """Chat entry with the given id or None; ids grow monotonically, so a binary search is enough."""
+    chat = room.get('chat', [])
+    pos = bisect.bisect_left(chat, msg_id, key=lambda m: m['id'])
+    if pos < len(chat) and chat[pos]['id'] == msg_id:
+        return chat[pos]
+    return None
+
+
+def remove_chat(room: dict, msg_id: int):
+    chat = room.get('chat', [])
+    pos = bisect.bisect_left(chat, msg_id, key=lambda m: m['id'])
+    if pos < len(chat) and chat[pos]['id'] == msg_id:
+        search_unindex_post(room, msg_id)
+        return chat.pop(pos)
+    return None
+
+# room_id -> {'chat': chat list the index was built from, 'posts': {from_id: [chat entry ids]}}
+_author_index = {}
+
+
+def _author_posts_index(room: dict) -> dict:
+    chat = room.setdefault('chat', [])
+    idx = _author_index.get(room['id'])
+    if idx is None or idx['chat'] is not chat:
+        idx = {'chat': chat, 'posts': {}}
+        for msg in chat:
+            idx['posts'].setdefault(msg.get('from_id'), []).append(msg['id'])
+        _author_index[room['id']] = idx
+    return idx
+
+
+def index_author_post(room: dict, msg: dict):
+    """Register a chat entry in the author index; call before appending it to room['chat']."""
+    _author_posts_index(room)['posts'].setdefault(msg.get('from_id'), []).append(msg['id'])
+
+
+def author_posts(room: dict, author_id: int, since: datetime = None) -> list:
+    """Chat entries posted by author_id (optionally not older than since), oldest first."""
+    ids = _author_posts_index(room)['posts'].get(author_id, [])
+    posts = [m for m in (find_chat(room, i) for i in ids) if m is not None]
+    # записи, удалённые из чата другими путями, выпадают из индекса при первом обращении
+    ids[:] = [m['id'] for m in posts]
+    if since is not None:
+        posts = [m for m in posts if datetime.fromisoformat(m['timestamp']) >= since]
+    return posts
+
+# Поиск по истории: room_id -> {'room', 'postings': {слово: set(id)}, 'tokens': {id: set(слов)}}.
+# Индекс строится один раз на комнату и дальше обновляется при публикации, правке и удалении.
+_search_index = {}
+
+
+def _post_tokens(msg: dict) -> set:
+    text = msg.get('content') if msg.get('type') == 'text' else ''
+    return set(_WORD_RE.findall(f"{text or ''} {msg.get('caption') or ''}".lower()))
+
+
+def _search_idx(room: dict) -> dict:
+    idx = _search_index.get(room['id'])
+    if idx is None or idx['room'] is not room:
+        idx = {'room': room, 'postings': {}, 'tokens': {}}
+        _search_index[room['id']] = idx
+        for msg in room.get('chat', []):
+            search_index_post(room, msg)
+    return idx
+
+
+def search_index_post(room: dict, msg: dict):
+    """(Re)index a chat entry after it was published or edited."""
+    idx = _search_idx(room)
+    search_unindex_post(room, msg['id'])
+    tokens = _post_tokens(msg)
+    idx['tokens'][msg['id']] = tokens
+    for token in tokens:
+        idx['postings'].setdefault(token, set()).add(msg['id'])
+
+
+def search_unindex_post(room: dict, msg_id: int):
+    idx = _search_index.get(room['id'])
+    if idx is None or idx['room'] is not room:
+        return
+    for token in idx['tokens'].pop(msg_id, ()):
+        ids = idx['postings'].get(token)
+        if ids is not None:
+            ids.discard(msg_id)
+            if not ids:
+                del idx['postings'][token]
+
+
+def parse_search_query(text: str) -> dict:
+    """'слова author:123|@name type:photo from:2026-01-31 to:2026-02-28' -> query dict."""
+    query = {'words': [], 'author': None, 'type': None, 'since': None, 'until': None}
+    for part in text.split():
+        key, _, value = part.partition(':')
+        if key == 'author' and value:
+            query['author'] = int(value) if value.isdigit() else value.lstrip('@').lower()
+        elif key == 'type' and value in ('text', 'photo', 'video', 'album'):
+            query['type'] = value
+        elif key in ('from', 'to') and value:
+            day = datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+            if key == 'from':
+                query['since'] = day
+            else:
+                query['until'] = day + timedelta(days=1)
+        else:
+            query['words'] += _WORD_RE.findall(part.lower())
+    return query
+
+
+def search_posts(room: dict, query: dict) -> list:
+    """Chat entries matching every word and filter, newest first."""
+    idx = _search_idx(room)
+    if query['words']:
+        postings = sorted((idx['postings'].get(w, set()) for w in query['words']), key=len)
+        ids = set(postings[0]).intersection(*postings[1:])
+        posts = [m for m in (find_chat(room, i) for i in sorted(ids, reverse=True)) if m is not None]
+    elif isinstance(query['author'], int):
+        posts = author_posts(room, query['author'])[::-1]
+    else:
+        posts = room.get('chat', [])[::-1]
+    result = []
+    for msg in posts:
+        author = query['author']
+        if isinstance(author, int) and msg.get('from_id') != author:
+            continue
+        if isinstance(author, str) and (msg.get('username') or '').lower() != author:
+            continue
+        if query['type'] and msg.get('type') != query['type']:
+            continue
+        if query['since'] or query['until']:
+            ts = datetime.fromisoformat(msg['timestamp'])
+            if (query['since'] and ts < query['since']) or (query['until'] and ts >= query['until']):
+                continue
+        result.append(msg)
+    return result
+
+
+def delivered_ids(value) -> list:
+    """Message ids of one delivered copy: an int for single messages, a list for albums."""
+    if isinstance(value, list):
+        return value
+    return [value] if value is not None else []
+
+
+def reply_entry(room: dict, uid: str, message: types.Message):
+    """Chat entry a user's message answers: the post behind the replied-to copy.
+
+    In a text digest the post is picked by the quoted fragment, otherwise it is the last one.
+    """
+    target_mid = message.reply_to_message.message_id
+    for chat_msg in reversed(room.get('chat', [])):
+        if target_mid in delivered_ids(chat_msg.get('delivered', {}).get(uid)):
+            return chat_msg
+    comp = (data.get('users', {}).get(uid, {}).get('digests') or {}).get(str(target_mid))
+    if not comp or comp[0] != room['id']:
+        return None
+    posts = [m for m in (find_chat(room, i) for i in comp[1]) if m is not None]
+    quote = message.quote.text if message.quote else None
+    if quote:
+        for m in posts:
+            if quote in (m.get('content') or ''):
+                return m
+    return posts[-1] if posts else None
+
+
+def album_media(items: list, caption: str = None) -> list:
+    media = []
+    for i, item in enumerate(items):
+        media_cls = InputMediaPhoto if item['type'] == 'photo' else InputMediaVideo
+        media.append(media_cls(media=item['file_id'], caption=caption if i == 0 and caption else None))
+    return media
+
+
+def parse_room_ref(payload: str):
+    """'<room>_<n>' -> (room_id, n); legacy '<n>' (index in the single chat) -> (DEFAULT_ROOM, n + 1)."""
+    parts = payload.split('_')
+    if len(parts) == 1:
+        return DEFAULT_ROOM, int(parts[0]) + 1
+    return parts[0], int(parts[1])
+
+
+# --- complaints ------------------------------------------------------------------
+# Жалобы комнаты: room['complaints'] — dict str(cid) -> {id, target, status, reports, created, updated};
+# повторные жалобы на то же сообщение добавляются в reports той же записи.
+COMPLAINT_STATUSES = ('open', 'handled', 'skipped')
+COMPLAINT_STATUS_TITLES = {'open': 'Открытые', 'handled': 'Обработанные', 'skipped': 'Пропущенные'}
+COMPLAINT_STATUS_NAMES = {'open': 'открыта', 'handled': 'обработана', 'skipped': 'пропущена'}
+
+# room_id -> {'src': complaints dict, 'target': {target: cid}, 'status': {status: set(cid)}}
+_complaint_index = {}
+
+
+def complaint_index(room: dict) -> dict:
+    """Lookup tables over room['complaints']; rebuilt whenever the complaints dict was replaced (load, refresh, reset)."""
+    comps = room.setdefault('complaints', {})
+    idx = _complaint_index.get(room['id'])
+    if idx is None or idx['src'] is not comps:
+        idx = {'src': comps, 'target': {}, 'status': {s: set() for s in COMPLAINT_STATUSES}}
+        for cid, comp in comps.items():
+            if comp.get('target') is not None and comp.get('status') == 'open':
+                idx['target'][comp['target']] = cid
+            idx['status'].setdefault(comp.get('status', 'open'), set()).add(cid)
+        _complaint_index[room['id']] = idx
+    return idx
+
+
+def add_complaint_report(room: dict, target, report: dict) -> dict:
+    """Attach a report to the open complaint about `target`, or open a new complaint."""
+    idx = complaint_index(room)
+    comps = room['complaints']
+    cid = idx['target'].get(target) if target is not None else None
+    if cid is not None and cid in comps:
+        comp = comps[cid]
+        # один пользователь — одна жалоба на сообщение, повтор лишь обновляет причину
+        comp['reports'] = [r for r in comp['reports'] if r.get('from') != report.get('from')]
+    else:
+        room['complaint_seq'] = room.get('complaint_seq', 0) + 1
+        cid = str(room['complaint_seq'])
+        comp = comps[cid] = Complaint(id=int(cid), target=target, status='open', reports=[],
+                                      created=report['timestamp'])
+        idx['status']['open'].add(cid)
+        if target is not None:
+            idx['target'][target] = cid
+    comp['reports'].append(report)
+    comp['updated'] = report['timestamp']
+    return comp
+
+
+def set_complaint_status(room: dict, cid: str, status: str):
+    idx = complaint_index(room)
+    comp = room['complaints'].get(cid)
+    if comp is None:
+        return None
+    idx['status'].get(comp.get('status', 'open'), set()).discard(cid)
+    idx['status'][status].add(cid)
+    if comp.get('target') is not None and idx['target'].get(comp['target']) == cid and status != 'open':
+        del idx['target'][comp['target']]
+    comp['status'] = status
+    comp['updated'] = now_ts()
+    return comp
+
+
+def drop_complaint(room: dict, cid: str):
+    idx = complaint_index(room)
+    comp = room['complaints'].pop(cid, None)
+    if comp is not None:
+        idx['status'].get(comp.get('status', 'open'), set()).discard(cid)
+        if idx['target'].get(comp.get('target')) == cid:
+            del idx['target'][comp['target']]
+    return comp
+
+
+def complaint_ids(room: dict, status: str) -> list:
+    return sorted(complaint_index(room)['status'].get(status, ()), key=int)
+
+
+def complaint_reporters(comp: dict) -> list:
+    return list(dict.fromkeys(r['from'] for r in comp.get('reports', []) if r.get('from')))
+
+
+def group_complaints(items: list) -> tuple[dict, int]:
+    """Old flat list of complaints -> (dict grouped by target, last cid)."""
+    comps = {}
+    by_target = {}
+    seq = 0
+    for item in items:
+        report = {k: item.get(k) for k in ('from', 'from_username', 'text', 'timestamp')}
+        target = item.get('target')
+        cid = by_target.get(target) if target is not None else None
+        if cid is None:
+            seq += 1
+            cid = str(seq)
+            comps[cid] = {'id': seq, 'target': target, 'status': 'open', 'reports': [],
+                          'created': item.get('timestamp')}
+            if target is not None:
+                by_target[target] = cid
+        comps[cid]['reports'].append(report)
+        comps[cid]['updated'] = item.get('timestamp')
+    return comps, seq
+
+
+# --- codec ---------------------------------------------------------------------
+def codec_dumps(obj, pretty: bool = False) -> bytes:
+    if DATA_CODEC == 'msgpack':
+        return msgpack.packb(obj, use_bin_type=True, default=_record_default)
+    if DATA_CODEC == 'orjson':
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if pretty else 0)
+        return orjson.dumps(obj, option=option, default=_record_default)
+    if pretty:
+        return json.dumps(obj, ensure_ascii=False, indent=2, default=_record_default).encode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=_record_default).encode('utf-8')
+
+
+def codec_loads(raw: bytes):
+    # формат определяется по первому байту, так что старые data.json читаются при любом DATA_CODEC
+    head = raw.lstrip()[:1]
+    if head in (b'{', b'[', b'"') or head.isdigit():
+        return orjson.loads(raw) if orjson is not None else json.loads(raw.decode('utf-8'))
+    if msgpack is None:
+        raise ValueError('data looks like msgpack but msgpack is not installed')
+    return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+
+# --- per-record encryption ---------------------------------------------------
+# keyring: kid -> AESGCM; kid is a short fingerprint of the derived key
+_keyring = {}
+# kid and KDF params used for writing
+_write_key = None
+# document -> {(associated data, kid, plaintext digest) -> token}, so unchanged records are not re-encrypted
+_sealed_cache = {}
+
+
+def _kid_for(key: bytes) -> str:
+    return hashlib.sha256(b'kid:' + key).hexdigest()[:8]
+
+
+def _derive_key(passphrase: str, params: dict) -> bytes:
+    kdf = Scrypt(salt=base64.b64decode(params['salt']), length=32, n=params['n'], r=params['r'], p=params['p'])
+    return kdf.derive(passphrase.encode('utf-8'))
+
+
+def _unlock_keys(keys: dict):
+    """Derive keys for every kid listed in the file from DATA_KEY / DATA_KEY_PREVIOUS."""
+    global _write_key
+    for kid, params in keys.items():
+        if kid in _keyring:
+            continue
+        for passphrase in (DATA_KEY_ENV, DATA_KEY_PREVIOUS):
+            if not passphrase:
+                continue
+            key = _derive_key(passphrase, params)
+            if _kid_for(key) == kid:
+                _keyring[kid] = AESGCM(key)
+                if passphrase == DATA_KEY_ENV and _write_key is None:
+                    _write_key = (kid, params)
+                break
+
+
+def _ensure_write_key():
+    global _write_key
+    if _write_key is None:
+        params = dict(KDF_PARAMS, salt=base64.b64encode(os.urandom(16)).decode('ascii'))
+        key = _derive_key(DATA_KEY_ENV, params)
+        kid = _kid_for(key)
+        _keyring[kid] = AESGCM(key)
+        _write_key = (kid, params)
+    return _write_key
+
+
+def _record_ad(name: str, section: str, key: str = '') -> bytes:
+    # associated data binds the record to its document and dict key: a record copied
+    # into another room or under another user id will not decrypt. List records
+    # (chat) carry their id inside the encrypted payload, so for them key is ''.
+    return f'{name}\x00{section}\x00{key}'.encode('utf-8')
+
+
+def _seal_record(ad: bytes, plain: bytes, kid: str):
+    nonce = os.urandom(12)
+    token = bytes.fromhex(kid) + nonce + _keyring[kid].encrypt(nonce, plain, ad)
+    # msgpack хранит байты как есть, для JSON нужен base64
+    return token if DATA_CODEC == 'msgpack' else base64.b64encode(token).decode('ascii')
+
+
+def _open_record(ad: bytes, section: str, token, cache: dict = None):
+    raw = token if isinstance(token, bytes) else base64.b64decode(token)
+    kid, nonce, ct = raw[:4].hex(), raw[4:16], raw[16:]
+    aead = _keyring.get(kid)
+    if aead is None:
+        raise ValueError(f'no key for record (kid {kid}); set DATA_KEY_PREVIOUS for rotation')
+    try:
+        plain = aead.decrypt(nonce, ct, ad)
+    except InvalidTag:
+        # записи до привязки к документу: associated data была только имя секции.
+        # Такой токен не кэшируется и при следующем сохранении перешифруется.
+        return codec_loads(aead.decrypt(nonce, ct, section.encode('ascii')))
+    if cache is not None and isinstance(token, bytes) == (DATA_CODEC == 'msgpack'):
+        # запомнить токен: пока запись не изменится, она сохранится теми же байтами
+        cache[(ad, kid, hashlib.blake2b(plain, digest_size=16).digest())] = token
+    return codec_loads(plain)
+
+
+def _seal_document(doc: dict, name: str) -> dict:
+    """Encrypt each record separately; records that did not change reuse their cached token."""
+    kid, params = _ensure_write_key()
+    old_cache = _sealed_cache.get(name, {})
+    new_cache = {}
+
+    def seal(section, value, key=''):
+        plain = codec_dumps(value)
+        ad = _record_ad(name, section, key)
+        ck = (ad, kid, hashlib.blake2b(plain, digest_size=16).digest())
+        token = old_cache.get(ck) or new_cache.get(ck)
+        if token is None:
+            token = _seal_record(ad, plain, kid)
+        new_cache[ck] = token
+        return token
+
+    records = {}
+    meta = {}
+    for section, value in doc.items():
+        if section in RECORD_SECTIONS and isinstance(value, dict):
+            records[section] = {k: seal(section, v, str(k)) for k, v in value.items()}
+        elif section in RECORD_SECTIONS and isinstance(value, list):
+            records[section] = [seal(section, v) for v in value]
+        else:
+            meta[section] = value
+    records['meta'] = seal('meta', meta)
+    _sealed_cache[name] = new_cache
+    return {'format': STORAGE_FORMAT, 'keys': {kid: params}, 'records': records}
+
+
+def _open_document(envelope: dict, name: str) -> dict:
+    _unlock_keys(envelope.get('keys', {}))
+    records = envelope.get('records', {})
+    cache = _sealed_cache.setdefault(name, {})
+    doc = dict(_open_record(_record_ad(name, 'meta'), 'meta', records['meta'], cache)) if 'meta' in records else {}
+    for section in RECORD_SECTIONS:
+        value = records.get(section)
+        if isinstance(value, dict):
+            doc[section] = {k: _open_record(_record_ad(name, section, str(k)), section, t, cache)
+                            for k, t in value.items()}
+        elif isinstance(value, list):
+            doc[section] = [_open_record(_record_ad(name, section), section, t, cache) for t in value]
+    return doc
+
+
+def _open_legacy_fernet(raw: bytes) -> dict:
+    # старый формат: весь документ одним Fernet-токеном, ключ = sha256(DATA_KEY)
+    for passphrase in (DATA_KEY_ENV, DATA_KEY_PREVIOUS):
+        if not passphrase:
+            continue
+        legacy = Fernet(base64.urlsafe_b64encode(hashlib.sha256(passphrase.encode()).digest()))
+        try:
+            return json.loads(legacy.decrypt(raw).decode('utf-8'))
+        except InvalidToken:
+            continue
+    raise ValueError('legacy Fernet file: wrong DATA_KEY')
+
+
+def decode_storage(raw: bytes, name: str = 'core') -> dict:
+    if raw.startswith(b'gAAAAA'):
+        return _open_legacy_fernet(raw)
+    doc = codec_loads(raw)
+    if isinstance(doc, dict) and doc.get('format') == STORAGE_FORMAT and 'records' in doc:
+        if not ENCRYPTION_ENABLED:
+            raise ValueError('data file is encrypted but DATA_KEY is not set')
+        return _open_document(doc, name)
+    return doc
+
+
+def encode_storage(doc: dict, name: str = 'core') -> bytes:
+    if ENCRYPTION_ENABLED:
+        doc = _seal_document(doc, name)
+    return codec_dumps(doc, pretty=DATA_PRETTY)
+
+
+# --- store: named documents ('core' -> DATA_FILE, 'room:<id>' -> ROOMS_DIR/<id>.json) ---
+# with STORE_BACKEND=sqlite the same names are rows of the docs table
+_db_conn = None
+# document -> version last read or written by this process (sqlite only)
+_doc_versions = {}
+
+
+def _db():
+    global _db_conn
+    if _db_conn is None:
+        _db_conn = sqlite3.connect(STORE_PATH, timeout=5, isolation_level=None)
+        _db_conn.execute('PRAGMA journal_mode=WAL')
+        _db_conn.execute('PRAGMA synchronous=NORMAL')
+        _db_conn.executescript("""
+            CREATE TABLE IF NOT EXISTS docs (name TEXT PRIMARY KEY, body BLOB NOT NULL, version INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS admin_sessions (user_id INTEGER PRIMARY KEY, login REAL NOT NULL DEFAULT 0, seen REAL NOT NULL DEFAULT 0);
+            CREATE TABLE IF NOT EXISTS updates (id INTEGER PRIMARY KEY AUTOINCREMENT, shard INTEGER NOT NULL, body TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS updates_shard ON updates (shard, id);
+            CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, shard INTEGER NOT NULL, room TEXT NOT NULL, msg_id INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS jobs_shard ON jobs (shard, id);
+            CREATE TABLE IF NOT EXISTS admin_login_failures (user_id INTEGER NOT NULL, ts REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS admin_login_failures_user ON admin_login_failures (user_id, ts);
+        """)
+        if 'login' not in {row[1] for row in _db_conn.execute('PRAGMA table_info(admin_sessions)')}:
+            # таблица без сроков сессий: старые сессии считаются истёкшими
+            _db_conn.execute('ALTER TABLE admin_sessions ADD COLUMN login REAL NOT NULL DEFAULT 0')
+            _db_conn.execute('ALTER TABLE admin_sessions ADD COLUMN seen REAL NOT NULL DEFAULT 0')
+    return _db_conn
+
+
+# Файл-замок хранилища: работающий бот (и каждый воркер) держит на нём общую блокировку,
+# --restore — исключительную, так что восстановление не идёт под живым ботом
+_store_hold = None
+
+
+def hold_store(exclusive: bool = False) -> bool:
+    """Take the store's lock file for this process; False if another process holds it incompatibly."""
+    global _store_hold
+    try:
+        import fcntl
+    except ImportError:
+        # без flock (Windows) проверка недоступна
+        return True
+    f = open((STORE_PATH if STORE_BACKEND == 'sqlite' else DATA_FILE) + '.lock', 'a')
+    try:
+        fcntl.flock(f, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    _store_hold = f
+    return True
+
+
+def _store_path(name: str) -> str:
+    if name == 'core':
+        return DATA_FILE
+    if name.startswith('stats'):
+        return name.replace(':', '.') + '.json'
+    return os.path.join(ROOMS_DIR, name.split(':', 1)[1] + '.json')
+
+
+def _store_read(name: str):
+    if STORE_BACKEND == 'sqlite':
+        row = _db().execute('SELECT body, version FROM docs WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        _doc_versions[name] = row[1]
+        return bytes(row[0])
+    path = _store_path(name)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _store_write(name: str, content: bytes):
+    if STORE_BACKEND == 'sqlite':
+        db = _db()
+        db.execute('INSERT INTO docs (name, body, version) VALUES (?, ?, 1) '
+                   'ON CONFLICT (name) DO UPDATE SET body = excluded.body, version = version + 1', (name, content))
+        _doc_versions[name] = db.execute('SELECT version FROM docs WHERE name = ?', (name,)).fetchone()[0]
+        return
+    path = _store_path(name)
+    if name != 'core':
+        os.makedirs(ROOMS_DIR, exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def _store_delete(name: str):
+    if STORE_BACKEND == 'sqlite':
+        _db().execute('DELETE FROM docs WHERE name = ?', (name,))
+        _doc_versions.pop(name, None)
+        return
+    try:
+        os.remove(_store_path(name))
+    except FileNotFoundError:
+        pass
+
+
+def _file_names() -> list:
+    names = ['core'] if os.path.exists(DATA_FILE) else []
+    if os.path.isdir(ROOMS_DIR):
+        names += [f'room:{fn[:-5]}' for fn in sorted(os.listdir(ROOMS_DIR)) if fn.endswith('.json')]
+    return names
+
+
+def _store_names() -> list:
+    if STORE_BACKEND == 'sqlite':
+        # только данные бота; документы статистики ('stats...') читаются отдельно
+        names = [row[0] for row in _db().execute(
+            "SELECT name FROM docs WHERE name = 'core' OR name LIKE 'room:%' ORDER BY name <> 'core', name")]
+        if not names and _file_names():
+            # первый запуск на sqlite: перенести data.json и rooms/ в базу как есть
+            for name in _file_names():
+                with open(_store_path(name), 'rb') as f:
+                    _store_write(name, f.read())
+            names = _store_names()
+        return names
+    return _file_names()
+
+
+class store_lock:
+    """Cross-process critical section (sqlite write transaction); a plain asyncio lock with the file store.
+
+    Everything written inside is committed atomically on exit.
+    """
+    _local = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self._local.acquire()
+        if STORE_BACKEND != 'sqlite':
+            return self
+        try:
+            await self._begin()
+        except BaseException:
+            self._local.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if STORE_BACKEND == 'sqlite':
+                _db().execute('ROLLBACK' if exc_type is not None else 'COMMIT')
+        finally:
+            self._local.release()
+
+    @staticmethod
+    async def _begin():
+        db = _db()
+        # BEGIN IMMEDIATE без ожидания внутри sqlite, чтобы не блокировать event loop
+        db.execute('PRAGMA busy_timeout = 0')
+        try:
+            while True:
+                try:
+                    db.execute('BEGIN IMMEDIATE')
+                    break
+                except sqlite3.OperationalError:
+                    await asyncio.sleep(0.02)
+        finally:
+            db.execute('PRAGMA busy_timeout = 5000')
+
+    async def suspend(self):
+        """Save and commit what was changed so far and let other workers in, e.g. around a Bot API call."""
+        # несохранённые правки обработчика пишутся сейчас: resume() перечитает документы, изменённые другими
+        await save_data()
+        if STORE_BACKEND == 'sqlite':
+            _db().execute('COMMIT')
+        self._local.release()
+
+    async def resume(self):
+        """Take the store again after suspend() and pick up what other workers wrote meanwhile."""
+        await self._local.acquire()
+        if STORE_BACKEND == 'sqlite':
+            try:
+                await self._begin()
+            except BaseException:
+                self._local.release()
+                raise
+        refresh_data()
+
+    async def rollback(self):
+        """Drop uncommitted writes and reload the documents they touched in memory."""
+        if STORE_BACKEND != 'sqlite':
+            return
+        db = _db()
+        db.execute('ROLLBACK')
+        await self._begin()
+        # версии забываются, чтобы refresh_data перечитал всё из хранилища
+        _doc_versions.clear()
+        refresh_data()
+
+
+# (store_lock, task) while a worker handles an update: Bot API calls made by that
+# task commit and release the store for their duration (StoreReleaseMiddleware)
+store_tx = contextvars.ContextVar('store_tx', default=None)
+
+
+class AdminSessions:
+    """Logged-in admins with an absolute lifetime (ADMIN_SESSION_TTL) and an idle timeout.
+
+    Sessions survive restarts: with the sqlite store they live in its admin_sessions table
+    (shared by all workers), otherwise in data['admin_sessions'] of the core document.
+    Expired sessions are dropped when they are next looked at.
+    """
+
+    def __init__(self, table: str):
+        self.table = table
+        # ids with a stored session, so touch() on a regular user's update costs no query;
+        # re-read periodically, another worker may have logged someone out
+        self._ids = None
+        self._ids_read = 0.0
+
+    def _known(self, user_id) -> bool:
+        if STORE_BACKEND != 'sqlite':
+            return str(int(user_id)) in data.get('admin_sessions', {})
+        if self._ids is None or time.monotonic() - self._ids_read > 60:
+            self._ids = {row[0] for row in _db().execute(f'SELECT user_id FROM {self.table}')}
+            self._ids_read = time.monotonic()
+        return int(user_id) in self._ids
+
+    @staticmethod
+    def _valid(login: float, seen: float, now: float) -> bool:
+        return now - login < ADMIN_SESSION_TTL and now - seen < ADMIN_IDLE_TIMEOUT
+
+    def _get(self, user_id):
+        if STORE_BACKEND == 'sqlite':
+            return _db().execute(f'SELECT login, seen FROM {self.table} WHERE user_id = ?', (int(user_id),)).fetchone()
+        s = data.get('admin_sessions', {}).get(str(int(user_id)))
+        return (s['login'], s['seen']) if s else None
+
+    def __contains__(self, user_id):
+        row = self._get(user_id)
+        if row is None:
+            return False
+        if not self._valid(row[0], row[1], time.time()):
+            self.discard(user_id)
+            return False
+        return True
+
+    def add(self, user_id):
+        now = time.time()
+        if STORE_BACKEND == 'sqlite':
+            _db().execute(f'INSERT OR REPLACE INTO {self.table} (user_id, login, seen) VALUES (?, ?, ?)',
+                          (int(user_id), now, now))
+            if self._ids is not None:
+                self._ids.add(int(user_id))
+        else:
+            data.setdefault('admin_sessions', {})[str(int(user_id))] = {'login': now, 'seen': now}
+
+    def touch(self, user_id):
+        """Record admin activity; written at most once a minute per session."""
+        if not self._known(user_id):
+            return
+        row = self._get(user_id)
+        now = time.time()
+        if row is None or not self._valid(row[0], row[1], now) or now - row[1] < 60:
+            return
+        if STORE_BACKEND == 'sqlite':
+            _db().execute(f'UPDATE {self.table} SET seen = ? WHERE user_id = ?', (now, int(user_id)))
+        else:
+            data['admin_sessions'][str(int(user_id))]['seen'] = now
+
+    def discard(self, user_id):
+        if STORE_BACKEND == 'sqlite':
+            _db().execute(f'DELETE FROM {self.table} WHERE user_id = ?', (int(user_id),))
+            if self._ids is not None:
+                self._ids.discard(int(user_id))
+        else:
+            data.get('admin_sessions', {}).pop(str(int(user_id)), None)
+
+    def __iter__(self):
+        now = time.time()
+        if STORE_BACKEND == 'sqlite':
+            rows = _db().execute(f'SELECT user_id, login, seen FROM {self.table}').fetchall()
+        else:
+            rows = [(int(k), s['login'], s['seen']) for k, s in data.get('admin_sessions', {}).items()]
+        return iter([uid for uid, login, seen in rows if self._valid(login, seen, now)])
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+
+# runtime admin sessions (anonymous admins who logged in with password)
+admin_sessions = AdminSessions('admin_sessions')
+
+@dp.update.outer_middleware()
+async def touch_admin_session(handler, event, ctx):
+    # любое действие админа продлевает его сессию до ADMIN_IDLE_TIMEOUT
+    user = ctx.get('event_from_user')
+    if user is not None:
+        admin_sessions.touch(user.id)
+    return await handler(event, ctx)
+
+
+# --- активность --------------------------------------------------------------------
+# Скользящие счётчики за последние минуты/часы/дни и оценка числа активных пользователей
+# (HyperLogLog): память постоянная, обновление — O(1) прямо в обработчиках, без сканов chat.
+# Хранятся отдельным документом 'stats' (у воркера — 'stats:<N>'), в панели суммируются.
+class RollingCounter:
+    """Event counts in the last `size` buckets of `width` seconds."""
+
+    def __init__(self, width: int, size: int):
+        self.width = width
+        self.size = size
+        self.head = int(time.time() // width)
+        self.slots = [0] * size
+
+    def _advance(self, now: float):
+        bucket = int(now // self.width)
+        if bucket > self.head:
+            for b in range(max(self.head + 1, bucket - self.size + 1), bucket + 1):
+                self.slots[b % self.size] = 0
+            self.head = bucket
+
+    def add(self, n: int = 1):
+        self._advance(time.time())
+        self.slots[self.head % self.size] += n
+
+    def series(self) -> list:
+        """Counts from the oldest bucket to the current one."""
+        self._advance(time.time())
+        return [self.slots[b % self.size] for b in range(self.head - self.size + 1, self.head + 1)]
+
+    def merge(self, other: 'RollingCounter'):
+        now = time.time()
+        self._advance(now)
+        other._advance(now)
+        self.slots = [a + b for a, b in zip(self.slots, other.slots)]
+
+    def to_doc(self) -> dict:
+        return {'head': self.head, 'slots': self.slots}
+
+    def load(self, doc: dict):
+        if len(doc.get('slots', ())) == self.size:
+            self.head, self.slots = doc['head'], list(doc['slots'])
+
+
+class HyperLogLog:
+    """Approximate count of distinct values in 2**p one-byte registers (about 1.6% error at p=10)."""
+    P = 10
+    M = 1 << P
+
+    def __init__(self, registers: bytes = None):
+        self.registers = bytearray(registers) if registers else bytearray(self.M)
+
+    def add(self, value):
+        h = int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+        idx = h >> (64 - self.P)
+        rank = (64 - self.P) - (h & ((1 << (64 - self.P)) - 1)).bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other: 'HyperLogLog'):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+        m = self.M
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # на малых числах точнее линейный подсчёт по пустым регистрам
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+
+class RollingUniques(RollingCounter):
+    """Distinct values per bucket; a sketch exists only for buckets that saw any value."""
+
+    def __init__(self, width: int, size: int):
+        super().__init__(width, size)
+        self.slots = [None] * size
+
+    def _advance(self, now: float):
+        bucket = int(now // self.width)
+        if bucket > self.head:
+            for b in range(max(self.head + 1, bucket - self.size + 1), bucket + 1):
+                self.slots[b % self.size] = None
+            self.head = bucket
+
+    def add(self, value):
+        self._advance(time.time())
+        slot = self.head % self.size
+        if self.slots[slot] is None:
+            self.slots[slot] = HyperLogLog()
+        self.slots[slot].add(value)
+
+    def count(self, last: int) -> int:
+        """Distinct values over the last `last` buckets, the current one included."""
+        total = HyperLogLog()
+        for b in range(self.head - last + 1, self.head + 1):
+            sketch = self.slots[b % self.size]
+            if sketch is not None:
+                total.merge(sketch)
+        return total.count()
+
+    def merge(self, other: 'RollingUniques'):
+        now = time.time()
+        self._advance(now)
+        other._advance(now)
+        for i, sketch in enumerate(other.slots):
+            if sketch is not None:
+                if self.slots[i] is None:
+                    self.slots[i] = HyperLogLog()
+                self.slots[i].merge(sketch)
+
+    def to_doc(self) -> dict:
+        return {'head': self.head,
+                'slots': [base64.b64encode(s.registers).decode() if s is not None else None for s in self.slots]}
+
+    def load(self, doc: dict):
+        if len(doc.get('slots', ())) == self.size:
+            self.head = doc['head']
+            self.slots = [HyperLogLog(base64.b64decode(s)) if s else None for s in doc['slots']]
+
+
+class Activity:
+    """Rolling activity of this process: updates, posts and deliveries; distinct active users."""
+    COUNTERS = ('updates', 'posts', 'deliveries')
+
+    def __init__(self):
+        # по минутам за час, по часам за двое суток, по дням за месяц
+        self.rings = {
+            name: {'minute': RollingCounter(60, 60), 'hour': RollingCounter(3600, 48), 'day': RollingCounter(86400, 30)}
+            for name in self.COUNTERS
+        }
+        self.users_hourly = RollingUniques(3600, 24)
+        self.users_daily = RollingUniques(86400, 30)
+
+    def count(self, name: str, n: int = 1):
+        for ring in self.rings[name].values():
+            ring.add(n)
+
+    def seen(self, user_id: int):
+        self.users_hourly.add(user_id)
+        self.users_daily.add(user_id)
+
+    def merge(self, other: 'Activity'):
+        for name, rings in self.rings.items():
+            for size, ring in rings.items():
+                ring.merge(other.rings[name][size])
+        self.users_hourly.merge(other.users_hourly)
+        self.users_daily.merge(other.users_daily)
+
+    def to_doc(self) -> dict:
+        return {
+            'counters': {name: {size: ring.to_doc() for size, ring in rings.items()} for name, rings in self.rings.items()},
+            'users_hourly': self.users_hourly.to_doc(),
+            'users_daily': self.users_daily.to_doc(),
+        }
+
+    @classmethod
+    def from_doc(cls, doc: dict) -> 'Activity':
+        activity = cls()
+        for name, rings in (doc.get('counters') or {}).items():
+            for size, ring_doc in rings.items():
+                if name in activity.rings and size in activity.rings[name]:
+                    activity.rings[name][size].load(ring_doc)
+        activity.users_hourly.load(doc.get('users_hourly') or {})
+        activity.users_daily.load(doc.get('users_daily') or {})
+        return activity
+
+
+activity = Activity()
+
+
+def activity_doc_name() -> str:
+    return 'stats' if WORKER_SHARD is None else f'stats:{WORKER_SHARD}'
+
+
+def load_activity():
+    global activity
+    try:
+        raw = _store_read(activity_doc_name())
+        if raw is not None:
+            activity = Activity.from_doc(decode_storage(raw, activity_doc_name()))
+    except Exception as e:
+        print(f'Failed to load activity stats: {e}')
+
+
+async def save_activity():
+    async with store_lock():
+        _write_document(activity_doc_name(), activity.to_doc())
+
+
+async def activity_loop():
+    while True:
+        await asyncio.sleep(60)
+        try:
+            await save_activity()
+        except Exception as e:
+            print(f'Saving activity stats failed: {e}')
+
+
+def total_activity() -> Activity:
+    """This process's counters plus the saved ones of the other workers."""
+    total = Activity.from_doc(activity.to_doc())
+    if STORE_BACKEND == 'sqlite':
+        for (name,) in _db().execute("SELECT name FROM docs WHERE name LIKE 'stats%'").fetchall():
+            if name != activity_doc_name():
+                try:
+                    total.merge(Activity.from_doc(decode_storage(_store_read(name), name)))
+                except Exception:
+                    pass
+    return total
+
+
+def sparkline(values: list) -> str:
+    # пустой интервал — самый низкий столбик, остальные по высоте от максимума
+    top = max(values) or 1
+    return ''.join('▁▂▃▄▅▆▇█'[1 + v * 7 // (top + 1)] if v else '▁' for v in values)
+
+
+def activity_text() -> str:
+    total = total_activity()
+    rings = total.rings
+    posts_hours = rings['posts']['hour'].series()[-24:]
+    deliveries_minutes = rings['deliveries']['minute'].series()
+    updates_hour = sum(rings['updates']['minute'].series())
+    return '\n'.join([
+        '📈 Активность',
+        f'Активных пользователей: за час ≈{total.users_hourly.count(1)}, за сутки ≈{total.users_hourly.count(24)}, '
+        f'за 7 дней ≈{total.users_daily.count(7)}, за 30 дней ≈{total.users_daily.count(30)}',
+        f'Обновлений за час: {updates_hour}',
+        f'Постов: за час {sum(rings["posts"]["minute"].series())}, за сутки {sum(posts_hours)}, '
+        f'за 30 дней {sum(rings["posts"]["day"].series())}',
+        f'По часам за сутки: {sparkline(posts_hours)}',
+        f'Доставок: за минуту {deliveries_minutes[-1]}, пик за час {max(deliveries_minutes)}/мин, '
+        f'за сутки {sum(rings["deliveries"]["hour"].series()[-24:])}',
+        f'По минутам за час: {sparkline(deliveries_minutes)}',
+    ])
+
+
+@dp.update.outer_middleware()
+async def track_activity(handler, event, ctx):
+    activity.count('updates')
+    user = ctx.get('event_from_user')
+    if user is not None:
+        activity.seen(user.id)
+    return await handler(event, ctx)
+
+
+# Неудачные попытки входа хранятся рядом с сессиями: в sqlite — таблица admin_login_failures
+# (общая для воркеров), иначе data['login_failures'] (user id -> времена попыток) в core,
+# так что перезапуск или другой воркер не обнуляют счётчик.
+def _login_failures(uid: str) -> list:
+    cutoff = time.time() - ADMIN_LOGIN_WINDOW
+    if STORE_BACKEND == 'sqlite':
+        db = _db()
+        db.execute('DELETE FROM admin_login_failures WHERE user_id = ? AND ts < ?', (int(uid), cutoff))
+        return [row[0] for row in db.execute(
+            'SELECT ts FROM admin_login_failures WHERE user_id = ? ORDER BY ts', (int(uid),))]
+    failures = data.setdefault('login_failures', {})
+    recent = [t for t in failures.get(uid, []) if t >= cutoff]
+    if recent:
+        failures[uid] = recent
+    else:
+        failures.pop(uid, None)
+    return recent
+
+
+def login_blocked_for(uid: str) -> int:
+    """Seconds until this user may try the admin password again (0 — allowed now)."""
+    recent = _login_failures(uid)
+    if len(recent) < ADMIN_LOGIN_ATTEMPTS:
+        return 0
+    return int(recent[0] + ADMIN_LOGIN_WINDOW - time.time()) + 1
+
+
+def login_failed(uid: str):
+    if STORE_BACKEND == 'sqlite':
+        _db().execute('INSERT INTO admin_login_failures (user_id, ts) VALUES (?, ?)', (int(uid), time.time()))
+    else:
+        data.setdefault('login_failures', {}).setdefault(uid, []).append(time.time())
+
+
+def login_succeeded(uid: str):
+    if STORE_BACKEND == 'sqlite':
+        _db().execute('DELETE FROM admin_login_failures WHERE user_id = ?', (int(uid),))
+    else:
+        data.get('login_failures', {}).pop(uid, None)
+
+
+# digest of the last written content per document, unchanged documents are not rewritten
+_saved_digest = {}
+
+
+def _write_document(name: str, doc: dict):
+    content = encode_storage(doc, name)
+    digest = hashlib.blake2b(content, digest_size=16).digest()
+    if _saved_digest.get(name) == digest:
+        return
+    _store_write(name, content)
+    _saved_digest[name] = digest
+
+
+async def load_data():
+    global data
+    loaded = {}
+    rooms = {}
+    # с нуля начинаем только если хранилища нет; любой сбой чтения или расшифровки
+    # останавливает запуск, иначе первое же автосохранение затёрло бы данные
+    for name in _store_names():
+        try:
+            raw = _store_read(name)
+            doc = decode_storage(raw, name)
+        except Exception as e:
+            raise SystemExit(f'Failed to load {name}: {e}. Check DATA_KEY / DATA_KEY_PREVIOUS; '
+                             f'the store was left untouched.')
+        _saved_digest[name] = hashlib.blake2b(raw, digest_size=16).digest()
+        if name == 'core':
+            loaded = doc
+        elif name.startswith('room:'):
+            rooms[doc.get('id', name.split(':', 1)[1])] = doc
+    if loaded or rooms:
+        loaded['rooms'] = rooms
+        data = loaded
+    migrate_data()
+
+
+def _keep_records(old: dict, new: dict):
+    """Refresh records in place, so references taken before a refresh see the reloaded values."""
+    for key, value in new.items():
+        record = old.get(key)
+        if isinstance(record, Record) and record is not value:
+            for field in list(record.keys()):
+                del record[field]
+            record.update(value)
+            new[key] = record
+
+
+def refresh_data():
+    """Reload documents that another worker process changed since this process last read them."""
+    if STORE_BACKEND != 'sqlite':
+        return
+    remote = dict(_db().execute(
+        "SELECT name, version FROM docs WHERE name = 'core' OR name LIKE 'room:%'").fetchall())
+    for name, version in remote.items():
+        if _doc_versions.get(name) == version:
+            continue
+        raw = _store_read(name)
+        doc = decode_storage(raw, name)
+        _saved_digest[name] = hashlib.blake2b(raw, digest_size=16).digest()
+        if name == 'core':
+            hydrate_core(doc)
+            rooms = data.get('rooms', {})
+            drafts = data.get('drafts', {})
+            _keep_records(data.get('users', {}), doc['users'])
+            _keep_records(drafts, doc['drafts'])
+            data.clear()
+            data.update(doc)
+            data['rooms'] = rooms
+            if not drafts_persisted():
+                data['drafts'] = drafts
+        else:
+            hydrate_room(doc)
+            rooms = data.setdefault('rooms', {})
+            room = rooms.get(name.split(':', 1)[1])
+            if room is None:
+                rooms[name.split(':', 1)[1]] = doc
+            else:
+                # на месте: обработчик воркера мог держать ссылку на комнату через сетевой вызов;
+                # индексы, привязанные к самому объекту комнаты, строятся заново
+                room.clear()
+                room.update(doc)
+                _search_index.pop(room['id'], None)
+                _dup_windows.pop(room['id'], None)
+    for room_id in list(data.get('rooms', {})):
+        name = f'room:{room_id}'
+        if name in _doc_versions and name not in remote:
+            del data['rooms'][room_id]
+            _doc_versions.pop(name, None)
+            _saved_digest.pop(name, None)
+
+
+async def save_data(room_id: str = None):
+    """Save the core document and one room (room_id), only core (room_id='core') or every room."""
+    async with LOCK:
+        core = {k: v for k, v in data.items() if k != 'rooms' and (k != 'drafts' or drafts_persisted())}
+        _write_document('core', core)
+        rooms = data.get('rooms', {})
+        if room_id == 'core':
+            return
+        if room_id is not None:
+            if room_id in rooms:
+                _write_document(f'room:{room_id}', rooms[room_id])
+            return
+        for rid, room in rooms.items():
+            _write_document(f'room:{rid}', room)
+        # комнаты, удалённые из памяти (например, после сброса), удаляются и из хранилища
+        for name in _store_names():
+            if name.startswith('room:') and name.split(':', 1)[1] not in rooms:
+                _store_delete(name)
+                _saved_digest.pop(name, None)
+                _sealed_cache.pop(name, None)
+
+# --- снимки ---------------------------------------------------------------------
+# Снимок — манифест {документ: blake2b его сохранённого содержимого}; само содержимое лежит в
+# SNAPSHOT_DIR/blobs под этим хешем и пишется один раз, так что неизменённые комнаты
+# ничего не стоят. Восстановление перезаписывает только документы, отличающиеся от снимка.
+def _blob_path(digest: str) -> str:
+    return os.path.join(SNAPSHOT_DIR, 'blobs', digest)
+
+
+def list_snapshots() -> list:
+    """Manifests, newest first."""
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return []
+    snaps = []
+    for fn in sorted(os.listdir(SNAPSHOT_DIR), reverse=True):
+        if fn.endswith('.json'):
+            try:
+                with open(os.path.join(SNAPSHOT_DIR, fn), 'r', encoding='utf-8') as f:
+                    snaps.append(json.load(f))
+            except Exception:
+                pass
+    return snaps
+
+
+async def take_snapshot(reason: str) -> dict:
+    await save_data()
+    async with LOCK:
+        os.makedirs(os.path.join(SNAPSHOT_DIR, 'blobs'), exist_ok=True)
+        docs = {}
+        for name in _store_names():
+            digest = _saved_digest.get(name)
+            if digest is None or not os.path.exists(_blob_path(digest.hex())):
+                raw = _store_read(name)
+                if raw is None:
+                    continue
+                digest = hashlib.blake2b(raw, digest_size=16).digest()
+                if not os.path.exists(_blob_path(digest.hex())):
+                    with open(_blob_path(digest.hex()) + '.tmp', 'wb') as f:
+                        f.write(raw)
+                    os.replace(_blob_path(digest.hex()) + '.tmp', _blob_path(digest.hex()))
+            docs[name] = digest.hex()
+        snap_id = datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S-%f')
+        manifest = {'id': snap_id, 'timestamp': now_ts(), 'reason': reason, 'docs': docs}
+        with open(os.path.join(SNAPSHOT_DIR, f'{snap_id}.json'), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        _prune_snapshots()
+    audit('snapshot', reason=reason, snapshot=snap_id, docs=len(docs))
+    return manifest
+
+
+def _prune_snapshots():
+    snaps = list_snapshots()
+    for snap in snaps[SNAPSHOT_KEEP:]:
+        try:
+            os.remove(os.path.join(SNAPSHOT_DIR, f"{snap['id']}.json"))
+        except FileNotFoundError:
+            pass
+    live = {d for snap in snaps[:SNAPSHOT_KEEP] for d in snap['docs'].values()}
+    for fn in os.listdir(os.path.join(SNAPSHOT_DIR, 'blobs')):
+        if fn not in live:
+            os.remove(_blob_path(fn))
+
+
+async def restore_snapshot(snap_id: str) -> int:
+    """Bring the store and memory back to a snapshot; returns how many documents had to be rewritten."""
+    with open(os.path.join(SNAPSHOT_DIR, f'{snap_id}.json'), 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    # текущее состояние тоже сохраняется, восстановление можно отменить
+    await take_snapshot(f'before restore {snap_id}')
+    changed = 0
+    async with LOCK:
+        for name in _store_names():
+            if name not in manifest['docs']:
+                _store_delete(name)
+                _saved_digest.pop(name, None)
+                _sealed_cache.pop(name, None)
+                if name.startswith('room:'):
+                    data.get('rooms', {}).pop(name.split(':', 1)[1], None)
+                changed += 1
+        for name, digest in manifest['docs'].items():
+            if _saved_digest.get(name) == bytes.fromhex(digest):
+                continue
+            with open(_blob_path(digest), 'rb') as f:
+                raw = f.read()
+            doc = decode_storage(raw, name)
+            _store_write(name, raw)
+            _saved_digest[name] = bytes.fromhex(digest)
+            if name == 'core':
+                rooms = data.get('rooms', {})
+                drafts = data.get('drafts', {})
+                sessions = data.get('admin_sessions', {})
+                data.clear()
+                data.update(doc)
+                data['rooms'] = rooms
+                # вошедшие админы остаются вошедшими и после восстановления
+                data['admin_sessions'] = sessions
+                if not drafts_persisted():
+                    data['drafts'] = drafts
+            else:
+                data.setdefault('rooms', {})[doc.get('id', name.split(':', 1)[1])] = doc
+            changed += 1
+    migrate_data()
+    return changed
+
+
+async def snapshot_loop():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        try:
+            async with store_lock():
+                refresh_data()
+                await take_snapshot('scheduled')
+        except Exception as e:
+            print(f'Snapshot failed: {e}')
+
+
+def bench_storage(posts: int = 50000):
+    """Compare whole-file Fernet with per-record AES-GCM on a synthetic history."""
+    global ENCRYPTION_ENABLED, DATA_KEY_ENV
+    if not DATA_KEY_ENV:
+        # замер не трогает хранилище, так что хватит одноразового ключа
+        DATA_KEY_ENV = base64.b64encode(os.urandom(24)).decode('ascii')
+        print('DATA_KEY is not set; benchmarking with a throwaway key')
+    ENCRYPTION_ENABLED = True
+    doc = {
+        'users': {str(1000 + i): {'username': f'user{i}', 'last_message': now_ts(), 'msg_count': 5} for i in range(posts // 5)},
+        'drafts': {},
+        'chat': [
+            {'from_id': 1000 + i % 1000, 'username': f'user{i % 1000}', 'type': 'text',
+             'content': f'сообщение номер {i} ' * 4, 'caption': '', 'timestamp': now_ts(),
+             'delivered': {str(1000 + j): 10 * i + j for j in range(20)}}
+            for i in range(posts)
+        ],
+        'complaints': [], 'banned': [], 'accepted': [], 'enabled': True,
+    }
+    plain = json.dumps(doc, ensure_ascii=False, indent=2).encode('utf-8')
+    mb = len(plain) / 1e6
+    legacy = Fernet(base64.urlsafe_b64encode(hashlib.sha256(DATA_KEY_ENV.encode()).digest()))
+
+    def timed(fn):
+        t0 = time.perf_counter()
+        out = fn()
+        return out, time.perf_counter() - t0
+
+    blob, t_enc = timed(lambda: legacy.encrypt(plain))
+    _, t_dec = timed(lambda: json.loads(legacy.decrypt(blob)))
+    t0 = time.perf_counter()
+    compact = codec_dumps(doc)
+    print(f'codec {DATA_CODEC}: {len(compact)/1e6:.1f} MB compact vs {mb:.1f} MB indent=2, '
+          f'{(time.perf_counter() - t0)*1000:.0f} ms')
+    print(f'fernet/whole-file: {len(blob)/1e6:.1f} MB on disk, '
+          f'encrypt {mb/t_enc:.1f} MB/s, decrypt+parse {mb/t_dec:.1f} MB/s')
+
+    _sealed_cache.clear()
+    out, t_cold = timed(lambda: encode_storage(doc))
+    _, t_open = timed(lambda: decode_storage(out))
+    doc['chat'].append(dict(doc['chat'][-1], content='новое сообщение'))
+    _, t_warm = timed(lambda: encode_storage(doc))
+    print(f'aes-gcm/per-record: {len(out)/1e6:.1f} MB on disk, '
+          f'encrypt {mb/t_cold:.1f} MB/s, decrypt+parse {mb/t_open:.1f} MB/s, '
+          f'save after 1 new post {t_warm*1000:.0f} ms (vs {t_cold*1000:.0f} ms cold)')
+
+def _rss_kb() -> int:
+    with open('/proc/self/status', encoding='ascii') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def _bench_memory_child(use_records: bool, users: int, posts: int, conn):
+    import gc
+    gc.collect()
+    before = _rss_kb()
+    user_cls, msg_cls = (User, ChatMessage) if use_records else (dict, dict)
+    ts = now_ts()
+    built = {
+        'users': {str(1000 + i): user_cls({'username': f'user{i}', 'last_message': ts, 'msg_count': 5, 'room': DEFAULT_ROOM})
+                  for i in range(users)},
+        'chat': [msg_cls({'id': i + 1, 'from_id': 1000 + i % users, 'username': f'user{i % users}', 'type': 'text',
+                          'content': f'сообщение номер {i}', 'caption': '', 'timestamp': ts,
+                          'delivered': {str(1000 + j): 10 * i + j for j in range(3)}, 'src_mid': i})
+                 for i in range(posts)],
+    }
+    conn.send(_rss_kb() - before)
+    del built
+
+
+def bench_memory(users: int = 10000, posts: int = 50000):
+    """RSS growth of the in-memory users and chat as plain dicts vs slotted records (Linux)."""
+    import multiprocessing
+    ctx = multiprocessing.get_context('fork')
+    results = {}
+    for use_records in (False, True):
+        parent, child = ctx.Pipe()
+        proc = ctx.Process(target=_bench_memory_child, args=(use_records, users, posts, child))
+        proc.start()
+        results[use_records] = parent.recv()
+        proc.join()
+    print(f'{users} users + {posts} posts: dicts {results[False] / 1024:.1f} MB, '
+          f'records {results[True] / 1024:.1f} MB ({1 - results[True] / results[False]:.0%} less)')
+
+
+async def autosave_loop():
+    while True:
+        await asyncio.sleep(60)
+        await save_data('core')
+
+# --- черновики --------------------------------------------------------------------
+def drafts_persisted() -> bool:
+    # воркеры видят черновики друг друга только через хранилище
+    return DRAFTS_PERSIST or WORKER_SHARD is not None
+
+
+def put_draft(uid: str, draft: dict) -> dict:
+    """Store the user's draft as the most recent one; beyond DRAFT_LIMIT the oldest unheld drafts are dropped."""
+    draft = Draft.of(draft)
+    drafts = data.setdefault('drafts', {})
+    old = drafts.pop(uid, None)
+    if old is not None and old.get('confirm_mid'):
+        # кнопки старого черновика больше ни к чему не относятся
+        schedule_delete(int(uid), old['confirm_mid'])
+    drafts[uid] = draft
+    while len(drafts) > DRAFT_LIMIT:
+        # черновики на проверке у администратора не вытесняются: их судьбу решает он
+        victim = next((u for u, d in drafts.items() if not d.get('held')), None)
+        if victim is None:
+            break
+        expire_draft(victim)
+    return draft
+
+
+async def attach_preview(uid: str, src_mid: int, preview_mid: int):
+    """Remember the confirmation preview on the user's draft; a preview whose draft is gone is deleted."""
+    draft = data.get('drafts', {}).get(uid)
+    if draft is None or draft.get('src_mid') != src_mid:
+        # пока превью отправлялось, черновик истёк или его заменил новый
+        schedule_delete(int(uid), preview_mid)
+        return
+    draft['confirm_mid'] = preview_mid
+    await save_data('core')
+
+
+def expire_draft(uid: str):
+    draft = data.get('drafts', {}).pop(uid, None)
+    if draft is not None and draft.get('confirm_mid'):
+        schedule_delete(int(uid), draft['confirm_mid'])
+    return draft
+
+
+def expire_drafts() -> list:
+    """Drop drafts older than DRAFT_TTL and held ones waiting longer than HELD_DRAFT_TTL.
+
+    Returns [(uid, held)] for the dropped drafts.
+    """
+    now = datetime.now(timezone.utc)
+    stale = []
+    for uid, draft in data.get('drafts', {}).items():
+        held = draft.get('held')
+        ttl = HELD_DRAFT_TTL if held else DRAFT_TTL
+        try:
+            # срок проверки считается с момента, когда черновик ушёл администратору
+            since = held if isinstance(held, str) else draft['timestamp']
+            if datetime.fromisoformat(since) < now - timedelta(seconds=ttl):
+                stale.append((uid, bool(held)))
+        except Exception:
+            stale.append((uid, bool(held)))
+    for uid, _ in stale:
+        expire_draft(uid)
+    return stale
+
+
+def held_drafts() -> list:
+    """Drafts waiting for an admin's decision: [(uid, draft)]."""
+    return [(uid, d) for uid, d in data.get('drafts', {}).items() if d.get('held')]
+
+
+async def draft_expiry_loop():
+    while True:
+        await asyncio.sleep(min(60, DRAFT_TTL))
+        try:
+            async with store_lock():
+                refresh_data()
+                stale = expire_drafts()
+                if stale and drafts_persisted():
+                    await save_data('core')
+        except Exception as e:
+            print(f'Draft expiry failed: {e}')
+            continue
+        for uid, held in stale:
+            if not held:
+                continue
+            try:
+                await bot.send_message(int(uid), 'Администратор не успел рассмотреть ваше сообщение, оно снято с проверки. Отправьте его заново, если нужно.')
+            except Exception:
+                pass
+
 
-LOCK = asyncio.Lock()
+def _user_display_name(user: types.User) -> str:
+    return f"@{user.username}" if user.username else user.full_name
 
-# runtime admin sessions (anonymous admins who logged in with password)
-admin_sessions = set()
 
-# data structure persisted to JSON
-data = {
-    'users': {},       # key: str(user_id) -> {username, last_message, msg_count}
-    'drafts': {},      # key: str(user_id) -> {type, content, timestamp}
-    'chat': [],        # list of {from_id, username, type, content, timestamp}
-    'complaints': [],  # list of {from, text, timestamp}
-    'banned': [],      # list of ints
-    'accepted': [],    # list of ints
-    'enabled': True,
-}
+# --- журнал ---------------------------------------------------------------------
+# События пишутся через очередь: обработчики только кладут запись в SimpleQueue, а файл
+# (JSON по строке на событие, с ротацией по размеру) и консоль пишет отдельный поток.
+audit_logger = logging.getLogger('bot.audit')
+audit_logger.setLevel(logging.INFO)
+audit_logger.propagate = False
+_audit_queue = queue.SimpleQueue()
+audit_logger.addHandler(logging.handlers.QueueHandler(_audit_queue))
+_audit_listener = None
 
 
-def now_ts():
-    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+class AuditJsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+                 'event': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, ensure_ascii=False, default=str)
 
 
-async def load_data():
-    global data
-    if os.path.exists(DATA_FILE):
-        try:
-            with open(DATA_FILE, 'rb') as f:
-                file_content = f.read()
-                if ENCRYPTION_ENABLED:
-                    decrypted = cipher.decrypt(file_content)
-                    data = json.loads(decrypted.decode('utf-8'))
-                else:
-                    data = json.loads(file_content.decode('utf-8'))
-        except Exception as e:
-            print(f'Failed to load data.json: {e}; starting fresh')
+class AuditConsoleFormatter(logging.Formatter):
+    def format(self, record):
+        fields = getattr(record, 'fields', {})
+        ts = datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='seconds')
+        return f"[{record.getMessage().upper()}] {ts} | " + ' | '.join(f'{k}={v}' for k, v in fields.items())
 
 
-async def save_data():
-    async with LOCK:
-        json_content = json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
-        if ENCRYPTION_ENABLED:
-            json_content = cipher.encrypt(json_content)
-        with open(DATA_FILE, 'wb') as f:
-            f.write(json_content)
+def start_audit_log():
+    global _audit_listener
+    if _audit_listener is not None:
+        return
+    path = AUDIT_LOG
+    if WORKER_SHARD is not None:
+        # у каждого воркера свой файл: ротация одного файла из нескольких процессов небезопасна
+        root, ext = os.path.splitext(AUDIT_LOG)
+        path = f'{root}.w{WORKER_SHARD}{ext}'
+    file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=AUDIT_LOG_MAX_BYTES,
+                                                        backupCount=AUDIT_LOG_BACKUPS, encoding='utf-8')
+    file_handler.setFormatter(AuditJsonFormatter())
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(AuditConsoleFormatter())
+    _audit_listener = logging.handlers.QueueListener(_audit_queue, file_handler, console_handler)
+    _audit_listener.start()
 
 
-async def autosave_loop():
-    while True:
-        await asyncio.sleep(60)
-        await save_data()
+def stop_audit_log():
+    global _audit_listener
+    if _audit_listener is not None:
+        _audit_listener.stop()
+        _audit_listener = None
 
 
-def _user_display_name(user: types.User) -> str:
-    return f"@{user.username}" if user.username else user.full_name
+def audit(event: str, actor=None, **fields):
+    """Record an event; actor is a types.User or a user id."""
+    if isinstance(actor, types.User):
+        fields = {'actor': actor.id, 'actor_name': _user_display_name(actor), **fields}
+    elif actor is not None:
+        fields = {'actor': int(actor), **fields}
+    audit_logger.info(event, extra={'fields': fields})
 
 
-def log_msg(msg_type: str, user: types.User, content: str):
-    ts = now_ts()
-    name = _user_display_name(user)
-    kind = {'text': 'Текст', 'photo': 'Фото', 'video': 'Видео'}.get(msg_type, msg_type)
-    print(f"[MSG] {ts} | {name} ({user.id}) | {kind} | {content}")
+def log_msg(msg_type: str, user: types.User, content: str, stage: str = 'draft'):
+    fields = {'type': msg_type, 'stage': stage}
+    if AUDIT_LOG_CONTENT:
+        fields['content'] = content
+    audit('message', user, **fields)
 
 
 async def shutdown():
@@ -120,12 +2325,15 @@ async def shutdown():
     print('Shutdown initiated...')
     try:
         await save_data()
+        await save_activity()
     except Exception:
         pass
     try:
         await bot.close()
     except Exception:
         pass
+    # журнал закрывается последним: сохранение и закрытие сессии тоже пишут в него
+    stop_audit_log()
     print('Shutdown complete.')
     os._exit(0)
 
@@ -150,12 +2358,14 @@ terms_kb = InlineKeyboardMarkup(inline_keyboard=[
 
 user_kb = ReplyKeyboardMarkup(keyboard=[
     [KeyboardButton(text='⚠️ Пожаловаться'), KeyboardButton(text='ℹ️ Меню')],
+    [KeyboardButton(text='🚪 Комнаты'), KeyboardButton(text='🔔 Доставка')],
+    [KeyboardButton(text='📜 Недавнее')],
 ], resize_keyboard=True)
 
 admin_kb = ReplyKeyboardMarkup(
     keyboard=[
         [KeyboardButton(text='Включить/Выключить бота')],
-        [KeyboardButton(text='Статистика')],
+        [KeyboardButton(text='Статистика'), KeyboardButton(text='Активность')],
         [KeyboardButton(text='Пользователи')],
         [KeyboardButton(text='Остановить бота')],
         [KeyboardButton(text='История чата')],
@@ -164,187 +2374,1141 @@ admin_kb = ReplyKeyboardMarkup(
         [KeyboardButton(text='Очистка чата')],
             [KeyboardButton(text='Стереть историю'), KeyboardButton(text='Удалить все сообщения')],
             [KeyboardButton(text='Сброс данных')],
-        [KeyboardButton(text='Просмотр жалоб')],
+        [KeyboardButton(text='Просмотр жалоб'), KeyboardButton(text='На проверке')],
+        [KeyboardButton(text='Комнаты')],
+        [KeyboardButton(text='Поиск'), KeyboardButton(text='Снимки')],
         [KeyboardButton(text='Выход')],
     ],
     resize_keyboard=True,
 )
 
-# list of admin button texts (used to avoid treating them as user content)
-ADMIN_BUTTON_TEXTS = {
-    'Включить/Выключить бота', 'Статистика', 'Пользователи', 'Остановить бота',
-    'История чата', 'Бан/Разбан', 'Рассылка', 'Очистка чата', 'Стереть историю', 'Удалить все сообщения', 'Просмотр жалоб', 'Выход', 'Сброс данных'
-}
+# list of admin button texts (used to avoid treating them as user content)
+ADMIN_BUTTON_TEXTS = {
+    'Включить/Выключить бота', 'Статистика', 'Пользователи', 'Остановить бота',
+    'История чата', 'Бан/Разбан', 'Рассылка', 'Очистка чата', 'Стереть историю', 'Удалить все сообщения', 'Просмотр жалоб', 'Выход', 'Сброс данных',
+    'Комнаты', 'Снимки', 'Поиск', 'Активность', 'На проверке'
+}
+
+
+def rooms_kb(for_admin: bool) -> InlineKeyboardMarkup:
+    rows = []
+    for room_id, room in data.get('rooms', {}).items():
+        label = f"{room.get('title', room_id)} ({len(room.get('members', []))})"
+        row = [InlineKeyboardButton(text=label, callback_data=f'join_room_{room_id}')]
+        if for_admin:
+            state = '🟢' if room.get('settings', {}).get('enabled', True) else '🔴'
+            row.append(InlineKeyboardButton(text=state, callback_data=f'toggle_room_{room_id}'))
+        rows.append(row)
+    if for_admin:
+        rows.append([InlineKeyboardButton(text='➕ Создать комнату', callback_data='create_room')])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def message_confirm_kb() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text='✅ Отправить', callback_data='confirm_send')],
+        [InlineKeyboardButton(text='❌ Отменить', callback_data='cancel_send')],
+    ])
+
+
+def complaint_kb_for(room_id: str, msg_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text='⚠️ Пожаловаться', callback_data=f'complaint_{room_id}_{msg_id}')]
+    ])
+
+
+def delivery_title(minutes: int) -> str:
+    if not minutes:
+        return 'сразу'
+    return 'раз в час' if minutes == 60 else f'раз в {minutes} мин'
+
+
+def delivery_kb(current: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=('✅ ' if minutes == current else '') + delivery_title(minutes).capitalize(),
+                              callback_data=f'delivery_{minutes}')]
+        for minutes in (0,) + DIGEST_INTERVALS
+    ])
+
+
+def complaint_actions_kb(room_id: str, cid) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text='✉️ Ответить', callback_data=f'reply_complaint_{room_id}_{cid}'),
+            InlineKeyboardButton(text='🗑️ Удалить сообщение', callback_data=f'delete_msg_{room_id}_{cid}'),
+        ],
+        [
+            InlineKeyboardButton(text='⚠️ Удалить жалобу', callback_data=f'del_complaint_{room_id}_{cid}'),
+            InlineKeyboardButton(text='⏭️ Пропустить', callback_data=f'skip_complaint_{room_id}_{cid}'),
+        ],
+    ])
+
+
+def complaints_page(room: dict, status: str, page: int) -> tuple[str, InlineKeyboardMarkup]:
+    """One page of the complaint queue: a line per complaint, buttons to open them, paging and status filter."""
+    ids = complaint_ids(room, status)
+    pages = max(1, (len(ids) + COMPLAINTS_PAGE - 1) // COMPLAINTS_PAGE)
+    page = min(max(page, 0), pages - 1)
+    room_id = room['id']
+    lines = [f'Жалобы — {COMPLAINT_STATUS_TITLES[status].lower()} ({len(ids)}), стр. {page + 1}/{pages}:']
+    rows = []
+    for cid in ids[page * COMPLAINTS_PAGE:(page + 1) * COMPLAINTS_PAGE]:
+        comp = room['complaints'][cid]
+        count = len(complaint_reporters(comp))
+        reason = (comp['reports'][-1].get('text') or '')[:40] if comp.get('reports') else ''
+        where = f'сообщение #{comp["target"]}' if comp.get('target') is not None else 'общая'
+        lines.append(f'#{cid} · {where} · {count} чел. · {reason}')
+        rows.append([InlineKeyboardButton(text=f'#{cid} ({count})', callback_data=f'open_complaint_{room_id}_{cid}')])
+    if not ids:
+        lines.append('Пусто.')
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text='◀️', callback_data=f'complaints_page_{room_id}_{status}_{page - 1}'))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton(text='▶️', callback_data=f'complaints_page_{room_id}_{status}_{page + 1}'))
+    if nav:
+        rows.append(nav)
+    rows.append([
+        InlineKeyboardButton(text=('• ' if s == status else '') + COMPLAINT_STATUS_TITLES[s],
+                             callback_data=f'complaints_page_{room_id}_{s}_0')
+        for s in COMPLAINT_STATUSES
+    ])
+    return '\n'.join(lines), InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def complaint_card_text(room: dict, comp: dict) -> str:
+    status = COMPLAINT_STATUS_NAMES.get(comp.get('status'), comp.get('status'))
+    lines = [f'Жалоба #{comp["id"]} ({status}), жалующихся: {len(complaint_reporters(comp))}']
+    target = comp.get('target')
+    tmsg = find_chat(room, target) if target is not None else None
+    if tmsg is not None:
+        t_uname = tmsg.get('username') or f'ID {tmsg.get("from_id")}'
+        lines.append(f'На сообщение #{target} от @{t_uname}:')
+        if tmsg.get('type') == 'text':
+            lines.append(tmsg.get('content') or '')
+        elif tmsg.get('type') == 'album':
+            lines.append(f'(альбом, {len(tmsg["content"])} шт.)')
+    elif target is not None:
+        lines.append(f'На сообщение #{target} (уже удалено)')
+    lines.append('Причины:')
+    for r in comp.get('reports', [])[-10:]:
+        who = f'@{r["from_username"]}' if r.get('from_username') else f'ID {r.get("from")}'
+        lines.append(f'• {who}: {r.get("text")}')
+    return '\n'.join(lines)
+
+def search_page(room: dict, query_text: str, page: int) -> tuple[str, InlineKeyboardMarkup]:
+    """One page of search results with per-result moderation buttons."""
+    posts = search_posts(room, parse_search_query(query_text))
+    pages = max(1, (len(posts) + SEARCH_PAGE - 1) // SEARCH_PAGE)
+    page = min(max(page, 0), pages - 1)
+    room_id = room['id']
+    lines = [f'Поиск «{query_text}»: найдено {len(posts)}, стр. {page + 1}/{pages}']
+    rows = []
+    for msg in posts[page * SEARCH_PAGE:(page + 1) * SEARCH_PAGE]:
+        uname = f"@{msg['username']}" if msg.get('username') else f"ID {msg.get('from_id')}"
+        body = msg.get('content') if msg['type'] == 'text' else f"[{msg['type']}] {msg.get('caption') or ''}"
+        lines.append(f"\n#{msg['id']} {uname}, {msg['timestamp'][:16].replace('T', ' ')}:\n{(body or '')[:200]}")
+        rows.append([
+            InlineKeyboardButton(text=f"🗑️ #{msg['id']} у всех", callback_data=f"srch_del_{room_id}_{msg['id']}"),
+            InlineKeyboardButton(text=f'🚫 {uname}', callback_data=f"srch_ban_{room_id}_{msg.get('from_id')}"),
+        ])
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text='◀️', callback_data=f'search_page_{page - 1}'))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton(text='▶️', callback_data=f'search_page_{page + 1}'))
+    if nav:
+        rows.append(nav)
+    return '\n'.join(lines)[:4096], InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+@dp.message(Command('start'))
+async def cmd_start(message: types.Message):
+    uid = str(message.from_user.id)
+    if uid not in data['users']:
+        data['users'][uid] = User(username=message.from_user.username, last_message=None)
+    terms = (
+    'Условия пользования:\n'
+    '- Все сообщения и материалы публикуются пользователями под их личную ответственность.\n'
+    '- Публикация фото и медиа с изображением других лиц возможна, но ответственность за публикацию лежит на пользователе.\n'
+    '- При первой жалобе на материалы с изображением третьих лиц они будут удалены без обсуждения.\n'
+    '- Администрация не поощряет публикацию материалов без согласия изображённых лиц.\n'
+    '- Запрещено распространять материалы из этого бота за его пределы; ответственность лежит на пользователе.\n'
+    '- Администрация не несёт ответственности за пользовательский контент, шутки, подколы или последствия общения.\n'
+    '- Администраторы действуют в рамках закона и вправе ограничить доступ к боту.\n'
+    '- Администраторы не связаны с учебным заведением и не представляют его интересы.\n'
+    '- Использование бота означает согласие с правилами и осознание возможных рисков.\n'
+    '- Незнание условий не снимает с вас ответственности.\n'
+    'Нажмите ✅ Принять для продолжения или \n ❌ Не согласен для отказа.'
+)
+                 
+    await message.answer(terms, reply_markup=terms_kb)
+
+
+@dp.callback_query(lambda c: c.data == 'accept_terms')
+async def cb_accept(cb: types.CallbackQuery):
+    uid_int = int(cb.from_user.id)
+    uid = str(uid_int)
+    room = user_room(uid)
+    if uid_int in room.get('banned', []):
+        await cb.message.answer('Вы забанены и не можете пользоваться ботом.')
+        await cb.answer()
+        return
+    if uid_int not in data.get('accepted', []):
+        data.setdefault('accepted', []).append(uid_int)
+    join_room(uid, room['id'])
+    await save_data(room['id'])
+    
+    # Сообщение подтверждения
+    confirmation = (
+        '✅ Вы приняли условия пользования!\n\n'
+        'Теперь вы можете писать сообщения в анонимный чат. 🎉\n'
+    )
+    await cb.message.answer(confirmation)
+    
+    # Отправляем меню сразу
+    help_text = (
+        '📋 МЕНЮ И СПРАВКА:\n\n'
+        '👤 ОТПРАВКА СООБЩЕНИЙ:\n'
+        '- Отправьте текст, фото, видео или альбом\n'
+        '- Появится превью и кнопка подтверждения\n'
+        '- После подтверждения сообщение станет анонимным\n'
+        '- Лимит: 1 сообщение на 30 секунд (антиспам)\n\n'
+        '⚠️ ЖАЛОБЫ:\n'
+        '- Нажмите "⚠️ Пожаловаться" под сообщением\n'
+        '- Или используйте кнопку "⚠️ Пожаловаться"\n'
+        '- На альбом — ответьте на него кнопкой "⚠️ Пожаловаться"\n\n'
+        '🚪 КОМНАТЫ:\n'
+        '- "🚪 Комнаты" или /rooms — выбрать другой анонимный чат\n\n'
+        '⚠️ ПРАВИЛА:\n'
+        '- Мы не поддерживаем публикацию материалов без согласия изображённых лиц (фото/видео).\n'
+        '- Такие материалы могут быть удалены по просьбе через жалобу с объяснением причины.\n'
+        '- Можете выражать себя как хотите — мат, шутки, подколы допускаются.\n'
+        '- Мы ценим дружелюбное отношение к пользователям и стараемся поддерживать безопасную атмосферу.\n\n'
+        '💬 КОМАНДЫ:\n'
+        '- "ℹ️ Меню" — показать эту справку\n'
+        '- "/start" — начать заново\n\n'
+        '🕊️ Команда FreeBird всегда к вашим услугам!'
+    )
+    await cb.message.answer(help_text, reply_markup=user_kb)
+    await cb.answer()
+    if CATCHUP_ON_JOIN and CATCHUP_POSTS:
+        asyncio.create_task(catch_up(uid, room['id']))
+
+
+@dp.callback_query(lambda c: c.data == 'decline_terms')
+async def cb_decline(cb: types.CallbackQuery):
+    await cb.message.answer('Вы отказались от условий. Для использования бота нужно принять условия (/start).')
+    await cb.answer()
+
+
+def render_body(msg: dict, is_admin: bool) -> str:
+    """Text of a text post or caption of a media post as a recipient sees it."""
+    # Для админа показать подписанное сообщение, для остальных - анонимное
+    header = ''
+    if is_admin:
+        sender_name = msg.get('username') if msg.get('username') else f'ID {msg["from_id"]}'
+        header = f"📤 От: {sender_name} ({msg['from_id']})\n\n"
+    if msg['type'] == 'text':
+        return header + msg["content"] + f'\n\n{FOOTER}'
+    caption = msg.get('caption') or ''
+    caption = header + caption if header else caption
+    return f"{caption}\n\n{FOOTER}" if caption else FOOTER
+
+
+class SendController:
+    """AIMD limit on how many fan-out sends run at once.
+
+    After `limit` successful sends with latency under SEND_LATENCY_TARGET the limit grows
+    by one; a 429 or a server/network error halves it, once per round of sends started
+    under the old limit. A 429 also pauses every fan-out for its retry_after.
+    """
+
+    def __init__(self, start: int, low: int, high: int):
+        self.low = low
+        self.high = high
+        self.limit = float(min(high, max(low, start)))
+        self.in_flight = 0
+        self.peak = 0
+        self.epoch = 0
+        self.credit = 0
+        self.latency = None  # EWMA, seconds
+        self.resume_at = 0.0
+        self.waiters = deque()
+        self.counts = dict.fromkeys(('sent', 'throttled', 'failed', 'rejected', 'retried', 'dropped', 'paused'), 0)
+        self.runs = deque(maxlen=3)  # summaries of the latest fan-outs
+
+    async def acquire(self) -> tuple:
+        while True:
+            pause = self.resume_at - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            elif self.in_flight < int(self.limit):
+                break
+            else:
+                fut = asyncio.get_running_loop().create_future()
+                self.waiters.append(fut)
+                await fut
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        return self.epoch, time.monotonic()
+
+    def release(self, token: tuple, outcome: str, retry_after: float = 0):
+        """outcome: sent, throttled (429), failed (5xx/network), rejected (the API refused this one send)
+        or paused (not sent: the circuit breaker is open)."""
+        epoch, started = token
+        self.in_flight -= 1
+        self.counts[outcome] += 1
+        if outcome == 'sent':
+            took = time.monotonic() - started
+            self.latency = took if self.latency is None else 0.8 * self.latency + 0.2 * took
+            if self.latency < SEND_LATENCY_TARGET:
+                self.credit += 1
+                if self.credit >= self.limit:
+                    self.credit = 0
+                    self.limit = min(self.high, self.limit + 1)
+        elif outcome in ('throttled', 'failed'):
+            if outcome == 'throttled':
+                self.resume_at = max(self.resume_at, time.monotonic() + retry_after)
+            # отправки, начатые до прошлого снижения, его уже учли
+            if epoch == self.epoch:
+                self.epoch += 1
+                self.credit = 0
+                self.limit = max(self.low, self.limit / 2)
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self.waiters:
+            fut = self.waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                free -= 1
+
+    def stats_text(self) -> str:
+        latency = f'{self.latency * 1000:.0f} мс' if self.latency is not None else '—'
+        c = self.counts
+        lines = [f'Параллельность рассылки: {int(self.limit)} (от {self.low} до {self.high}), сейчас {self.in_flight}, '
+                 f'пик {self.peak}, задержка {latency}; 429: {c["throttled"]}, сбоев: {c["failed"]}, '
+                 f'повторов: {c["retried"]}, отказов API: {c["rejected"]}, не доставлено: {c["dropped"]}, '
+                 f'ожиданий предохранителя: {c["paused"]}']
+        for run in self.runs:
+            lines.append(f'  {run["lane"]}: {run["sent"]}/{run["total"]} за {run["seconds"]:.1f} с '
+                         f'({run["rate"]:.1f}/с, лимит {run["limit"]}), повторов {run["retried"]}')
+        return '\n'.join(lines)
+
+
+send_controller = SendController(SEND_CONCURRENCY, SEND_CONCURRENCY_MIN, SEND_CONCURRENCY_MAX)
+
+
+def request_not_sent(error: Exception) -> bool:
+    """The call failed before the request reached Telegram (connection refused, DNS), so repeating it is safe."""
+    return isinstance(error, TelegramNetworkError) and isinstance(error.__cause__, ClientConnectorError)
+
+
+async def fan_out(recipients, send_one, concurrency: int = None, lane: str = 'broadcast',
+                  repeatable: bool = False) -> dict:
+    """Run send_one(recipient) for every recipient; returns {total, sent, retried, dropped, ...}.
+
+    How many run at once is decided by send_controller (and never more than `concurrency`).
+    A recipient hit by flood control, or by an error raised before the request went out,
+    goes back to the queue up to SEND_RETRIES times. A timeout or a 5xx may come after
+    Telegram already delivered the message, so it is repeated only for `repeatable` work
+    (edits, deletes); new sends are dropped instead of risking a duplicate. While the
+    circuit breaker is open the recipient waits for it without spending an attempt.
+    The overall request rate is capped by the session's RateLimitMiddleware; the calls
+    go to its `lane` as one flow. Called from a worker's update handler, the store is
+    released for the whole run.
+    """
+    sem = asyncio.Semaphore(concurrency) if concurrency else None
+    flow = next(_flow_ids)
+    recipients = list(recipients)
+    summary = {'lane': lane, 'total': len(recipients), 'sent': 0, 'retried': 0, 'dropped': 0}
+    started = time.monotonic()
+
+    async def attempt(recipient):
+        if sem is None:
+            await send_one(recipient)
+        else:
+            async with sem:
+                await send_one(recipient)
+
+    async def run(recipient):
+        send_lane.set(lane)
+        send_flow.set(flow)
+        tries = 0
+        while tries <= SEND_RETRIES:
+            token = await send_controller.acquire()
+            try:
+                await attempt(recipient)
+            except CircuitOpenError:
+                # запрос не ушёл: ждём конца паузы предохранителя (или его пробного вызова)
+                send_controller.release(token, 'paused')
+                await asyncio.sleep(max(1.0, circuit_breaker.opened_until - time.monotonic()))
+                continue
+            except TelegramRetryAfter as e:
+                send_controller.release(token, 'throttled', e.retry_after)
+            except (TelegramServerError, TelegramNetworkError) as e:
+                send_controller.release(token, 'failed')
+                if not (repeatable or request_not_sent(e)):
+                    # таймаут или 5xx: сообщение могло уже дойти, повтор дал бы дубликат
+                    break
+                # повтор — в конец очереди, после короткой паузы
+                await asyncio.sleep(2 ** tries)
+            except Exception:
+                # пользователь заблокировал бота, сообщение уже удалено и т. п. — повтор не поможет
+                send_controller.release(token, 'rejected')
+                summary['dropped'] += 1
+                return
+            else:
+                send_controller.release(token, 'sent')
+                summary['sent'] += 1
+                return
+            tries += 1
+            if tries <= SEND_RETRIES:
+                summary['retried'] += 1
+                send_controller.counts['retried'] += 1
+        summary['dropped'] += 1
+        send_controller.counts['dropped'] += 1
+
+    held = store_tx.get()
+    if held is not None and held[1] is asyncio.current_task():
+        # воркер: отправки идут в дочерних задачах, поэтому хранилище отпускается один раз на всю рассылку
+        await held[0].suspend()
+        try:
+            await asyncio.gather(*(run(r) for r in recipients))
+        finally:
+            await held[0].resume()
+    else:
+        await asyncio.gather(*(run(r) for r in recipients))
+    seconds = time.monotonic() - started
+    summary.update(seconds=seconds, rate=summary['sent'] / seconds if seconds else 0.0, limit=int(send_controller.limit))
+    if summary['total'] > 1:
+        send_controller.runs.append(summary)
+    return summary
+
+
+def reply_copy_id(target: dict, recipient: str):
+    """Id of the recipient's copy of target to reply to, or None if they have none."""
+    # у получателя дайджестов цель может быть внутри текстового дайджеста
+    ids = delivered_ids(target.get('delivered', {}).get(recipient) or (target.get('digest') or {}).get(recipient))
+    return ids[0] if ids else None
+
+
+async def send_post(chat_id: int, msg: dict, variant: tuple, reply_to_id: int = None):
+    """Send one copy of a chat entry; returns its delivered value (message id, or ids for an album)."""
+    body, markup, media = variant
+    if msg['type'] == 'album':
+        # весь альбом одним send_media_group; у альбома не бывает inline-кнопок,
+        # пожаловаться можно ответом на него кнопкой "⚠️ Пожаловаться"
+        try:
+            sent = await bot.send_media_group(chat_id, media, reply_to_message_id=reply_to_id)
+        except TelegramBadRequest:
+            sent = await bot.send_media_group(chat_id, media)
+        return [m.message_id for m in sent]
+    if msg['type'] == 'text':
+        send, args, kw = bot.send_message, (chat_id, body), {}
+    else:
+        send = bot.send_photo if msg['type'] == 'photo' else bot.send_video
+        args, kw = (chat_id, msg['content']), {'caption': body}
+    try:
+        sent = await send(*args, reply_markup=markup, reply_to_message_id=reply_to_id, **kw)
+    except TelegramBadRequest:
+        # Если reply_to_message_id не существует, отправить без ответа
+        sent = await send(*args, reply_markup=markup, **kw)
+    return sent.message_id
+
+
+def post_variants(room: dict, msg: dict) -> dict:
+    """is_admin -> (body, reply markup, album media or None) for a chat entry."""
+    complaint_kb = complaint_kb_for(room['id'], msg['id'])
+    variants = {}
+    for is_admin in (False, True):
+        body = render_body(msg, is_admin)
+        media = album_media(msg['content'], body) if msg['type'] == 'album' else None
+        variants[is_admin] = (body, None if is_admin else complaint_kb, media)
+    return variants
+
+
+async def broadcast_entry(room: dict, msg: dict, recipients: list = None, digest: bool = True):
+    """Send a chat entry to every member of its room (or to recipients) and record delivered message ids.
+
+    Recipients who take digests get it queued instead (digest=False: the caller already queued it).
+    """
+    recipients = list(room.get('members', []) if recipients is None else recipients)
+    if digest:
+        recipients = queue_digest(room, msg, recipients)
+    # Если это ответ на сообщение в чате, message_id целевого сообщения берётся у каждого получателя
+    reply_target = find_chat(room, msg['reply_target_id']) if msg.get('reply_target_id') is not None else None
+    # админы видят автора, остальные — анонимный текст с кнопкой жалобы; оба варианта готовятся один раз
+    admins = set(admin_sessions)
+    variants = post_variants(room, msg)
+
+    async def send_one(user_id_int):
+        reply_to_id = reply_copy_id(reply_target, str(user_id_int)) if reply_target is not None else None
+        variant = variants[user_id_int in admins]
+        msg['delivered'][str(user_id_int)] = await send_post(user_id_int, msg, variant, reply_to_id)
+        activity.count('deliveries')
+
+    await fan_out(recipients, send_one)
+
+
+async def propagate_edit(room: dict, msg: dict):
+    """Apply the current content of a chat entry to every delivered copy."""
+    admins = set(admin_sessions)
+    variants = post_variants(room, msg)
+
+    async def edit_one(recip_str):
+        value = msg.get('delivered', {}).get(recip_str)
+        ids = delivered_ids(value)
+        if not ids:
+            return
+        user_id_int = int(recip_str)
+        body, markup, _ = variants[user_id_int in admins]
+        if isinstance(value, list):
+            # фото или видео, пришедшее в альбоме дайджеста: у таких сообщений нет кнопок
+            markup = None
+        if msg['type'] == 'text':
+            await bot.edit_message_text(text=body, chat_id=user_id_int, message_id=ids[0], reply_markup=markup)
+        elif msg['type'] in ('photo', 'video'):
+            # editMessageMedia меняет и файл (если его заменили), и подпись за один вызов
+            media_cls = InputMediaPhoto if msg['type'] == 'photo' else InputMediaVideo
+            await bot.edit_message_media(media=media_cls(media=msg['content'], caption=body), chat_id=user_id_int,
+                                         message_id=ids[0], reply_markup=markup)
+        elif msg['type'] == 'album':
+            await bot.edit_message_caption(chat_id=user_id_int, message_id=ids[0], caption=body)
+
+    await fan_out(list(msg.get('delivered', {})), edit_one, repeatable=True)
+    # текстовые дайджесты с этим постом перерисовываются целиком
+    await refresh_digests(((int(r), mid) for r, mid in (msg.get('digest') or {}).items()), lane='broadcast')
+
+
+# (room_id, msg_id) -> monotonic time of the latest edit not yet propagated
+_edit_pending = {}
+_edit_tasks = {}
+
+
+def schedule_edit(room_id: str, msg_id: int):
+    """Propagate an edit after EDIT_COALESCE_DELAY of quiet; a burst of edits results in one pass."""
+    key = (room_id, msg_id)
+    _edit_pending[key] = time.monotonic()
+    if key not in _edit_tasks:
+        _edit_tasks[key] = asyncio.create_task(_edit_worker(key))
+
+
+async def _edit_worker(key):
+    try:
+        while key in _edit_pending:
+            wait = _edit_pending[key] + EDIT_COALESCE_DELAY - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            _edit_pending.pop(key, None)
+            room = data.get('rooms', {}).get(key[0])
+            msg = find_chat(room, key[1]) if room is not None else None
+            if msg is None:
+                return
+            await propagate_edit(room, msg)
+    finally:
+        _edit_tasks.pop(key, None)
+
+
+# --- дайджесты -------------------------------------------------------------------
+# Пользователь с delivery = N минут получает посты комнаты не по одному, а раз в N минут:
+# тексты — одним сообщением с кнопкой жалобы на каждый пост, фото и видео — альбомами.
+# Очередь лежит в room['digest'] и сохраняется вместе с комнатой. Копии в альбомах
+# записываются в delivered как обычно (списком id); текстовый дайджест — в msg['digest'],
+# а его состав — в user['digests'], чтобы ответы, жалобы, правки и удаления находили пост.
+digest_stats = {'digests': 0, 'posts': 0, 'calls': 0}
+
+
+def delivery_interval(uid) -> int:
+    """Minutes between a user's digests; 0 — every post right away."""
+    return data.get('users', {}).get(str(uid), {}).get('delivery') or 0
+
+
+def queue_digest(room: dict, msg: dict, recipients: list) -> list:
+    """Queue msg for recipients who take digests; return the ones to deliver right away."""
+    # админы и автор поста получают его сразу
+    admins = set(admin_sessions)
+    pending = room.setdefault('digest', {})
+    instant = []
+    for uid in recipients:
+        if uid in admins or uid == msg.get('from_id') or not delivery_interval(uid):
+            instant.append(uid)
+            continue
+        pending.setdefault(str(uid), {'since': time.time(), 'ids': []})['ids'].append(msg['id'])
+    return instant
+
+
+def take_due_digests(force_uid: str = None) -> list:
+    """Mark queues whose window has passed as being sent: [(room, uid, posts, queued ids)].
+
+    The ids stay queued until unqueue_digest() records the delivery, so a failed or
+    interrupted send is retried on a later tick instead of losing the posts.
+    """
+    now = time.time()
+    due = []
+    for room in data.get('rooms', {}).values():
+        pending = room.get('digest') or {}
+        for uid, entry in list(pending.items()):
+            minutes = delivery_interval(uid)
+            if uid != force_uid and minutes and now < entry['since'] + minutes * 60:
+                continue
+            if now - entry.get('sending', 0) < DIGEST_SEND_TIMEOUT:
+                continue
+            ids = list(entry['ids'])
+            posts = [m for m in (find_chat(room, i) for i in ids) if m is not None]
+            if not posts:
+                del pending[uid]
+                continue
+            entry['sending'] = now
+            due.append((room, uid, posts, ids))
+    return due
+
+
+def unqueue_digest(room_id: str, uid: str, taken: list, done: set):
+    """Drop delivered (or no longer deliverable) ids from uid's queue and release it for the next tick."""
+    room = data.get('rooms', {}).get(room_id)
+    entry = ((room or {}).get('digest') or {}).get(uid)
+    if entry is None:
+        return
+    entry['ids'] = [i for i in entry['ids'] if i not in done]
+    entry.pop('sending', None)
+    if not entry['ids']:
+        del room['digest'][uid]
+    elif done.issuperset(taken):
+        # всё взятое ушло, остались посты, пришедшие во время отправки: их окно считается отсюда
+        entry['since'] = time.time()
+
+
+def digest_text(room: dict, posts: list) -> tuple[str, InlineKeyboardMarkup]:
+    body = '\n\n'.join(f'{n}. {m["content"]}' for n, m in enumerate(posts, 1))
+    buttons = [InlineKeyboardButton(text=f'⚠️ {n}', callback_data=f'complaint_{room["id"]}_{m["id"]}')
+               for n, m in enumerate(posts, 1)]
+    kb = InlineKeyboardMarkup(inline_keyboard=[buttons[i:i + 5] for i in range(0, len(buttons), 5)])
+    return f'🗞 Новое в чате ({len(posts)}):\n\n{body}\n\n{FOOTER}', kb
+
+
+def _digest_chunks(posts: list, size, limit: int) -> list:
+    """Split posts in order into runs whose total size(post) stays within limit."""
+    chunks, current, total = [], [], 0
+    for post in posts:
+        n = size(post)
+        if current and total + n > limit:
+            chunks.append(current)
+            current, total = [], 0
+        current.append(post)
+        total += n
+    return chunks + [current] if current else chunks
+
+
+def _digest_media(post: dict) -> list:
+    caption = post.get('caption') or None
+    if post['type'] == 'album':
+        return album_media(post['content'], caption)
+    media_cls = InputMediaPhoto if post['type'] == 'photo' else InputMediaVideo
+    return [media_cls(media=post['content'], caption=caption)]
+
+
+async def send_digest(room: dict, uid: str, posts: list, progress: dict = None) -> tuple:
+    """Deliver queued posts to one user: (room_id, uid, {post id: delivered ids}, {digest mid: post ids}).
+
+    `progress` keeps what was sent across repeated attempts, so a retry sends only the rest.
+    """
+    chat_id = int(uid)
+    progress = {} if progress is None else progress
+    copies = progress.setdefault('copies', {})
+    texts = progress.setdefault('texts', {})
+    sent_ids = set(copies).union(*texts.values())
+    calls = 0
+    for chunk in _digest_chunks([m for m in posts if m['type'] == 'text'], lambda m: len(m['content']) + 8,
+                                DIGEST_TEXT_LIMIT):
+        if chunk[0]['id'] in sent_ids:
+            continue
+        text, kb = digest_text(room, chunk)
+        sent = await bot.send_message(chat_id, text, reply_markup=kb)
+        calls += 1
+        texts[sent.message_id] = [m['id'] for m in chunk]
+    media_posts = [m for m in posts if m['type'] != 'text']
+    for chunk in _digest_chunks(media_posts, lambda m: len(m['content']) if m['type'] == 'album' else 1, 10):
+        if chunk[0]['id'] in sent_ids:
+            continue
+        media = [item for m in chunk for item in _digest_media(m)]
+        if len(chunk) == 1 and chunk[0]['type'] != 'album':
+            # одиночный пост отправляется как обычно, со своей кнопкой жалобы
+            post = chunk[0]
+            send = bot.send_photo if post['type'] == 'photo' else bot.send_video
+            sent = await send(chat_id, post['content'], caption=render_body(post, False),
+                              reply_markup=complaint_kb_for(room['id'], post['id']))
+            copies[post['id']] = sent.message_id
+        elif len(media) == 1:
+            sent = await bot.send_media_group(chat_id, media)
+            copies[chunk[0]['id']] = [m.message_id for m in sent]
+        else:
+            sent = await bot.send_media_group(chat_id, media)
+            mids = iter(m.message_id for m in sent)
+            for post in chunk:
+                copies[post['id']] = [next(mids) for _ in range(len(_digest_media(post)))]
+        calls += 1
+    digest_stats['digests'] += 1
+    digest_stats['posts'] += len(posts)
+    digest_stats['calls'] += calls
+    activity.count('deliveries', len(posts))
+    return room['id'], uid, copies, texts
+
+
+def record_digest(room_id: str, uid: str, copies: dict, texts: dict) -> list:
+    """Store where a sent digest put each post; return (recipient, mid) of texts whose posts are gone meanwhile."""
+    room = data.get('rooms', {}).get(room_id)
+    stale = []
+    for msg_id, value in copies.items():
+        msg = find_chat(room, msg_id) if room is not None else None
+        if msg is not None:
+            msg.setdefault('delivered', {})[uid] = value
+        else:
+            stale.append((int(uid), value))
+    digests = get_user(uid).setdefault('digests', {})
+    for mid, ids in texts.items():
+        kept = [i for i in ids if room is not None and find_chat(room, i) is not None]
+        for msg_id in kept:
+            find_chat(room, msg_id).setdefault('digest', {})[uid] = mid
+        digests[str(mid)] = [room_id, kept]
+        if len(kept) < len(ids):
+            stale.append((int(uid), mid))
+    # помнить только последние DIGEST_KEEP дайджестов пользователя
+    for mid in sorted(digests, key=int)[:-DIGEST_KEEP]:
+        del digests[mid]
+    return stale
+
+
+async def flush_digests(force_uid: str = None):
+    """Send every digest whose window has passed (and force_uid's right away)."""
+    async with store_lock():
+        refresh_data()
+        due = take_due_digests(force_uid)
+        for room_id in {room['id'] for room, *_ in due}:
+            await save_data(room_id)
+    if not due:
+        return
+    progress = {}
+
+    async def send_one(item):
+        room, uid, posts, _ = item
+        state = progress.setdefault((room['id'], uid), {})
+        try:
+            await send_digest(room, uid, posts, state)
+        except (TelegramBadRequest, TelegramForbiddenError):
+            # пользователь закрыл чат с ботом: повторять бессмысленно, очередь снимается
+            state['gone'] = True
+
+    stale = []
+    try:
+        await fan_out(due, send_one)
+    finally:
+        # записать всё, что успело уйти, даже если рассылку прервали; неотправленное остаётся в очереди
+        async with store_lock():
+            refresh_data()
+            for room, uid, posts, ids in due:
+                state = progress.get((room['id'], uid), {})
+                copies, texts = state.get('copies', {}), state.get('texts', {})
+                if copies or texts:
+                    stale += record_digest(room['id'], uid, copies, texts)
+                done = set(ids) if state.get('gone') else set(copies).union(*texts.values())
+                # посты, удалённые до отправки, тоже снимаются с очереди
+                done |= set(ids) - {m['id'] for m in posts}
+                unqueue_digest(room['id'], uid, ids, done)
+            for room_id in {room['id'] for room, *_ in due}:
+                await save_data(room_id)
+    # посты, удалённые, пока дайджест отправлялся
+    for recipient, value in stale:
+        if isinstance(value, int) and str(value) in (get_user(str(recipient)).get('digests') or {}):
+            await refresh_digests([(recipient, value)])
+        else:
+            try:
+                await delete_delivered(recipient, value)
+            except Exception:
+                pass
+
+
+async def digest_loop():
+    while True:
+        await asyncio.sleep(DIGEST_TICK)
+        try:
+            await flush_digests()
+        except Exception as e:
+            print(f'Digest delivery failed: {e}')
+
+
+def digest_copies(msgs) -> set:
+    """(recipient, mid) of the text digests carrying any of msgs; the posts are dropped from their contents."""
+    pairs = set()
+    users = data.get('users', {})
+    for msg in msgs:
+        for recip, mid in (msg.get('digest') or {}).items():
+            comp = (users.get(recip, {}).get('digests') or {}).get(str(mid))
+            if comp:
+                comp[1] = [i for i in comp[1] if i != msg['id']]
+            pairs.add((int(recip), mid))
+    return pairs
+
+
+async def refresh_digest(recipient: int, mid: int):
+    """Re-render a delivered text digest from the posts it still carries, or delete it when none are left."""
+    digests = data.get('users', {}).get(str(recipient), {}).get('digests') or {}
+    comp = digests.get(str(mid))
+    room = data.get('rooms', {}).get(comp[0]) if comp else None
+    posts = [m for m in (find_chat(room, i) for i in comp[1]) if m is not None] if room is not None else []
+    if not posts:
+        digests.pop(str(mid), None)
+        await bot.delete_message(recipient, mid)
+        return
+    text, kb = digest_text(room, posts)
+    await bot.edit_message_text(text=text, chat_id=recipient, message_id=mid, reply_markup=kb)
+
+
+async def refresh_digests(pairs, lane: str = 'delete'):
+    await fan_out(list(pairs), lambda pair: refresh_digest(*pair), lane=lane, repeatable=True)
+
+
+def digest_stats_text() -> str:
+    users = sum(1 for u in data.get('users', {}).values() if u.get('delivery'))
+    queued = sum(len(q['ids']) for room in data.get('rooms', {}).values() for q in (room.get('digest') or {}).values())
+    saved = digest_stats['posts'] - digest_stats['calls']
+    return (f'Дайджесты: подписчиков {users}, в очереди {queued}, отправлено {digest_stats["digests"]} '
+            f'({digest_stats["posts"]} постов за {digest_stats["calls"]} вызовов API, сэкономлено {saved})')
+
+
+# --- догоняющая лента ------------------------------------------------------------
+# Новый участник получает последние посты комнаты, которых у него нет, — самым низким
+# приоритетом отправки и с записью в delivered, чтобы на них можно было ответить и пожаловаться.
+# Готовые к отправке варианты постов кэшируются; user['catchup'] = [начало суток, отправлено].
+_catchup_cache = OrderedDict()  # (room_id, msg_id) -> (content the variant was rendered from, user variant)
+
+
+def catchup_variant(room: dict, msg: dict) -> tuple:
+    key = (room['id'], msg['id'])
+    # правка (в том числе в другом воркере) меняет содержимое — вариант рендерится заново
+    source = (msg.get('edited'), msg.get('content'), msg.get('caption'))
+    cached = _catchup_cache.get(key)
+    if cached is not None and cached[0] == source:
+        _catchup_cache.move_to_end(key)
+        return cached[1]
+    variant = post_variants(room, msg)[False]
+    _catchup_cache[key] = (source, variant)
+    if len(_catchup_cache) > CATCHUP_CACHE:
+        _catchup_cache.popitem(last=False)
+    return variant
+
+
+def catchup_allowance(user) -> int:
+    """Posts the user may still receive through catch-up today."""
+    day = int(time.time() // 86400)
+    if not user.get('catchup') or user['catchup'][0] != day:
+        user['catchup'] = [day, 0]
+    return max(0, CATCHUP_BUDGET - user['catchup'][1])
+
+
+async def catch_up(uid: str, room_id: str, notify: bool = False) -> int:
+    """Send the user the room's last CATCHUP_POSTS posts they do not have, oldest first; returns how many were sent."""
+    async with store_lock():
+        refresh_data()
+        room = data.get('rooms', {}).get(room_id)
+        if room is None:
+            return 0
+        # те же условия, что и для участия в чате: принятые правила, членство, без бана, всё включено
+        ok, reason = room_guard(uid, room)
+        if ok and int(uid) not in room.get('members', []):
+            ok, reason = False, 'Вы не в этой комнате.'
+        posts, variants = [], []
+        if ok:
+            user = get_user(uid)
+            allowance = catchup_allowance(user)
+            reason = 'Новых сообщений нет.' if allowance else 'Лимит недавних сообщений на сегодня исчерпан.'
+            # посты, ждущие в дайджесте пользователя, придут с ним — второй раз их не шлём
+            queued = set(((room.get('digest') or {}).get(uid) or {}).get('ids', ()))
+            posts = [m for m in room.get('chat', [])[-CATCHUP_POSTS:]
+                     if uid not in (m.get('delivered') or {}) and uid not in (m.get('digest') or {})
+                     and m['id'] not in queued]
+            posts = posts[-allowance:] if allowance else []
+            user['catchup'][1] += len(posts)
+            variants = [catchup_variant(room, m) for m in posts]
+            if posts:
+                await save_data('core')
+    chat_id = int(uid)
+    if not posts:
+        if notify:
+            await bot.send_message(chat_id, reason)
+        return 0
+    send_lane.set('catchup')
+    sent = {}
+    try:
+        await bot.send_message(chat_id, f'📜 Последние сообщения комнаты «{room.get("title", room_id)}»:')
+        for msg, variant in zip(posts, variants):
+            # ответ на пост, который пользователь уже получил (в том числе только что), остаётся ответом
+            target = find_chat(room, msg['reply_target_id']) if msg.get('reply_target_id') is not None else None
+            reply_to_id = None
+            if target is not None:
+                ids = delivered_ids(sent.get(target['id']))
+                reply_to_id = ids[0] if ids else reply_copy_id(target, uid)
+            for _ in range(SEND_RETRIES + 1):
+                try:
+                    sent[msg['id']] = await send_post(chat_id, msg, variant, reply_to_id)
+                    break
+                except TelegramRetryAfter as e:
+                    # догоняющая лента не торопится: ждём, сколько сказал Telegram, и пробуем снова
+                    await asyncio.sleep(e.retry_after)
+            else:
+                break
+    except Exception:
+        # пользователь заблокировал бота или сеть недоступна: что успели — записываем
+        pass
+    async with store_lock():
+        refresh_data()
+        room = data.get('rooms', {}).get(room_id)
+        for msg_id, value in sent.items():
+            msg = find_chat(room, msg_id) if room is not None else None
+            if msg is not None:
+                msg.setdefault('delivered', {})[uid] = value
+        # неотправленное не расходует лимит
+        user = get_user(uid)
+        catchup_allowance(user)
+        user['catchup'][1] = max(0, user['catchup'][1] - (len(posts) - len(sent)))
+        await save_data(room_id)
+    activity.count('deliveries', len(sent))
+    return len(sent)
+
+
+# (room_id, cid) -> monotonic time of the latest report admins have not been told about
+_complaint_pending = {}
+_complaint_tasks = {}
+
+
+def schedule_complaint_notice(room_id: str, cid: str):
+    """Tell admins about a complaint after COMPLAINT_NOTIFY_DELAY of quiet; a burst of reports gives one notice."""
+    key = (room_id, cid)
+    _complaint_pending[key] = time.monotonic()
+    if key not in _complaint_tasks:
+        _complaint_tasks[key] = asyncio.create_task(_complaint_notice_worker(key))
+
+
+async def _complaint_notice_worker(key):
+    try:
+        while key in _complaint_pending:
+            wait = _complaint_pending[key] + COMPLAINT_NOTIFY_DELAY - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            _complaint_pending.pop(key, None)
+            room = data.get('rooms', {}).get(key[0])
+            comp = room.get('complaints', {}).get(key[1]) if room is not None else None
+            if comp is None or comp.get('status') != 'open':
+                return
+            # уведомление — только текст; медиа админ увидит, открыв жалобу
+            last = comp['reports'][-1]
+            try:
+                ts_utc = datetime.fromisoformat(last['timestamp'])
+                time_str = ts_utc.astimezone(timezone(timedelta(hours=5))).strftime('%d.%m.%Y %H:%M:%S')
+            except Exception:
+                time_str = last.get('timestamp')
+            where = f' на сообщение #{comp["target"]}' if comp.get('target') is not None else ''
+            text = (f'Жалоба #{comp["id"]}{where} в комнате «{room.get("title", room["id"])}», '
+                    f'жалующихся: {len(complaint_reporters(comp))}\nПоследняя причина: {last.get("text")}\nВремя: {time_str}')
+            kb = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text='Открыть', callback_data=f'open_complaint_{room["id"]}_{comp["id"]}')]
+            ])
+            await fan_out(list(admin_sessions), lambda adm: bot.send_message(adm, text, reply_markup=kb), lane='admin')
+    finally:
+        _complaint_tasks.pop(key, None)
+
+
+async def delete_delivered(recipient: int, value):
+    ids = delivered_ids(value)
+    if len(ids) > 1:
+        await bot.delete_messages(recipient, ids)
+    elif ids:
+        await bot.delete_message(recipient, ids[0])
 
+# --- отложенное удаление сообщений -------------------------------------------------
+# Служебные сообщения бота (уведомления, кнопки просроченных черновиков) удаляются одной
+# фоновой задачей: очередь по времени, удаления в один чат за раз уходят одним deleteMessages.
+_delete_queue = []     # heap of (due monotonic time, chat_id, message_id)
+_delete_wakeup = asyncio.Event()
+_delete_task = None
 
-@dp.message(Command('start'))
-async def cmd_start(message: types.Message):
-    uid = str(message.from_user.id)
-    data['users'].setdefault(uid, {'username': message.from_user.username, 'last_message': None})
-    terms = (
-    'Условия пользования:\n'
-    '- Все сообщения и материалы публикуются пользователями под их личную ответственность.\n'
-    '- Публикация фото и медиа с изображением других лиц возможна, но ответственность за публикацию лежит на пользователе.\n'
-    '- При первой жалобе на материалы с изображением третьих лиц они будут удалены без обсуждения.\n'
-    '- Администрация не поощряет публикацию материалов без согласия изображённых лиц.\n'
-    '- Запрещено распространять материалы из этого бота за его пределы; ответственность лежит на пользователе.\n'
-    '- Администрация не несёт ответственности за пользовательский контент, шутки, подколы или последствия общения.\n'
-    '- Администраторы действуют в рамках закона и вправе ограничить доступ к боту.\n'
-    '- Администраторы не связаны с учебным заведением и не представляют его интересы.\n'
-    '- Использование бота означает согласие с правилами и осознание возможных рисков.\n'
-    '- Незнание условий не снимает с вас ответственности.\n'
-    'Нажмите ✅ Принять для продолжения или \n ❌ Не согласен для отказа.'
-)
-                 
-    await message.answer(terms, reply_markup=terms_kb)
 
+def schedule_delete(chat_id: int, message_id: int, delay: float = 0):
+    global _delete_task
+    heapq.heappush(_delete_queue, (time.monotonic() + delay, int(chat_id), message_id))
+    _delete_wakeup.set()
+    if _delete_task is None or _delete_task.done():
+        _delete_task = asyncio.create_task(_deletion_loop())
 
-@dp.callback_query(lambda c: c.data == 'accept_terms')
-async def cb_accept(cb: types.CallbackQuery):
-    uid_int = int(cb.from_user.id)
-    if uid_int in data.get('banned', []):
-        await cb.message.answer('Вы забанены и не можете пользоваться ботом.')
-        await cb.answer()
-        return
-    if uid_int not in data.get('accepted', []):
-        data.setdefault('accepted', []).append(uid_int)
-    await save_data()
-    
-    # Сообщение подтверждения
-    confirmation = (
-        '✅ Вы приняли условия пользования!\n\n'
-        'Теперь вы можете писать сообщения в анонимный чат. 🎉\n'
-    )
-    await cb.message.answer(confirmation)
-    
-    # Отправляем меню сразу
-    help_text = (
-        '📋 МЕНЮ И СПРАВКА:\n\n'
-        '👤 ОТПРАВКА СООБЩЕНИЙ:\n'
-        '- Отправьте текст, фото или видео\n'
-        '- Появится превью и кнопка подтверждения\n'
-        '- После подтверждения сообщение станет анонимным\n'
-        '- Лимит: 1 сообщение на 30 секунд (антиспам)\n\n'
-        '⚠️ ЖАЛОБЫ:\n'
-        '- Нажмите "⚠️ Пожаловаться" под сообщением\n'
-        '- Или используйте кнопку "⚠️ Пожаловаться"\n\n'
-        '⚠️ ПРАВИЛА:\n'
-        '- Мы не поддерживаем публикацию материалов без согласия изображённых лиц (фото/видео).\n'
-        '- Такие материалы могут быть удалены по просьбе через жалобу с объяснением причины.\n'
-        '- Можете выражать себя как хотите — мат, шутки, подколы допускаются.\n'
-        '- Мы ценим дружелюбное отношение к пользователям и стараемся поддерживать безопасную атмосферу.\n\n'
-        '💬 КОМАНДЫ:\n'
-        '- "ℹ️ Меню" — показать эту справку\n'
-        '- "/start" — начать заново\n\n'
-        '🕊️ Команда FreeBird всегда к вашим услугам!'
-    )
-    await cb.message.answer(help_text, reply_markup=user_kb)
-    await cb.answer()
 
+async def _deletion_loop():
+    send_lane.set('delete')
+    while True:
+        _delete_wakeup.clear()
+        if not _delete_queue:
+            await _delete_wakeup.wait()
+            continue
+        wait = _delete_queue[0][0] - time.monotonic()
+        if wait > 0:
+            try:
+                await asyncio.wait_for(_delete_wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        due = {}
+        now = time.monotonic()
+        while _delete_queue and _delete_queue[0][0] <= now:
+            _, chat_id, message_id = heapq.heappop(_delete_queue)
+            due.setdefault(chat_id, []).append(message_id)
+        for chat_id, ids in due.items():
+            for i in range(0, len(ids), 100):
+                try:
+                    await delete_delivered(chat_id, ids[i:i + 100])
+                except Exception:
+                    pass
+
+def purge_kb(room_id: str, author_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text='🧹 За 24 ч', callback_data=f'purge_{room_id}_{author_id}_24'),
+            InlineKeyboardButton(text='🧹 За 7 дней', callback_data=f'purge_{room_id}_{author_id}_168'),
+            InlineKeyboardButton(text='🧹 Все', callback_data=f'purge_{room_id}_{author_id}_0'),
+        ],
+    ])
 
-@dp.callback_query(lambda c: c.data == 'decline_terms')
-async def cb_decline(cb: types.CallbackQuery):
-    await cb.message.answer('Вы отказались от условий. Для использования бота нужно принять условия (/start).')
-    await cb.answer()
 
+async def purge_delivered(per_recipient: dict, posts: int, chat_id: int, status_mid: int):
+    """Delete copies of purged posts at every recipient, reporting progress in the admin's status message."""
+    done = 0
+    total = len(per_recipient)
 
-@dp.callback_query(lambda c: c.data == 'confirm_send')
-async def cb_confirm_send(cb: types.CallbackQuery):
-    uid = str(cb.from_user.id)
-    draft = data.get('drafts', {}).get(uid)
-    if not draft:
-        await cb.message.answer('Черновик не найден.')
-        await cb.answer()
-        return
+    async def report(final=False):
+        text = (f'🧹 Удалено {posts} сообщений у {total} получателей.' if final
+                else f'🧹 Удаление {posts} сообщений: {done} из {total} получателей…')
+        try:
+            await bot.edit_message_text(text=text, chat_id=chat_id, message_id=status_mid)
+        except Exception:
+            pass
+
+    async def progress():
+        while True:
+            await asyncio.sleep(3)
+            await report()
+
+    async def delete_for(recipient):
+        nonlocal done
+        ids = per_recipient[recipient]
+        # deleteMessages принимает до 100 id за раз; после повтора продолжаем с того же места
+        while ids:
+            await delete_delivered(recipient, ids[:100])
+            del ids[:100]
+        done += 1
+
+    reporter = asyncio.create_task(progress())
+    try:
+        await fan_out(list(per_recipient), delete_for, lane='delete', repeatable=True)
+    finally:
+        reporter.cancel()
+    await report(final=True)
+
+
+async def publish_draft(uid: str, draft: dict, room: dict) -> dict:
+    """Turn a confirmed draft into a chat entry, save it and start delivering it to the room.
+
+    The draft is taken off data['drafts'] before the first await, so a concurrent confirm,
+    cancel or admin decision finds it gone. Delivery runs as a background task once the
+    entry is saved and does not hold up the author's next updates.
+    """
+    if data.get('drafts', {}).get(uid) is draft:
+        data['drafts'].pop(uid)
     # Add to public chat (anonymous to users)
-    msg = {
+    room['seq'] = room.get('seq', 0) + 1
+    msg = ChatMessage({
+        'id': room['seq'],
         'from_id': int(uid),
         'username': data.get('users', {}).get(uid, {}).get('username'),
         'type': draft['type'],
         'content': draft.get('content'),
         'caption': draft.get('caption', ''),
         'timestamp': now_ts(),
-    }
-    # Копировать индекс целевого сообщения если это ответ
-    if 'reply_target_idx' in draft:
-        msg['reply_target_idx'] = draft['reply_target_idx']
+    })
+    # Копировать id целевого сообщения если это ответ
+    if 'reply_target_id' in draft:
+        msg['reply_target_id'] = draft['reply_target_id']
+    # message_id исходного сообщения у автора — по нему находятся его правки
+    if 'src_mid' in draft:
+        msg['src_mid'] = draft['src_mid']
     # store delivered message ids per recipient to allow later deletion
     msg['delivered'] = {}
-    data.setdefault('chat', []).append(msg)
+    if draft.get('fp'):
+        msg['fp'] = draft['fp']
+    index_author_post(room, msg)
+    room.setdefault('chat', []).append(msg)
+    remember_fingerprint(room, msg)
+    search_index_post(room, msg)
     # Увеличить счетчик сообщений пользователя
-    data.setdefault('users', {}).setdefault(uid, {})['msg_count'] = data['users'][uid].get('msg_count', 0) + 1
-    # log for admin/console
-    user_obj = cb.from_user
-    if draft['type'] == 'text':
-        log_msg(draft['type'], user_obj, draft['content'])
-    else:
-        log_msg(draft['type'], user_obj, f"file_id:{draft['content']} caption:{draft.get('caption','')}")
-    # Send anonymous to all users with footer at the bottom and attach complaint button
-    chat_idx = len(data.get('chat', [])) - 1
-    complaint_kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text='⚠️ Пожаловаться', callback_data=f'complaint_{chat_idx}')]
-    ])
-    for uid_k in list(data.get('users', {}).keys()):
-        try:
-            user_id_int = int(uid_k)
-            # Получить индекс целевого сообщения в чате (если это ответ)
-            reply_target_idx = msg.get('reply_target_idx')
-            reply_to_id = None
-            
-            # Если это ответ на сообщение в чате, найти message_id этого сообщения для текущего получателя
-            if reply_target_idx is not None and 0 <= reply_target_idx < len(data.get('chat', [])):
-                target_msg = data['chat'][reply_target_idx]
-                reply_to_id = target_msg.get('delivered', {}).get(str(user_id_int))
-            
-            # Проверить, админ это или обычный пользователь
-            is_admin = user_id_int in admin_sessions
-            
-            # Для админа показать подписанное сообщение, для остальных - анонимное
-            if is_admin:
-                sender_name = msg.get('username') if msg.get('username') else f'ID {msg["from_id"]}'
-                header = f"📤 От: {sender_name} ({msg['from_id']})\n\n"
-            else:
-                header = ''
-            
-            if msg['type'] == 'text':
-                content = header + msg["content"] + f'\n\n{FOOTER}'
-                try:
-                    sent = await bot.send_message(user_id_int, content, reply_markup=complaint_kb if not is_admin else None, reply_to_message_id=reply_to_id)
-                except Exception:
-                    # Если reply_to_message_id не существует, отправить без ответа
-                    sent = await bot.send_message(user_id_int, content, reply_markup=complaint_kb if not is_admin else None)
-                msg['delivered'][str(user_id_int)] = sent.message_id
-            elif msg['type'] == 'photo':
-                caption = msg.get('caption') or ''
-                caption = header + caption if header else caption
-                caption = f"{caption}\n\n{FOOTER}" if caption else FOOTER
-                try:
-                    sent = await bot.send_photo(user_id_int, msg['content'], caption=caption, reply_markup=complaint_kb if not is_admin else None, reply_to_message_id=reply_to_id)
-                except Exception:
-                    # Если reply_to_message_id не существует, отправить без ответа
-                    sent = await bot.send_photo(user_id_int, msg['content'], caption=caption, reply_markup=complaint_kb if not is_admin else None)
-                msg['delivered'][str(user_id_int)] = sent.message_id
-            elif msg['type'] == 'video':
-                caption = msg.get('caption') or ''
-                caption = header + caption if header else caption
-                caption = f"{caption}\n\n{FOOTER}" if caption else FOOTER
-                try:
-                    sent = await bot.send_video(user_id_int, msg['content'], caption=caption, reply_markup=complaint_kb if not is_admin else None, reply_to_message_id=reply_to_id)
-                except Exception:
-                    # Если reply_to_message_id не существует, отправить без ответа
-                    sent = await bot.send_video(user_id_int, msg['content'], caption=caption, reply_markup=complaint_kb if not is_admin else None)
-                msg['delivered'][str(user_id_int)] = sent.message_id
-        except Exception:
-            pass
+    user = get_user(uid)
+    user['msg_count'] = user.get('msg_count', 0) + 1
+    activity.count('posts')
+    user['last_message'] = now_ts()
+    # Send anonymous to all room members with footer at the bottom and attach complaint button
+    if WORKER_SHARD is not None:
+        # в режиме воркеров рассылку делят все процессы, каждый доставляет своим получателям
+        enqueue_fanout(room['id'], msg['id'])
+    await save_data(room['id'])
+    if WORKER_SHARD is None:
+        asyncio.create_task(deliver_entry(room, msg))
+    return msg
+
+
+async def deliver_entry(room: dict, msg: dict):
+    """Background delivery of a published entry; the delivered ids are saved when it is done."""
+    try:
+        await broadcast_entry(room, msg)
+    except Exception as e:
+        print(f'Delivery of {room["id"]}#{msg["id"]} failed: {e}')
     # save delivered ids
     try:
-        await save_data()
+        await save_data(room['id'])
     except Exception:
         pass
-    # clear user draft and update last_message
-    data['drafts'].pop(uid, None)
-    data['users'].setdefault(uid, {})['last_message'] = now_ts()
-    await save_data()
+
+
+@dp.callback_query(lambda c: c.data == 'confirm_send')
+async def cb_confirm_send(cb: types.CallbackQuery):
+    uid = str(cb.from_user.id)
+    draft = data.get('drafts', {}).get(uid)
+    if not draft:
+        await cb.message.answer('Черновик не найден.')
+        await cb.answer()
+        return
+    if draft.get('held'):
+        await cb.answer('Сообщение уже на проверке у администратора.')
+        return
+    room = get_room(draft.get('room') or user_room_id(uid))
+    if draft.get('dup_of') is not None and DUP_ACTION == 'approve':
+        # повтор недавнего поста: публикует администратор
+        draft['held'] = now_ts()
+        dup_stats['held'] += 1
+        await save_data('core')
+        await fan_out(list(admin_sessions), lambda adm: send_held_draft(adm, uid, draft, room), lane='admin')
+        try:
+            await cb.message.edit_reply_markup(reply_markup=None)
+        except Exception:
+            pass
+        await cb.message.answer('Похожее сообщение уже было в чате — ваше отправлено на проверку администратору.')
+        await cb.answer()
+        return
+    # log for admin/console
+    user_obj = cb.from_user
+    if draft['type'] == 'text':
+        log_msg(draft['type'], user_obj, draft['content'], 'confirm')
+    elif draft['type'] == 'album':
+        log_msg(draft['type'], user_obj, f"file_ids:{','.join(i['file_id'] for i in draft['content'])} caption:{draft.get('caption','')}", 'confirm')
+    else:
+        log_msg(draft['type'], user_obj, f"file_id:{draft['content']} caption:{draft.get('caption','')}", 'confirm')
+    await publish_draft(uid, draft, room)
     # delete confirmation message
     try:
         await cb.message.delete()
@@ -353,13 +3517,7 @@ async def cb_confirm_send(cb: types.CallbackQuery):
     # send temporary notification and auto-delete it after 3 seconds
     try:
         tmp = await bot.send_message(cb.from_user.id, 'Сообщение отправлено в чат.')
-        async def _del_later(chat_id, message_id, delay=3):
-            await asyncio.sleep(delay)
-            try:
-                await bot.delete_message(chat_id, message_id)
-            except Exception:
-                pass
-        asyncio.create_task(_del_later(tmp.chat.id, tmp.message_id, 3))
+        schedule_delete(tmp.chat.id, tmp.message_id, 3)
     except Exception:
         pass
     await cb.answer()
@@ -368,9 +3526,11 @@ async def cb_confirm_send(cb: types.CallbackQuery):
 @dp.callback_query(lambda c: c.data == 'cancel_send')
 async def cb_cancel_send(cb: types.CallbackQuery):
     uid = str(cb.from_user.id)
-    # remove draft
-    data.get('drafts', {}).pop(uid, None)
-    await save_data()
+    # remove draft; если его уже опубликовали или отклонили, отменять нечего
+    if data.get('drafts', {}).pop(uid, None) is None:
+        await cb.answer('Черновик уже отправлен или удалён.')
+        return
+    await save_data('core')
     # delete confirmation message
     try:
         await cb.message.delete()
@@ -379,39 +3539,146 @@ async def cb_cancel_send(cb: types.CallbackQuery):
     # send temporary cancellation notice
     try:
         tmp = await bot.send_message(cb.from_user.id, 'Отправка отменена.')
-        async def _del_later(chat_id, message_id, delay=3):
-            await asyncio.sleep(delay)
-            try:
-                await bot.delete_message(chat_id, message_id)
-            except Exception:
-                pass
-        asyncio.create_task(_del_later(tmp.chat.id, tmp.message_id, 3))
+        schedule_delete(tmp.chat.id, tmp.message_id, 3)
+    except Exception:
+        pass
+    await cb.answer()
+
+
+async def send_held_draft(chat_id: int, uid: str, draft: dict, room: dict):
+    uname = data.get('users', {}).get(uid, {}).get('username')
+    who = f'@{uname}' if uname else f'ID {uid}'
+    head = f'Повтор сообщения #{draft.get("dup_of")} в комнате «{room.get("title", room["id"])}» от {who}. Опубликовать?'
+    kb = duplicate_kb(uid)
+    if draft['type'] == 'text':
+        await bot.send_message(chat_id, f'{head}\n\n{draft["content"]}'[:4096], reply_markup=kb)
+    elif draft['type'] == 'photo':
+        await bot.send_photo(chat_id, draft['content'], caption=f'{head}\n\n{draft.get("caption", "")}'[:1024], reply_markup=kb)
+    elif draft['type'] == 'video':
+        await bot.send_video(chat_id, draft['content'], caption=f'{head}\n\n{draft.get("caption", "")}'[:1024], reply_markup=kb)
+    elif draft['type'] == 'album':
+        await bot.send_media_group(chat_id, album_media(draft['content'], draft.get('caption')))
+        await bot.send_message(chat_id, head, reply_markup=kb)
+
+
+@dp.callback_query(lambda c: c.data.startswith('dup_ok_') or c.data.startswith('dup_no_'))
+async def cb_duplicate_decision(cb: types.CallbackQuery):
+    if cb.from_user.id not in admin_sessions:
+        await cb.answer('Вы не админ.')
+        return
+    uid = cb.data.split('_')[2]
+    draft = data.get('drafts', {}).get(uid)
+    if not draft or not draft.get('held'):
+        # уже решено другим админом или автор прислал новый черновик
+        await cb.answer('Уже не актуально.')
+        try:
+            await cb.message.edit_reply_markup(reply_markup=None)
+        except Exception:
+            pass
+        return
+    audit('duplicate_approved' if cb.data.startswith('dup_ok_') else 'duplicate_rejected', cb.from_user,
+          author=int(uid), dup_of=draft.get('dup_of'))
+    if cb.data.startswith('dup_ok_'):
+        await publish_draft(uid, draft, get_room(draft.get('room') or user_room_id(uid)))
+        result, notice = 'Опубликовано.', 'Администратор одобрил ваше сообщение, оно отправлено в чат.'
+    else:
+        data['drafts'].pop(uid, None)
+        await save_data('core')
+        result, notice = 'Отклонено.', 'Администратор отклонил ваше сообщение как повтор.'
+    try:
+        await bot.send_message(int(uid), notice)
+    except Exception:
+        pass
+    try:
+        await cb.message.edit_reply_markup(reply_markup=None)
+    except Exception:
+        pass
+    await cb.answer(result)
+
+
+async def send_complaint_card(chat_id: int, room: dict, comp: dict):
+    text = complaint_card_text(room, comp)
+    kb = complaint_actions_kb(room['id'], comp['id'])
+    tmsg = find_chat(room, comp['target']) if comp.get('target') is not None else None
+    msg_type = tmsg.get('type') if tmsg is not None else None
+    if msg_type == 'photo':
+        await bot.send_photo(chat_id, tmsg.get('content'), caption=text[:1024], reply_markup=kb)
+    elif msg_type == 'video':
+        await bot.send_video(chat_id, tmsg.get('content'), caption=text[:1024], reply_markup=kb)
+    elif msg_type == 'album':
+        first = tmsg['content'][0]
+        send = bot.send_photo if first['type'] == 'photo' else bot.send_video
+        await send(chat_id, first['file_id'], caption=text[:1024], reply_markup=kb)
+    else:
+        await bot.send_message(chat_id, text[:4096], reply_markup=kb)
+
+
+def _complaint_ref(cb_data: str):
+    """'<action>_complaint_<room>_<cid>' / 'delete_msg_<room>_<cid>' -> (room, cid as str)."""
+    room_id, cid = cb_data.split('_')[2:4]
+    return get_room(room_id), str(int(cid))
+
+
+async def _close_card(msg, text: str):
+    try:
+        await msg.edit_text(text)
+    except Exception:
+        try:
+            await msg.edit_caption(caption=text)
+        except Exception:
+            pass
+    schedule_delete(msg.chat.id, msg.message_id, 3)
+
+
+@dp.callback_query(lambda c: c.data.startswith('complaints_page_'))
+async def cb_complaints_page(cb: types.CallbackQuery):
+    if cb.from_user.id not in admin_sessions:
+        await cb.answer('Вы не админ.')
+        return
+    try:
+        room_id, status, page = cb.data.split('_')[2:5]
+        if status not in COMPLAINT_STATUSES:
+            raise ValueError(status)
+        text, kb = complaints_page(get_room(room_id), status, int(page))
+        await cb.message.edit_text(text, reply_markup=kb)
     except Exception:
         pass
     await cb.answer()
 
 
+@dp.callback_query(lambda c: c.data.startswith('open_complaint_'))
+async def cb_open_complaint(cb: types.CallbackQuery):
+    if cb.from_user.id not in admin_sessions:
+        await cb.answer('Вы не админ.')
+        return
+    try:
+        room, cid = _complaint_ref(cb.data)
+    except Exception:
+        await cb.answer('Ошибка.')
+        return
+    comp = room.get('complaints', {}).get(cid)
+    if comp is None:
+        await cb.answer('Жалоба не найдена.')
+        return
+    try:
+        await send_complaint_card(cb.message.chat.id, room, comp)
+    except Exception:
+        await cb.answer('Не удалось показать жалобу.')
+        return
+    await cb.answer()
+
+
 @dp.callback_query(lambda c: c.data.startswith('del_complaint_'))
 async def cb_del_complaint(cb: types.CallbackQuery):
     if cb.from_user.id not in admin_sessions:
         await cb.answer('Вы не админ.')
         return
     try:
-        idx = int(cb.data.split('_')[2])
-        if 0 <= idx < len(data.get('complaints', [])):
-            data['complaints'].pop(idx)
-            await save_data()
-            try:
-                await cb.message.edit_text('Жалоба удалена.')
-            except Exception:
-                pass
-            async def _del_after(msg):
-                await asyncio.sleep(3)
-                try:
-                    await bot.delete_message(msg.chat.id, msg.message_id)
-                except Exception:
-                    pass
-            asyncio.create_task(_del_after(cb.message))
+        room, cid = _complaint_ref(cb.data)
+        if drop_complaint(room, cid) is not None:
+            audit('complaint_deleted', cb.from_user, room=room['id'], complaint=int(cid))
+            await save_data(room['id'])
+            await _close_card(cb.message, 'Жалоба удалена.')
         else:
             await cb.answer('Жалоба не найдена.')
     except Exception:
@@ -425,14 +3692,14 @@ async def cb_reply_complaint(cb: types.CallbackQuery):
         await cb.answer('Вы не админ.')
         return
     try:
-        idx = int(cb.data.split('_')[2])
+        room, cid = _complaint_ref(cb.data)
     except Exception:
         await cb.answer('Ошибка.')
         return
     data['admin_action'] = 'reply_complaint_pending'
-    data['admin_action_target'] = idx
-    await save_data()
-    await cb.message.answer(f'Введите ответ на жалобу #{idx}:')
+    data['admin_action_target'] = [room['id'], cid]
+    await save_data('core')
+    await cb.message.answer(f'Введите ответ на жалобу #{cid} (получат все пожаловавшиеся):')
     await cb.answer()
 
 
@@ -443,106 +3710,127 @@ async def cb_delete_msg(cb: types.CallbackQuery):
         await cb.answer('Вы не админ.')
         return
     try:
-        idx = int(cb.data.split('_')[2])
+        room, cid = _complaint_ref(cb.data)
     except Exception:
         await cb.answer('Ошибка.')
         return
-    comps = data.get('complaints', [])
-    if not (0 <= idx < len(comps)):
+    comp = room.get('complaints', {}).get(cid)
+    if comp is None:
         await cb.answer('Жалоба не найдена.')
         return
-    comp = comps[idx]
     target = comp.get('target')
-    if target is None:
-        # no target; just remove the complaint
-        data['complaints'].pop(idx)
-        await save_data()
-        try:
-            await cb.message.edit_text('Жалоба удалена (сообщение не найдено).')
-        except Exception:
-            pass
-        async def _del_after2(msg):
-            await asyncio.sleep(3)
-            try:
-                await bot.delete_message(msg.chat.id, msg.message_id)
-            except Exception:
-                pass
-        asyncio.create_task(_del_after2(cb.message))
-        await cb.answer('Жалоба удалена.')
-        return
-    # remove target message if exists
-    if 0 <= target < len(data.get('chat', [])):
-        # attempt to delete delivered messages for this chat entry
-        target_msg = data['chat'][target]
-        delivered = target_msg.get('delivered', {}) or {}
-        for recip_str, mid in list(delivered.items()):
-            try:
-                await bot.delete_message(int(recip_str), mid)
-            except Exception:
-                pass
-        # remove the target from stored chat and the complaint
-        data['chat'].pop(target)
-        data['complaints'].pop(idx)
-        await save_data()
-        try:
-            await cb.message.edit_text('Сообщение удалено и жалоба обработана.')
-        except Exception:
-            pass
-        # notify the complainant that their request was fulfilled
-        try:
-            reporter = comp.get('from')
-            if reporter:
-                await bot.send_message(int(reporter), 'Ваша просьба выполнена.')
-        except Exception:
-            pass
-        await cb.answer('Сообщение удалено.')
-    else:
-        data['complaints'].pop(idx)
-        await save_data()
+    target_msg = find_chat(room, target) if target is not None else None
+    if target_msg is None:
+        # сообщения уже нет (или жалоба общая) — закрываем жалобу
+        set_complaint_status(room, cid, 'handled')
+        await save_data(room['id'])
+        await _close_card(cb.message, 'Целевое сообщение не найдено — жалоба закрыта.')
+        await cb.answer('Жалоба закрыта.')
+        return
+    delivered = target_msg.get('delivered', {}) or {}
+    await fan_out(list(delivered.items()), lambda item: delete_delivered(int(item[0]), item[1]), lane='delete',
+                  repeatable=True)
+    remove_chat(room, target)
+    await refresh_digests(digest_copies([target_msg]))
+    set_complaint_status(room, cid, 'handled')
+    audit('complaint_handled', cb.from_user, room=room['id'], complaint=int(cid), msg=target,
+          author=target_msg.get('from_id'), recipients=len(delivered))
+    await save_data(room['id'])
+    try:
+        await cb.message.edit_text('Сообщение удалено и жалоба обработана.')
+    except Exception:
         try:
-            await cb.message.edit_text('Целевое сообщение не найдено — жалоба удалена.')
+            await cb.message.edit_caption(caption='Сообщение удалено и жалоба обработана.')
         except Exception:
             pass
-        async def _del_after3(msg):
-            await asyncio.sleep(3)
-            try:
-                await bot.delete_message(msg.chat.id, msg.message_id)
-            except Exception:
-                pass
-        asyncio.create_task(_del_after3(cb.message))
-        await cb.answer('Целевое сообщение не найдено; жалоба удалена.')
+    # notify every complainant that their request was fulfilled
+    await fan_out(complaint_reporters(comp), lambda reporter: bot.send_message(int(reporter), 'Ваша просьба выполнена.'),
+                  lane='interactive')
+    await cb.answer('Сообщение удалено.')
 
 
 @dp.callback_query(lambda c: c.data.startswith('skip_complaint_'))
 async def cb_skip_complaint(cb: types.CallbackQuery):
-    # Admin chooses to skip this complaint (mark as seen/ignored)
+    # Admin chooses to skip this complaint (it stays in the "skipped" list)
     if cb.from_user.id not in admin_sessions:
         await cb.answer('Вы не админ.')
         return
     try:
-        idx = int(cb.data.split('_')[2])
+        room, cid = _complaint_ref(cb.data)
     except Exception:
         await cb.answer('Ошибка.')
         return
-    if 0 <= idx < len(data.get('complaints', [])):
-        data['complaints'].pop(idx)
-        await save_data()
-        try:
-            await cb.message.edit_text('Жалоба пропущена (удалена из списка).')
-        except Exception:
-            pass
+    if set_complaint_status(room, cid, 'skipped') is not None:
+        audit('complaint_skipped', cb.from_user, room=room['id'], complaint=int(cid))
+        await save_data(room['id'])
+        await _close_card(cb.message, 'Жалоба пропущена.')
         await cb.answer('Жалоба пропущена.')
     else:
         await cb.answer('Жалоба не найдена.')
 
 
-@dp.callback_query(lambda c: c.data == 'confirm_clear_history')
+def snapshots_kb(snaps: list) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"{s['timestamp'][:16].replace('T', ' ')} — {s['reason']}",
+                              callback_data=f"restore_snap_{s['id']}")]
+        for s in snaps
+    ])
+
+
+@dp.callback_query(lambda c: c.data.startswith('restore_snap_'))
+async def cb_restore_snap(cb: types.CallbackQuery):
+    if cb.from_user.id not in admin_sessions:
+        await cb.answer('Вы не админ.')
+        return
+    snap_id = cb.data[len('restore_snap_'):]
+    confirm_kb = InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text='✅ Да, восстановить', callback_data=f'confirm_restore_{snap_id}'),
+            InlineKeyboardButton(text='❌ Отмена', callback_data='cancel_restore'),
+        ],
+    ])
+    await cb.message.answer(f'⚠️ Вернуть все данные к снимку {snap_id}? Текущее состояние тоже сохранится снимком.',
+                            reply_markup=confirm_kb)
+    await cb.answer()
+
+
+@dp.callback_query(lambda c: c.data.startswith('confirm_restore_'))
+async def cb_confirm_restore(cb: types.CallbackQuery):
+    if cb.from_user.id not in admin_sessions:
+        await cb.answer('Вы не админ.')
+        return
+    snap_id = cb.data[len('confirm_restore_'):]
+    try:
+        changed = await restore_snapshot(snap_id)
+    except Exception as e:
+        await cb.message.edit_text(f'Не удалось восстановить снимок: {e}')
+        await cb.answer()
+        return
+    audit('restore', cb.from_user, snapshot=snap_id, docs_rewritten=changed)
+    await cb.message.edit_text(f'✅ Данные восстановлены из снимка {snap_id} (перезаписано документов: {changed}).')
+    await cb.answer('Восстановлено.')
+
+
+@dp.callback_query(lambda c: c.data == 'cancel_restore')
+async def cb_cancel_restore(cb: types.CallbackQuery):
+    try:
+        await cb.message.edit_text('Отменено.')
+    except Exception:
+        pass
+    await cb.answer('Отменено.')
+
+
+@dp.callback_query(lambda c: c.data.startswith('confirm_clear_history_'))
 async def cb_confirm_clear_history(cb: types.CallbackQuery):
     if cb.from_user.id not in admin_sessions:
         await cb.answer('Вы не админ.')
         return
-    data['chat'].clear()
-    await save_data()
+    room = get_room(cb.data[len('confirm_clear_history_'):])
+    await take_snapshot(f"before clear history {room['id']}")
+    audit('history_cleared', cb.from_user, room=room['id'], posts=len(room.get('chat', [])))
+    room['chat'].clear()
+    _search_index.pop(room['id'], None)
+    await save_data(room['id'])
     await cb.message.edit_text('✅ История чата полностью удалена.')
     await cb.answer('История стёрта.')
 
@@ -556,32 +3844,36 @@ async def cb_cancel_clear_history(cb: types.CallbackQuery):
     await cb.answer('Отменено.')
 
 
-@dp.callback_query(lambda c: c.data == 'confirm_delete_all_msgs')
+@dp.callback_query(lambda c: c.data.startswith('confirm_delete_all_msgs_'))
 async def cb_confirm_delete_all_msgs(cb: types.CallbackQuery):
     if cb.from_user.id not in admin_sessions:
         await cb.answer('Вы не админ.')
         return
+    room = get_room(cb.data[len('confirm_delete_all_msgs_'):])
+    await take_snapshot(f"before delete recent {room['id']}")
     # Удалить последние 50 сообщений у всех пользователей
-    chat_list = data.get('chat', [])
+    chat_list = room.get('chat', [])
     # Оставить только сообщения, которые не в последних 50
     msgs_to_delete = chat_list[-50:] if len(chat_list) > 50 else chat_list
     
+    copies = []
     for msg in msgs_to_delete:
-        delivered = msg.get('delivered', {}) or {}
-        for recip_str, mid in list(delivered.items()):
-            try:
-                await bot.delete_message(int(recip_str), mid)
-            except Exception:
-                pass
+        search_unindex_post(room, msg['id'])
+        copies += list((msg.get('delivered', {}) or {}).items())
+    await fan_out(copies, lambda item: delete_delivered(int(item[0]), item[1]), lane='delete',
+                  repeatable=True)
+    digests = digest_copies(msgs_to_delete)
     
     # Оставить в истории только старые сообщения (удалить последние 50 из истории)
     if len(chat_list) > 50:
-        data['chat'] = chat_list[:-50]
+        room['chat'] = chat_list[:-50]
     else:
-        data['chat'].clear()
+        room['chat'].clear()
+    await refresh_digests(digests)
     
-    await save_data()
+    await save_data(room['id'])
     deleted_count = len(msgs_to_delete)
+    audit('recent_deleted', cb.from_user, room=room['id'], posts=deleted_count)
     await cb.message.edit_text(f'✅ Удалено {deleted_count} последних сообщений у всех пользователей.')
     await cb.answer('Сообщения удалены.')
 
@@ -602,7 +3894,7 @@ async def cb_confirm_reset_data(cb: types.CallbackQuery):
         return
     # Пометить ожидание ввода пароля
     data['admin_action'] = 'reset_pending'
-    await save_data()
+    await save_data('core')
     await cb.message.answer('Введите пароль администратора для подтверждения удаления данных:')
     await cb.answer()
 
@@ -617,7 +3909,7 @@ async def cb_cancel_reset_data(cb: types.CallbackQuery):
     except Exception:
         pass
     data['admin_action'] = None
-    await save_data()
+    await save_data('core')
     await cb.answer('Отменено.')
 
 
@@ -627,10 +3919,11 @@ async def cb_del_submission(cb: types.CallbackQuery):
         await cb.answer('Вы не админ.')
         return
     try:
-        idx = int(cb.data.split('_')[2])
-        if 0 <= idx < len(data.get('chat', [])):
-            data['chat'].pop(idx)
-            await save_data()
+        room_id, msg_id = cb.data.split('_')[2:4]
+        room = get_room(room_id)
+        if remove_chat(room, int(msg_id)) is not None:
+            audit('chat_entry_removed', cb.from_user, room=room['id'], msg=int(msg_id))
+            await save_data(room['id'])
             await cb.message.edit_text('Сообщение удалено из чата.')
         else:
             await cb.answer('Сообщение не найдено.')
@@ -638,6 +3931,126 @@ async def cb_del_submission(cb: types.CallbackQuery):
         await cb.answer('Ошибка.')
 
 
+@dp.callback_query(lambda c: c.data.startswith('purge_'))
+async def cb_purge_author(cb: types.CallbackQuery):
+    # Admin removes the posts of a (banned) author from the chat and from every recipient
+    if cb.from_user.id not in admin_sessions:
+        await cb.answer('Вы не админ.')
+        return
+    try:
+        room_id, author, hours = cb.data.split('_')[1:4]
+        author, hours = int(author), int(hours)
+    except Exception:
+        await cb.answer('Ошибка.')
+        return
+    room = get_room(room_id)
+    since = datetime.now(timezone.utc) - timedelta(hours=hours) if hours else None
+    posts = author_posts(room, author, since)
+    if not posts:
+        await cb.answer('Сообщений не найдено.')
+        return
+    per_recipient = {}
+    for msg in posts:
+        for recip_str, value in (msg.get('delivered') or {}).items():
+            per_recipient.setdefault(int(recip_str), []).extend(delivered_ids(value))
+    await take_snapshot(f"before purge {author} {room['id']}")
+    purged = {m['id'] for m in posts}
+    audit('purge', cb.from_user, room=room['id'], author=author, hours=hours, posts=len(purged),
+          recipients=len(per_recipient))
+    room['chat'] = [m for m in room.get('chat', []) if m['id'] not in purged]
+    for msg_id in purged:
+        search_unindex_post(room, msg_id)
+    digests = digest_copies(posts)
+    await save_data(room['id'])
+    try:
+        await cb.message.edit_reply_markup(reply_markup=None)
+    except Exception:
+        pass
+    status = await cb.message.answer(f'🧹 Удаление {len(posts)} сообщений: 0 из {len(per_recipient)} получателей…')
+    # само удаление у получателей идёт в фоне, история уже очищена
+    asyncio.create_task(purge_delivered(per_recipient, len(posts), status.chat.id, status.message_id))
+    asyncio.create_task(refresh_digests(digests))
+    await cb.answer()
+
+
+# admin id -> (room_id, query) of the last search, for paging
+_admin_searches = {}
+
+
+@dp.callback_query(lambda c: c.data.startswith('search_page_'))
+async def cb_search_page(cb: types.CallbackQuery):
+    if cb.from_user.id not in admin_sessions:
+        await cb.answer('Вы не админ.')
+        return
+    last = _admin_searches.get(cb.from_user.id)
+    if last is None:
+        await cb.answer('Повторите поиск.')
+        return
+    try:
+        text, kb = search_page(get_room(last[0]), last[1], int(cb.data[len('search_page_'):]))
+        await cb.message.edit_text(text, reply_markup=kb)
+    except Exception:
+        pass
+    await cb.answer()
+
+
+@dp.callback_query(lambda c: c.data.startswith('srch_del_'))
+async def cb_search_delete(cb: types.CallbackQuery):
+    # Delete a found post from the history and at every recipient
+    if cb.from_user.id not in admin_sessions:
+        await cb.answer('Вы не админ.')
+        return
+    try:
+        room_id, msg_id = cb.data.split('_')[2:4]
+        room, msg_id = get_room(room_id), int(msg_id)
+    except Exception:
+        await cb.answer('Ошибка.')
+        return
+    msg = remove_chat(room, msg_id)
+    if msg is None:
+        await cb.answer('Сообщение уже удалено.')
+        return
+    delivered = msg.get('delivered') or {}
+    await fan_out(list(delivered.items()), lambda item: delete_delivered(int(item[0]), item[1]), lane='delete',
+                  repeatable=True)
+    await refresh_digests(digest_copies([msg]))
+    audit('chat_entry_removed', cb.from_user, room=room['id'], msg=msg_id, author=msg.get('from_id'),
+          recipients=len(delivered))
+    await save_data(room['id'])
+    last = _admin_searches.get(cb.from_user.id)
+    if last is not None:
+        try:
+            text, kb = search_page(get_room(last[0]), last[1], 0)
+            await cb.message.edit_text(text, reply_markup=kb)
+        except Exception:
+            pass
+    await cb.answer(f'Сообщение #{msg_id} удалено у {len(delivered)} получателей.')
+
+
+@dp.callback_query(lambda c: c.data.startswith('srch_ban_'))
+async def cb_search_ban(cb: types.CallbackQuery):
+    if cb.from_user.id not in admin_sessions:
+        await cb.answer('Вы не админ.')
+        return
+    try:
+        room_id, author = cb.data.split('_')[2:4]
+        room, author = get_room(room_id), int(author)
+    except Exception:
+        await cb.answer('Ошибка.')
+        return
+    if author in room.get('banned', []):
+        await cb.answer('Уже забанен.')
+        return
+    room.setdefault('banned', []).append(author)
+    posts = len(author_posts(room, author))
+    audit('ban', cb.from_user, room=room['id'], target=author, posts=posts)
+    await save_data(room['id'])
+    await cb.message.answer(f'Пользователь {author} забанен. Его сообщений в комнате: {posts}.'
+                            + ('\nУдалить их у всех получателей?' if posts else ''),
+                            reply_markup=purge_kb(room['id'], author) if posts else None)
+    await cb.answer()
+
+
 @dp.callback_query(lambda c: c.data.startswith('complaint_'))
 async def cb_complaint_inline(cb: types.CallbackQuery):
     # User clicked complaint on a specific chat message
@@ -645,27 +4058,51 @@ async def cb_complaint_inline(cb: types.CallbackQuery):
         await cb.answer('Админы не могут отправлять жалобы через эту кнопку.')
         return
     try:
-        idx = int(cb.data.split('_')[1])
+        room_id, msg_id = parse_room_ref(cb.data[len('complaint_'):])
     except Exception:
         await cb.answer('Ошибка.')
         return
     uid = str(cb.from_user.id)
-    data.setdefault('users', {}).setdefault(uid, {})['awaiting_complaint_for'] = idx
-    await save_data()
+    get_user(uid)['awaiting_complaint_for'] = [room_id, msg_id]
+    await save_data('core')
     await cb.message.answer('Опишите, пожалуйста, причину жалобы (коротко):')
     await cb.answer()
 
 
+@dp.callback_query(lambda c: c.data.startswith('delivery_'))
+async def cb_delivery(cb: types.CallbackQuery):
+    try:
+        minutes = int(cb.data[len('delivery_'):])
+    except ValueError:
+        await cb.answer('Ошибка.')
+        return
+    if minutes and minutes not in DIGEST_INTERVALS:
+        await cb.answer('Такого варианта нет.')
+        return
+    uid = str(cb.from_user.id)
+    get_user(uid)['delivery'] = minutes
+    await save_data('core')
+    if not minutes:
+        # накопленное уходит сразу; отдельной задачей, чтобы не ждать блокировку хранилища изнутри обработчика
+        asyncio.create_task(flush_digests(uid))
+    try:
+        await cb.message.edit_text(f'Сообщения будут приходить: {delivery_title(minutes)}.', reply_markup=delivery_kb(minutes))
+    except Exception:
+        pass
+    await cb.answer()
+
+
 @dp.callback_query(lambda c: c.data.startswith('del_chat_'))
 async def cb_del_chat(cb: types.CallbackQuery):
     if cb.from_user.id not in admin_sessions:
         await cb.answer('Вы не админ.')
         return
     try:
-        idx = int(cb.data.split('_')[2])
-        if 0 <= idx < len(data.get('chat', [])):
-            data['chat'].pop(idx)
-            await save_data()
+        room_id, msg_id = cb.data.split('_')[2:4]
+        room = get_room(room_id)
+        if remove_chat(room, int(msg_id)) is not None:
+            audit('chat_entry_removed', cb.from_user, room=room['id'], msg=int(msg_id))
+            await save_data(room['id'])
             await cb.message.edit_text('Сообщение удалено из чата.')
         else:
             await cb.answer('Сообщение не найдено.')
@@ -673,74 +4110,352 @@ async def cb_del_chat(cb: types.CallbackQuery):
         await cb.answer('Ошибка.')
 
 
-def can_send_check(user_id: str) -> tuple[bool, str]:
+@dp.callback_query(lambda c: c.data.startswith('join_room_'))
+async def cb_join_room(cb: types.CallbackQuery):
+    uid = str(cb.from_user.id)
+    room_id = cb.data[len('join_room_'):]
+    if room_id not in data.get('rooms', {}):
+        await cb.answer('Комната не найдена.')
+        return
+    room = data['rooms'][room_id]
+    if cb.from_user.id in room.get('banned', []):
+        await cb.answer('Вы забанены в этой комнате.')
+        return
+    old_room_id = user_room_id(uid)
+    join_room(uid, room_id)
+    # черновик из прежней комнаты больше не актуален
+    data.get('drafts', {}).pop(uid, None)
+    await save_data(old_room_id)
+    await save_data(room_id)
+    await cb.message.answer(f"Вы в комнате «{room.get('title', room_id)}».")
+    await cb.answer()
+    if CATCHUP_ON_JOIN and CATCHUP_POSTS and old_room_id != room_id:
+        asyncio.create_task(catch_up(uid, room_id))
+
+
+@dp.callback_query(lambda c: c.data.startswith('toggle_room_'))
+async def cb_toggle_room(cb: types.CallbackQuery):
+    if cb.from_user.id not in admin_sessions:
+        await cb.answer('Вы не админ.')
+        return
+    room_id = cb.data[len('toggle_room_'):]
+    if room_id not in data.get('rooms', {}):
+        await cb.answer('Комната не найдена.')
+        return
+    settings = data['rooms'][room_id].setdefault('settings', {})
+    settings['enabled'] = not settings.get('enabled', True)
+    audit('room_toggled', cb.from_user, room=room_id, enabled=settings['enabled'])
+    await save_data(room_id)
+    try:
+        await cb.message.edit_reply_markup(reply_markup=rooms_kb(for_admin=True))
+    except Exception:
+        pass
+    await cb.answer('Комната включена.' if settings['enabled'] else 'Комната выключена.')
+
+
+@dp.callback_query(lambda c: c.data == 'create_room')
+async def cb_create_room(cb: types.CallbackQuery):
+    if cb.from_user.id not in admin_sessions:
+        await cb.answer('Вы не админ.')
+        return
+    data['admin_action'] = 'room_create_pending'
+    await save_data('core')
+    await cb.message.answer('Отправьте id комнаты (латиница/цифры, до 16 символов) и название через пробел:')
+    await cb.answer()
+
+
+@dp.message(Command('rooms'))
+async def cmd_rooms(message: types.Message):
+    current = user_room(message.from_user.id)
+    await message.answer(f"Текущая комната: «{current.get('title', current['id'])}». Выберите комнату:",
+                         reply_markup=rooms_kb(for_admin=False))
+
+
+def room_guard(user_id: str, room: dict) -> tuple[bool, str]:
+    """Checks shared by new posts and edits: ban in the room, bot and room switches, accepted terms."""
     uid = int(user_id)
-    if uid in data.get('banned', []):
+    if uid in room.get('banned', []):
         return False, 'Вы забанены.'
     if not data.get('enabled', True):
         return False, 'Бот временно отключён.'
+    if not room.get('settings', {}).get('enabled', True):
+        return False, 'Комната временно отключена.'
     if uid not in data.get('accepted', []):
         return False, 'Примите условия (/start) прежде чем отправлять сообщения.'
-    last = data.get('users', {}).get(user_id, {}).get('last_message')
+    return True, ''
+
+
+def cooldown_check(last, cooldown: int) -> tuple[bool, str]:
     if last:
         try:
             last_dt = datetime.fromisoformat(last)
             diff = (datetime.now(timezone.utc) - last_dt).total_seconds()
-            if diff < 30:
-                return False, f'Антиспам: подождите {int(30-diff)} секунд.'
+            if diff < cooldown:
+                return False, f'Антиспам: подождите {int(cooldown-diff)} секунд.'
         except Exception:
             pass
     return True, ''
 
 
+def can_send_check(user_id: str) -> tuple[bool, str]:
+    room = user_room(user_id)
+    ok, reason = room_guard(user_id, room)
+    if not ok:
+        return ok, reason
+    last = data.get('users', {}).get(user_id, {}).get('last_message')
+    return cooldown_check(last, room.get('settings', {}).get('cooldown', 30))
+
+
+# --- повторы ----------------------------------------------------------------------
+# Отпечаток поста: file_unique_id для медиа (одинаков у всех пересылок одного файла)
+# и 64-битный simhash нормализованного текста — он совпадает и у слегка изменённых копий.
+_WORD_RE = re.compile(r'\w+')
+
+# room_id -> {'src': room, 'media': OrderedDict fuid -> msg id, 'text': OrderedDict simhash -> msg id}
+_dup_windows = {}
+dup_stats = {'checked': 0, 'media_hits': 0, 'text_hits': 0, 'blocked': 0, 'held': 0}
+
+
+def text_simhash(text: str):
+    """simhash over word 3-shingles; None for texts too short to fingerprint reliably."""
+    words = _WORD_RE.findall((text or '').lower())
+    if len(' '.join(words)) < DUP_MIN_TEXT:
+        return None
+    shingles = [' '.join(words[i:i + 3]) for i in range(max(1, len(words) - 2))]
+    weights = [0] * 64
+    for sh in shingles:
+        h = int.from_bytes(hashlib.blake2b(sh.encode('utf-8'), digest_size=8).digest(), 'big')
+        for bit in range(64):
+            weights[bit] += 1 if h >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+def message_fingerprint(message: types.Message) -> dict:
+    if message.content_type == 'photo':
+        return {'media': [message.photo[-1].file_unique_id]}
+    if message.content_type == 'video':
+        return {'media': [message.video.file_unique_id]}
+    sh = text_simhash(message.text)
+    return {'text': format(sh, 'x')} if sh is not None else {}
+
+
+def _dup_window(room: dict) -> dict:
+    win = _dup_windows.get(room['id'])
+    if win is None or win['src'] is not room:
+        win = {'src': room, 'media': OrderedDict(), 'text': OrderedDict()}
+        _dup_windows[room['id']] = win
+        for msg in room.get('chat', [])[-DUP_WINDOW:]:
+            remember_fingerprint(room, msg)
+    return win
+
+
+def remember_fingerprint(room: dict, msg: dict):
+    """Add a published chat entry to the room's window, evicting the least recently seen fingerprints."""
+    fp = msg.get('fp') or {}
+    win = _dup_window(room)
+    keys = [('media', fuid) for fuid in fp.get('media', [])]
+    if fp.get('text'):
+        keys.append(('text', int(fp['text'], 16)))
+    for kind, key in keys:
+        win[kind][key] = msg['id']
+        win[kind].move_to_end(key)
+        while len(win[kind]) > DUP_WINDOW:
+            win[kind].popitem(last=False)
+
+
+def forget_fingerprint(room: dict, msg: dict):
+    """Rebuild the room's window without this chat entry (before its content changes).
+
+    Entries with the same fingerprint share a window key, so removing keys alone could drop another post's.
+    """
+    _dup_windows[room['id']] = {'src': room, 'media': OrderedDict(), 'text': OrderedDict()}
+    for other in room.get('chat', [])[-DUP_WINDOW:]:
+        if other is not msg:
+            remember_fingerprint(room, other)
+
+
+def find_duplicate(room: dict, fp: dict):
+    """Id of a recent chat entry with the same media or near-identical text, else None."""
+    dup_stats['checked'] += 1
+    win = _dup_window(room)
+    for fuid in fp.get('media', []):
+        if fuid in win['media']:
+            win['media'].move_to_end(fuid)
+            dup_stats['media_hits'] += 1
+            return win['media'][fuid]
+    if fp.get('text'):
+        sh = int(fp['text'], 16)
+        for key, msg_id in win['text'].items():
+            if (key ^ sh).bit_count() <= DUP_TEXT_DISTANCE:
+                win['text'].move_to_end(key)
+                dup_stats['text_hits'] += 1
+                return msg_id
+    return None
+
+
+def dup_stats_text() -> str:
+    hits = dup_stats['media_hits'] + dup_stats['text_hits']
+    rate = hits / dup_stats['checked'] if dup_stats['checked'] else 0
+    return (f'Повторы: {hits} из {dup_stats["checked"]} ({rate:.0%}; медиа {dup_stats["media_hits"]}, '
+            f'текст {dup_stats["text_hits"]}), заблокировано {dup_stats["blocked"]}, на проверке {dup_stats["held"]}')
+
+
+def duplicate_kb(uid: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text='✅ Разрешить', callback_data=f'dup_ok_{uid}'),
+        InlineKeyboardButton(text='❌ Отклонить', callback_data=f'dup_no_{uid}'),
+    ]])
+
+
+def check_duplicate(room: dict, fp: dict):
+    return find_duplicate(room, fp) if DUP_ACTION != 'off' else None
+
+
+def dup_note(dup_of) -> str:
+    if dup_of is None:
+        return ''
+    if DUP_ACTION == 'approve':
+        return f'\n\n⚠️ Похожее сообщение (#{dup_of}) уже было в чате — после подтверждения его проверит администратор.'
+    return f'\n\n⚠️ Похожее сообщение (#{dup_of}) уже было в чате недавно.'
+
+
+# (user_id, media_group_id) -> {'items', 'caption', 'message', 'task'}
+_album_buffers = {}
+
+
+def buffer_album_item(uid: str, message: types.Message):
+    """Collect album parts; the draft is created once no new part arrived for ALBUM_WINDOW seconds."""
+    key = (uid, message.media_group_id)
+    buf = _album_buffers.setdefault(key, {'items': [], 'caption': '', 'message': message, 'task': None, 'fuids': []})
+    if message.content_type == 'photo':
+        item = {'type': 'photo', 'file_id': message.photo[-1].file_id}
+    else:
+        item = {'type': 'video', 'file_id': message.video.file_id}
+    buf['fuids'].extend(message_fingerprint(message)['media'])
+    buf['items'].append((message.message_id, item))
+    if message.caption and not buf['caption']:
+        buf['caption'] = message.caption
+    if message.message_id < buf['message'].message_id:
+        buf['message'] = message
+    if buf['task'] is not None:
+        buf['task'].cancel()
+    buf['task'] = asyncio.create_task(_flush_album(key))
+
+
+async def _flush_album(key):
+    await asyncio.sleep(ALBUM_WINDOW)
+    buf = _album_buffers.pop(key, None)
+    if buf is None:
+        return
+    uid = key[0]
+    message = buf['message']
+    items = [item for _, item in sorted(buf['items'], key=lambda p: p[0])][:10]
+    caption = buf['caption']
+    async with store_lock():
+        refresh_data()
+        room = user_room(uid)
+        fp = {'media': buf['fuids']}
+        dup_of = check_duplicate(room, fp)
+        blocked = dup_of is not None and DUP_ACTION == 'block'
+        if blocked:
+            dup_stats['blocked'] += 1
+        else:
+            draft = {'type': 'album', 'content': items, 'caption': caption, 'timestamp': now_ts(), 'room': room['id'],
+                     'src_mid': message.message_id, 'fp': fp}
+            if dup_of is not None:
+                draft['dup_of'] = dup_of
+            target = reply_entry(room, uid, message) if message.reply_to_message else None
+            if target is not None:
+                draft['reply_target_id'] = target['id']
+            put_draft(uid, draft)
+            await save_data(room['id'])
+    if blocked:
+        try:
+            await message.answer('Такой альбом уже был в чате недавно.')
+        except Exception:
+            pass
+        return
+    try:
+        await bot.send_media_group(message.chat.id, album_media(items, caption))
+        preview = await message.answer(f'Вы уверены, что хотите отправить этот альбом ({len(items)} шт.)?' + dup_note(dup_of),
+                                       reply_markup=message_confirm_kb())
+        async with store_lock():
+            refresh_data()
+            await attach_preview(uid, message.message_id, preview.message_id)
+    except Exception:
+        pass
+    log_msg('album', message.from_user, f"file_ids:{','.join(i['file_id'] for i in items)} caption:{caption}")
+
+
 @dp.message()
 async def on_message(message: types.Message):
     uid = str(message.from_user.id)
 
     # Admin entry trigger
     if message.text and message.text.startswith('/admin'):
+        wait = login_blocked_for(uid)
+        if wait:
+            await message.answer(f'Слишком много попыток входа. Попробуйте через {wait // 60 + 1} мин.')
+            return
         await message.answer('Введите пароль администратора:')
         # mark awaiting password in user record
-        data['users'].setdefault(uid, {})['awaiting_admin_password'] = True
-        await save_data()
+        get_user(uid)['awaiting_admin_password'] = True
+        await save_data('core')
         return
 
     # If user is replying with admin password
     if message.text and data['users'].get(uid, {}).pop('awaiting_admin_password', False):
-        if message.text.strip() == ADMIN_PASSWORD:
+        if login_blocked_for(uid):
+            await message.answer('Слишком много попыток входа.')
+        elif message.text.strip() == ADMIN_PASSWORD:
+            login_succeeded(uid)
             admin_sessions.add(int(uid))
-            await message.answer('Доступ в админ-панель предоставлен.', reply_markup=admin_kb)
+            audit('admin_login', message.from_user)
+            pending = len(held_drafts())
+            note = f'\nПовторов ждут решения: {pending} — кнопка «На проверке».' if pending else ''
+            await message.answer('Доступ в админ-панель предоставлен.' + note, reply_markup=admin_kb)
         else:
+            login_failed(uid)
+            audit('admin_login_failed', message.from_user)
             await message.answer('Неверный пароль.')
-        await save_data()
+        await save_data('core')
         return
 
     # Admin actions and keyboard handling (only for logged-in admins)
     if message.from_user.id in admin_sessions and message.text:
         text = message.text
+        # админ работает с комнатой, в которой находится сам
+        room = user_room(uid)
         # Exit
         if text == 'Выход':
             admin_sessions.discard(message.from_user.id)
+            audit('admin_logout', message.from_user)
+            await save_data('core')
             await message.answer('Выход из админ-панели.', reply_markup=ReplyKeyboardRemove())
             return
 
         if text == 'Включить/Выключить бота':
             data['enabled'] = not data.get('enabled', True)
-            await save_data()
+            audit('bot_toggled', message.from_user, enabled=data['enabled'])
+            await save_data('core')
             await message.answer(f"Бот {'включён' if data['enabled'] else 'выключен'}.")
             return
 
         if text == 'Статистика':
             users_count = len(data.get('users', {}))
             drafts = len(data.get('drafts', {}))
-            complaints = len(data.get('complaints', []))
-            chat_msgs = len(data.get('chat', []))
+            complaints = len(complaint_ids(room, 'open'))
+            chat_msgs = len(room.get('chat', []))
             # Вычислить общее количество сообщений от всех пользователей
             total_msgs = sum(u.get('msg_count', 0) for u in data.get('users', {}).values())
-            stats = f'Пользователей: {users_count}\nЧерновиков: {drafts}\nСообщений в чате: {chat_msgs}\nВсего отправлено сообщений: {total_msgs}\nЖалоб: {complaints}'
+            stats = f'Пользователей: {users_count}\nЧерновиков: {drafts}\nВсего отправлено сообщений: {total_msgs}\n\nКомната «{room.get("title", room["id"])}»:\nУчастников: {len(room.get("members", []))}\nСообщений в чате: {chat_msgs}\nОткрытых жалоб: {complaints}\n\n{dup_stats_text()}\n{digest_stats_text()}\n{update_scheduler.stats_text()}\n{send_controller.stats_text()}\n{rate_limiter.stats_text()}\n{api_session.stats_text()}\n{circuit_breaker.stats_text()}'
             await message.answer(stats)
             return
 
+        if text == 'Активность':
+            await message.answer(activity_text())
+            return
+
         if text == 'Пользователи':
             users = data.get('users', {})
             users_count = len(users)
@@ -751,13 +4466,15 @@ async def on_message(message: types.Message):
                 for uid_k, uinfo in users.items():
                     uname = uinfo.get('username')
                     display_name = f'@{uname}' if uname else f'ID {uid_k}'
-                    banned = ' (забанен)' if int(uid_k) in data.get('banned', []) else ''
+                    user_room_ = get_room(uinfo.get('room') or DEFAULT_ROOM)
+                    banned = ' (забанен)' if int(uid_k) in user_room_.get('banned', []) else ''
                     msg_count = uinfo.get('msg_count', 0)
-                    users_list.append(f'{display_name} - {msg_count} соо{banned}')
+                    users_list.append(f"{display_name} - {msg_count} соо [{user_room_['id']}]{banned}")
                 await message.answer(f'Пользователей: {users_count}\n\n' + '\n'.join(users_list))
             return
 
         if text == 'Остановить бота':
+            audit('shutdown', message.from_user)
             await message.answer('Останавливаю бота...')
             await asyncio.sleep(0.5)
             await message.answer('Бот остановлен.')
@@ -771,53 +4488,40 @@ async def on_message(message: types.Message):
             return
 
         if text == 'Просмотр жалоб':
-            if not data.get('complaints'):
+            if not room.get('complaints'):
                 await message.answer('Жалоб нет.')
             else:
-                for idx, c in enumerate(data.get('complaints', [])):
-                    user_id = c.get('from')
-                    user_info = data.get('users', {}).get(str(user_id), {})
-                    uname = user_info.get('username') or f'ID {user_id}'
-                    del_kb = InlineKeyboardMarkup(inline_keyboard=[
-                        [
-                            InlineKeyboardButton(text='✉️ Ответить', callback_data=f'reply_complaint_{idx}'),
-                            InlineKeyboardButton(text='🗑️ Удалить сообщение', callback_data=f'delete_msg_{idx}'),
-                        ],
-                        [
-                            InlineKeyboardButton(text='⚠️ Удалить жалобу', callback_data=f'del_complaint_{idx}'),
-                            InlineKeyboardButton(text='⏭️ Пропустить', callback_data=f'skip_complaint_{idx}'),
-                        ],
-                    ])
-                    target = c.get('target')
-                    if target is not None and 0 <= target < len(data.get('chat', [])):
-                        tmsg = data['chat'][target]
-                        t_uname = tmsg.get('username') or f'ID {tmsg.get("from_id")}'
-                        msg_type = tmsg.get('type')
-                        caption_text = f"Жалоба #{idx} от @{uname} ({user_id})\nНа сообщение #{target} от @{t_uname}:\nПричина: {c.get('text')}"
-                        
-                        if msg_type == 'text':
-                            t_preview = tmsg.get('content')
-                            await message.answer(f"Жалоба #{idx} от @{uname} ({user_id}):\nНа сообщение #{target} от @{t_uname}:\n{t_preview}\nПричина: {c.get('text')}", reply_markup=del_kb)
-                        elif msg_type == 'photo':
-                            await bot.send_photo(message.chat.id, tmsg.get('content'), caption=caption_text, reply_markup=del_kb)
-                        elif msg_type == 'video':
-                            await bot.send_video(message.chat.id, tmsg.get('content'), caption=caption_text, reply_markup=del_kb)
-                    else:
-                        await message.answer(f"Жалоба #{idx} от @{uname} ({user_id}):\n{c.get('text')}", reply_markup=del_kb)
+                page_text, kb = complaints_page(room, 'open', 0)
+                await message.answer(page_text, reply_markup=kb)
+            return
+
+        if text == 'На проверке':
+            pending = held_drafts()
+            if not pending:
+                await message.answer('Повторов на проверке нет.')
+                return
+            for uid_k, draft in pending:
+                try:
+                    await send_held_draft(message.chat.id, uid_k, draft, get_room(draft.get('room') or user_room_id(uid_k)))
+                except Exception:
+                    pass
             return
 
         if text == 'История чата':
-            chats = data.get('chat', [])
+            chats = room.get('chat', [])
             if not chats:
                 await message.answer('История чата пуста.')
             else:
                     # Aggregate chat history into a single message (with fallback to chunking)
                     parts = []
-                    for idx, msg in enumerate(chats):
+                    for msg in chats:
                         uname = msg.get('username')
                         display_name = f'@{uname}' if uname else f'ID {msg["from_id"]}'
                         if msg['type'] == 'text':
                             body = msg.get('content', '')
+                        elif msg['type'] == 'album':
+                            caption = msg.get('caption') or ''
+                            body = f"album ({len(msg['content'])}) file_ids {', '.join(i['file_id'] for i in msg['content'])}" + (f" caption: {caption}" if caption else '')
                         else:
                             caption = msg.get('caption') or ''
                             body = f"{msg['type']} file_id {msg.get('content')}" + (f" caption: {caption}" if caption else '')
@@ -828,7 +4532,7 @@ async def on_message(message: types.Message):
                             time_str = ts_ekb.strftime('%H:%M:%S')
                         except Exception:
                             time_str = msg['timestamp']
-                        parts.append(f"{idx+1}. {display_name} ({msg['from_id']}) в {time_str}:\n{body}")
+                        parts.append(f"{msg['id']}. {display_name} ({msg['from_id']}) в {time_str}:\n{body}")
 
                     combined = '\n\n'.join(parts)
                     # Telegram max message length ~4096; use safe limit
@@ -860,8 +4564,10 @@ async def on_message(message: types.Message):
             return
 
         if text == 'Очистка чата':
-            data['drafts'].clear()
-            await save_data()
+            audit('drafts_cleared', message.from_user, drafts=len(data.get('drafts', {})))
+            for draft_uid in list(data.get('drafts', {})):
+                expire_draft(draft_uid)
+            await save_data('core')
             await message.answer('Все черновики пользователей удалены.')
             return
 
@@ -869,18 +4575,18 @@ async def on_message(message: types.Message):
             # Удалить всю историю чата
             confirm_kb = InlineKeyboardMarkup(inline_keyboard=[
                 [
-                    InlineKeyboardButton(text='✅ Да, стереть', callback_data='confirm_clear_history'),
+                    InlineKeyboardButton(text='✅ Да, стереть', callback_data=f"confirm_clear_history_{room['id']}"),
                     InlineKeyboardButton(text='❌ Отмена', callback_data='cancel_clear_history'),
                 ],
             ])
-            await message.answer('⚠️ Вы уверены? Это удалит всю историю сообщений навсегда!', reply_markup=confirm_kb)
+            await message.answer(f"⚠️ Вы уверены? Это удалит всю историю сообщений комнаты «{room.get('title', room['id'])}» навсегда!", reply_markup=confirm_kb)
             return
 
         if text == 'Удалить все сообщения':
             # Удалить последние 50 сообщений у всех пользователей
             confirm_kb = InlineKeyboardMarkup(inline_keyboard=[
                 [
-                    InlineKeyboardButton(text='✅ Да, удалить', callback_data='confirm_delete_all_msgs'),
+                    InlineKeyboardButton(text='✅ Да, удалить', callback_data=f"confirm_delete_all_msgs_{room['id']}"),
                     InlineKeyboardButton(text='❌ Отмена', callback_data='cancel_delete_all_msgs'),
                 ],
             ])
@@ -901,66 +4607,126 @@ async def on_message(message: types.Message):
         if text == 'Бан/Разбан':
             data['admin_action'] = 'ban_pending'
             await message.answer('Отправьте ID пользователя для бан/разбан:')
-            await save_data()
+            await save_data('core')
             return
 
         if text == 'Рассылка':
             data['admin_action'] = 'broadcast_pending'
             await message.answer('Отправьте текст рассылки:')
-            await save_data()
+            await save_data('core')
+            return
+
+        if text == 'Поиск':
+            data['admin_action'] = 'search_pending'
+            await message.answer('Что искать? Слова и фильтры: author:<id или @ник> type:text|photo|video|album '
+                                 'from:ГГГГ-ММ-ДД to:ГГГГ-ММ-ДД')
+            await save_data('core')
+            return
+
+        if text == 'Снимки':
+            snaps = list_snapshots()[:10]
+            if not snaps:
+                await message.answer('Снимков пока нет.')
+            else:
+                await message.answer('Последние снимки данных (нажмите, чтобы восстановить):', reply_markup=snapshots_kb(snaps))
+            return
+
+        if text == 'Комнаты':
+            await message.answer(f"Текущая комната: «{room.get('title', room['id'])}». Комнаты:",
+                                 reply_markup=rooms_kb(for_admin=True))
             return
 
     # Handle pending admin actions (ban or broadcast)
     if message.from_user.id in admin_sessions:
+        room = user_room(uid)
         if data.get('admin_action') == 'ban_pending':
             try:
                 target = int(message.text.strip())
-                if target in data.get('banned', []):
-                    data['banned'].remove(target)
+                if target in room.get('banned', []):
+                    room['banned'].remove(target)
+                    audit('unban', message.from_user, room=room['id'], target=target)
                     await message.answer(f'Пользователь {target} разбанен.')
                 else:
-                    data.setdefault('banned', []).append(target)
-                    await message.answer(f'Пользователь {target} забанен.')
+                    room.setdefault('banned', []).append(target)
+                    posts = len(author_posts(room, target))
+                    audit('ban', message.from_user, room=room['id'], target=target, posts=posts)
+                    await message.answer(f'Пользователь {target} забанен. Его сообщений в комнате: {posts}.'
+                                         + ('\nУдалить их у всех получателей?' if posts else ''),
+                                         reply_markup=purge_kb(room['id'], target) if posts else None)
                 data['admin_action'] = None
-                await save_data()
+                await save_data(room['id'])
             except Exception:
                 await message.answer('Неверный ID.')
             return
 
+        if data.get('admin_action') == 'search_pending':
+            data['admin_action'] = None
+            query_text = (message.text or '').strip()
+            try:
+                page_text, kb = search_page(room, query_text, 0)
+            except ValueError:
+                await message.answer('Неверная дата, нужен формат ГГГГ-ММ-ДД.')
+                return
+            _admin_searches[message.from_user.id] = (room['id'], query_text)
+            await message.answer(page_text, reply_markup=kb)
+            return
+
+        if data.get('admin_action') == 'room_create_pending':
+            parts = (message.text or '').strip().split(maxsplit=1)
+            room_id = parts[0].lower() if parts else ''
+            # 'core' зарезервировано: save_data('core') сохраняет только общий документ
+            if not ROOM_ID_RE.match(room_id) or room_id == 'core':
+                await message.answer('Неверный id комнаты.')
+            elif room_id in data.get('rooms', {}):
+                await message.answer('Такая комната уже есть.')
+            else:
+                data['rooms'][room_id] = new_room(room_id, parts[1] if len(parts) > 1 else room_id)
+                audit('room_created', message.from_user, room=room_id)
+                await message.answer(f'Комната {room_id} создана.', reply_markup=rooms_kb(for_admin=True))
+            data['admin_action'] = None
+            await save_data(room_id if room_id in data.get('rooms', {}) else room['id'])
+            return
+
         if data.get('admin_action') == 'broadcast_pending':
             text = message.text or ''
-            sent = 0
-            for uid_k in list(data.get('users', {}).keys()):
-                try:
-                    await bot.send_message(int(uid_k), f'Рассылка от админа:\n{text}')
-                    sent += 1
-                except Exception:
-                    pass
+
+            async def send_notice(member):
+                await bot.send_message(member, f'Рассылка от админа:\n{text}')
+
+            result = await fan_out(list(room.get('members', [])), send_notice)
             data['admin_action'] = None
-            await message.answer(f'Рассылка отправлена ({sent}).')
+            audit('broadcast', message.from_user, room=room['id'], sent=result['sent'], dropped=result['dropped'],
+                  retried=result['retried'], **({'content': text} if AUDIT_LOG_CONTENT else {}))
+            await message.answer(f'Рассылка отправлена ({result["sent"]} из {result["total"]}, '
+                                 f'за {result["seconds"]:.0f} с; не доставлено {result["dropped"]}).')
             return
 
         if data.get('admin_action') == 'reply_complaint_pending':
-            target = data.get('admin_action_target')
             try:
-                comps = data.get('complaints', [])
-                if target is None or not (0 <= int(target) < len(comps)):
+                room_id, target = data.get('admin_action_target') or [None, None]
+                comp = get_room(room_id).get('complaints', {}).get(str(target))
+                if comp is None:
                     await message.answer('Целевая жалоба не найдена.')
                 else:
-                    comp = comps[int(target)]
-                    target_user = comp.get('from')
-                    reply_text = message.text or ''
-                    reporter_name = comp.get('from_username') or f'ID {target_user}'
-                    try:
-                        # Send anonymous reply from admin (do not reveal admin identity)
-                        send_text = f'Ответ от администратора:\n\n{reply_text}'
-                        await bot.send_message(int(target_user), send_text)
-                        await message.answer('Ответ отправлен заявителю.')
-                    except Exception:
+                    # Send anonymous reply from admin (do not reveal admin identity)
+                    send_text = f'Ответ от администратора:\n\n{message.text or ""}'
+                    reporters = complaint_reporters(comp)
+                    delivered = []
+
+                    async def send_reply(reporter):
+                        await bot.send_message(int(reporter), send_text)
+                        delivered.append(reporter)
+
+                    await fan_out(reporters, send_reply, lane='interactive')
+                    audit('complaint_replied', message.from_user, room=room_id, complaint=int(target),
+                          reporters=len(delivered))
+                    if delivered:
+                        await message.answer(f'Ответ отправлен заявителям ({len(delivered)} из {len(reporters)}).')
+                    else:
                         await message.answer('Не удалось отправить ответ заявителю.')
                 data['admin_action'] = None
                 data['admin_action_target'] = None
-                await save_data()
+                await save_data('core')
             except Exception:
                 await message.answer('Ошибка при отправке ответа.')
             return
@@ -969,30 +4735,27 @@ async def on_message(message: types.Message):
             try:
                 # Проверяем введённый пароль
                 if message.text and message.text.strip() == ADMIN_PASSWORD:
-                    # Запись в audit.log (без бэкапа)
-                    try:
-                        with open('audit.log', 'a', encoding='utf-8') as al:
-                            al.write("no_backup\n")
-                    except Exception:
-                        pass
+                    snap = await take_snapshot('before reset')
+                    audit('reset', message.from_user, snapshot=snap['id'], users=len(data.get('users', {})),
+                          rooms=len(data.get('rooms', {})))
                     # Сброс данных в память и сохранение (новая структура)
                     new_data = {
                         'users': {},
                         'drafts': {},
-                        'chat': [],
-                        'complaints': [],
-                        'banned': [],
                         'accepted': [],
                         'enabled': True,
+                        'rooms': {DEFAULT_ROOM: new_room(DEFAULT_ROOM, 'Общий чат')},
+                        'admin_sessions': data.get('admin_sessions', {}),
                     }
                     data.clear()
                     data.update(new_data)
                     await save_data()
                     await message.answer('✅ Все данные удалены.')
                 else:
+                    audit('reset_denied', message.from_user)
                     await message.answer('Неверный пароль. Операция отменена.')
                 data['admin_action'] = None
-                await save_data()
+                await save_data('core')
             except Exception:
                 await message.answer('Ошибка при выполнении операции.')
             return
@@ -1011,13 +4774,20 @@ async def on_message(message: types.Message):
         help_text = (
             '📋 МЕНЮ И СПРАВКА:\n\n'
             '👤 ОТПРАВКА СООБЩЕНИЙ:\n'
-            '- Отправьте текст, фото или видео\n'
+            '- Отправьте текст, фото, видео или альбом\n'
             '- Появится превью и кнопка подтверждения\n'
             '- После подтверждения сообщение станет анонимным\n'
             '- Лимит: 1 сообщение на 30 секунд (антиспам)\n\n'
             '⚠️ ЖАЛОБЫ:\n'
             '- Нажмите "⚠️ Пожаловаться" под сообщением\n'
-            '- Или используйте кнопку "⚠️ Пожаловаться"\n\n'
+            '- Или используйте кнопку "⚠️ Пожаловаться"\n'
+            '- На альбом — ответьте на него кнопкой "⚠️ Пожаловаться"\n\n'
+            '🚪 КОМНАТЫ:\n'
+            '- "🚪 Комнаты" или /rooms — выбрать другой анонимный чат\n\n'
+            '🔔 ДОСТАВКА:\n'
+            '- "🔔 Доставка" — получать сообщения сразу или дайджестом раз в N минут\n'
+            '- "📜 Недавнее" — прислать последние сообщения комнаты, которых у вас нет\n'
+            '- Чтобы ответить на пост из дайджеста, ответьте на дайджест, выделив цитату из этого поста\n\n'
             '⚠️ ПРАВИЛА:\n'
             '- Мы не поддерживаем публикацию материалов без согласия изображённых лиц (фото/видео).\n'
             '- Такие материалы могут быть удалены по просьбе через жалобу с объяснением причины.\n'
@@ -1031,9 +4801,34 @@ async def on_message(message: types.Message):
         await message.answer(help_text, reply_markup=user_kb)
         return
 
+    if message.text == '🚪 Комнаты':
+        await cmd_rooms(message)
+        return
+
+    if message.text == '📜 Недавнее':
+        if CATCHUP_POSTS:
+            # отдельной задачей: посты идут с низким приоритетом и не держат очередь обновлений пользователя
+            asyncio.create_task(catch_up(uid, user_room_id(uid), notify=True))
+        return
+
+    if message.text == '🔔 Доставка':
+        minutes = delivery_interval(uid)
+        await message.answer(f'Сейчас сообщения приходят: {delivery_title(minutes)}. Как их получать?',
+                             reply_markup=delivery_kb(minutes))
+        return
+
     if message.text == '⚠️ Пожаловаться':
-        data['users'].setdefault(uid, {})['awaiting_complaint'] = True
-        await save_data()
+        # кнопка, нажатая ответом на сообщение из чата (например, на альбом), — жалоба на него
+        if message.reply_to_message:
+            room = user_room(uid)
+            chat_msg = reply_entry(room, uid, message)
+            if chat_msg is not None:
+                get_user(uid)['awaiting_complaint_for'] = [room['id'], chat_msg['id']]
+                await save_data('core')
+                await message.answer('Опишите, пожалуйста, причину жалобы (коротко):')
+                return
+        get_user(uid)['awaiting_complaint'] = True
+        await save_data('core')
         await message.answer('Отправьте текст жалобы (коротко):')
         return
 
@@ -1041,48 +4836,20 @@ async def on_message(message: types.Message):
     awaiting_for = data.get('users', {}).get(uid, {}).pop('awaiting_complaint_for', None)
     awaiting_general = data.get('users', {}).get(uid, {}).pop('awaiting_complaint', False)
     if awaiting_for is not None or awaiting_general:
-        comp = {
+        if isinstance(awaiting_for, int):
+            # ожидание, сохранённое до появления комнат: индекс в общем чате
+            awaiting_for = [DEFAULT_ROOM, awaiting_for + 1]
+        room = get_room(awaiting_for[0]) if awaiting_for is not None else user_room(uid)
+        report = {
             'from': int(uid),
             'from_username': data.get('users', {}).get(uid, {}).get('username'),
             'text': message.text or '',
             'timestamp': now_ts(),
-            'target': None,
         }
-        if awaiting_for is not None:
-            comp['target'] = int(awaiting_for)
-        data.setdefault('complaints', []).append(comp)
-        await save_data()
-        # notify admin sessions with details (show clickable @username when available)
-        for adm in list(admin_sessions):
-            try:
-                # Конвертировать время в Екатеринбург и форматировать
-                try:
-                    ts_utc = datetime.fromisoformat(comp['timestamp'])
-                    ts_ekb = ts_utc.replace(tzinfo=timezone.utc).astimezone(timezone(timedelta(hours=5)))
-                    time_str = ts_ekb.strftime('%d.%m.%Y %H:%M:%S')
-                except Exception:
-                    time_str = comp['timestamp']
-                
-                reporter_uname = comp.get('from_username')
-                reporter_display = f'@{reporter_uname}' if reporter_uname else f'ID {comp["from"]}'
-                if comp.get('target') is not None and 0 <= comp['target'] < len(data.get('chat', [])):
-                    target_msg = data['chat'][comp['target']]
-                    t_uname = target_msg.get('username')
-                    target_display = f'@{t_uname}' if t_uname else f'ID {target_msg.get("from_id")}'
-                    msg_type = target_msg.get('type')
-                    caption_text = f'Новая жалоба от {reporter_display} ({comp["from"]})\nНа сообщение #{comp["target"]} от {target_display}:\nПричина: {comp["text"]}\nВремя: {time_str}'
-                    
-                    if msg_type == 'text':
-                        target_preview = target_msg.get('content')
-                        await bot.send_message(adm, f'Новая жалоба от {reporter_display} ({comp["from"]})\nНа сообщение #{comp["target"]} от {target_display}:\n{target_preview}\nПричина: {comp["text"]}\nВремя: {time_str}')
-                    elif msg_type == 'photo':
-                        await bot.send_photo(adm, target_msg.get('content'), caption=caption_text)
-                    elif msg_type == 'video':
-                        await bot.send_video(adm, target_msg.get('content'), caption=caption_text)
-                else:
-                    await bot.send_message(adm, f'Новая жалоба от {reporter_display} ({comp["from"]})\nПричина: {comp["text"]}\nВремя: {time_str}')
-            except Exception:
-                pass
+        target = int(awaiting_for[1]) if awaiting_for is not None else None
+        comp = add_complaint_report(room, target, report)
+        await save_data(room['id'])
+        schedule_complaint_notice(room['id'], str(comp['id']))
         await message.answer('Жалоба отправлена администраторам.', reply_markup=user_kb)
         return
 
@@ -1097,67 +4864,357 @@ async def on_message(message: types.Message):
         if not ok:
             await message.answer(reason)
             return
+        room = user_room(uid)
+        if message.media_group_id and message.content_type in ('photo', 'video'):
+            buffer_album_item(uid, message)
+            return
+        fp = message_fingerprint(message)
+        dup_of = check_duplicate(room, fp)
+        if dup_of is not None and DUP_ACTION == 'block':
+            dup_stats['blocked'] += 1
+            await message.answer('Такое сообщение уже было в чате недавно.')
+            return
         if message.content_type == 'text':
             content = message.text
             t = 'text'
             # save draft
-            data.setdefault('drafts', {})[uid] = {'type': t, 'content': content, 'timestamp': now_ts()}
+            put_draft(uid, {'type': t, 'content': content, 'timestamp': now_ts()})
         elif message.content_type == 'photo':
             file_id = message.photo[-1].file_id
             caption = message.caption or ''
             t = 'photo'
             # save draft with caption
-            data.setdefault('drafts', {})[uid] = {'type': t, 'content': file_id, 'caption': caption, 'timestamp': now_ts()}
+            put_draft(uid, {'type': t, 'content': file_id, 'caption': caption, 'timestamp': now_ts()})
             content = file_id
         else:
             file_id = message.video.file_id
             caption = message.caption or ''
             t = 'video'
-            data.setdefault('drafts', {})[uid] = {'type': t, 'content': file_id, 'caption': caption, 'timestamp': now_ts()}
+            put_draft(uid, {'type': t, 'content': file_id, 'caption': caption, 'timestamp': now_ts()})
             content = file_id
-        data.setdefault('users', {}).setdefault(uid, {})
+        get_user(uid)
+        data['drafts'][uid]['room'] = room['id']
+        data['drafts'][uid]['src_mid'] = message.message_id
+        data['drafts'][uid]['fp'] = fp
+        if dup_of is not None:
+            data['drafts'][uid]['dup_of'] = dup_of
         
-        # Сохранить индекс целевого сообщения в чате если это ответ
+        # Сохранить id целевого сообщения в чате если это ответ
         if message.reply_to_message:
-            # Найти целевое сообщение в истории чата по message_id в личном чате отправителя
-            target_msg_id = message.reply_to_message.message_id
-            for idx, chat_msg in enumerate(data.get('chat', [])):
-                if chat_msg.get('delivered', {}).get(uid) == target_msg_id:
-                    data['drafts'][uid]['reply_target_idx'] = idx
-                    break
+            # Найти целевое сообщение в истории комнаты по message_id в личном чате отправителя
+            chat_msg = reply_entry(room, uid, message)
+            if chat_msg is not None:
+                data['drafts'][uid]['reply_target_id'] = chat_msg['id']
         
-        await save_data()
+        await save_data(room['id'])
         # prepare confirmation inline keyboard
-        confirm_kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text='✅ Отправить', callback_data='confirm_send')],
-            [InlineKeyboardButton(text='❌ Отменить', callback_data='cancel_send')],
-        ])
+        confirm_kb = message_confirm_kb()
         # show preview and confirmation to the sender (anonymous for others)
         if t == 'text':
-            await message.answer(f'Вы уверены, что хотите отправить следующее сообщение?\n\n{content}', reply_markup=confirm_kb)
+            preview = await message.answer(preview_text(t, content) + dup_note(dup_of), reply_markup=confirm_kb)
             log_msg(t, message.from_user, content)
         elif t == 'photo':
-            preview_caption = f"Вы уверены, что хотите отправить это фото?\n\n{caption}" if caption else 'Вы уверены, что хотите отправить это фото?'
-            await message.reply_photo(content, caption=preview_caption, reply_markup=confirm_kb)
+            preview = await message.reply_photo(content, caption=preview_text(t, caption) + dup_note(dup_of), reply_markup=confirm_kb)
             log_msg(t, message.from_user, f'file_id:{content} caption:{caption}')
         else:
-            preview_caption = f"Вы уверены, что хотите отправить это видео?\n\n{caption}" if caption else 'Вы уверены, что хотите отправить это видео?'
-            await message.reply_video(content, caption=preview_caption, reply_markup=confirm_kb)
+            preview = await message.reply_video(content, caption=preview_text(t, caption) + dup_note(dup_of), reply_markup=confirm_kb)
             log_msg(t, message.from_user, f'file_id:{content} caption:{caption}')
+        # превью с кнопками подтверждения: его обновляют правки черновика
+        await attach_preview(uid, message.message_id, preview.message_id)
+        return
+
+
+def preview_text(msg_type: str, body: str) -> str:
+    if msg_type == 'text':
+        return f'Вы уверены, что хотите отправить следующее сообщение?\n\n{body}'
+    question = 'Вы уверены, что хотите отправить это фото?' if msg_type == 'photo' else 'Вы уверены, что хотите отправить это видео?'
+    return f"{question}\n\n{body}" if body else question
+
+
+@dp.edited_message()
+async def on_edited_message(message: types.Message):
+    uid = str(message.from_user.id)
+    if message.content_type == 'text':
+        new_content, new_caption = message.text, None
+    elif message.content_type == 'photo':
+        new_content, new_caption = message.photo[-1].file_id, message.caption or ''
+    elif message.content_type == 'video':
+        new_content, new_caption = message.video.file_id, message.caption or ''
+    else:
+        return
+
+    # ещё не отправленный черновик: обновить его и превью
+    draft = data.get('drafts', {}).get(uid)
+    if draft and draft.get('src_mid') == message.message_id and draft['type'] == message.content_type:
+        if draft.get('held'):
+            # администратор решает по тому, что видел в карточке, — менять это нельзя
+            await message.answer('Сообщение уже на проверке у администратора, правка не применена.')
+            return
+        fp = message_fingerprint(message)
+        dup_of = check_duplicate(get_room(draft.get('room') or user_room_id(uid)), fp)
+        if dup_of is not None and DUP_ACTION == 'block':
+            dup_stats['blocked'] += 1
+            await message.answer('Такое сообщение уже было в чате недавно. Правка не применена.')
+            return
+        draft['content'] = new_content
+        if new_caption is not None:
+            draft['caption'] = new_caption
+        draft['fp'] = fp
+        if dup_of is not None:
+            draft['dup_of'] = dup_of
+        else:
+            draft.pop('dup_of', None)
+        await save_data(draft.get('room'))
+        if draft.get('confirm_mid'):
+            try:
+                if draft['type'] == 'text':
+                    await bot.edit_message_text(text=preview_text('text', new_content) + dup_note(dup_of),
+                                                chat_id=message.chat.id, message_id=draft['confirm_mid'],
+                                                reply_markup=message_confirm_kb())
+                else:
+                    media_cls = InputMediaPhoto if draft['type'] == 'photo' else InputMediaVideo
+                    await bot.edit_message_media(media=media_cls(media=new_content,
+                                                                 caption=preview_text(draft['type'], new_caption) + dup_note(dup_of)),
+                                                 chat_id=message.chat.id, message_id=draft['confirm_mid'],
+                                                 reply_markup=message_confirm_kb())
+            except Exception:
+                pass
         return
 
+    # уже опубликованное сообщение: сначала комната автора, затем остальные; правки обычно касаются свежих постов
+    own = user_room_id(uid)
+    rooms = [data['rooms'][own]] + [r for rid, r in data.get('rooms', {}).items() if rid != own]
+    for room in rooms:
+        for chat_msg in reversed(room.get('chat', [])):
+            if chat_msg.get('from_id') != message.from_user.id or chat_msg.get('src_mid') != message.message_id:
+                continue
+            # без отдельного антиспама: серию правок схлопывает schedule_edit, наружу уходит только последняя
+            ok, reason = room_guard(uid, room)
+            if not ok:
+                await message.answer(reason + ' Правка не применена.')
+                return
+            if chat_msg['type'] == 'album':
+                if new_caption is None:
+                    return
+                chat_msg['caption'] = new_caption
+            elif chat_msg['type'] != message.content_type:
+                return
+            else:
+                # правкой нельзя превратить пост в повтор другого: отпечаток считается заново
+                fp = message_fingerprint(message)
+                forget_fingerprint(room, chat_msg)
+                dup_of = check_duplicate(room, fp)
+                if dup_of is not None and DUP_ACTION in ('block', 'approve'):
+                    remember_fingerprint(room, chat_msg)
+                    dup_stats['blocked'] += 1
+                    await message.answer(f'Похожее сообщение (#{dup_of}) уже было в чате недавно. Правка не применена.')
+                    return
+                chat_msg['content'] = new_content
+                if new_caption is not None:
+                    chat_msg['caption'] = new_caption
+                chat_msg['fp'] = fp
+                remember_fingerprint(room, chat_msg)
+            chat_msg['edited'] = now_ts()
+            search_index_post(room, chat_msg)
+            await save_data(room['id'])
+            schedule_edit(room['id'], chat_msg['id'])
+            return
+
+
+# --- workers: python bot.py --frontend + python bot.py --worker 0..WORKERS-1 (STORE_BACKEND=sqlite) ---
+def update_shard(update: dict) -> int:
+    # все обновления одного пользователя обрабатывает один воркер — порядок сохраняется
+    for key in ('message', 'edited_message', 'callback_query', 'my_chat_member', 'inline_query'):
+        obj = update.get(key)
+        if obj and obj.get('from'):
+            return obj['from']['id'] % WORKERS
+    return 0
+
+
+def enqueue_update(update: dict):
+    _db().execute('INSERT INTO updates (shard, body) VALUES (?, ?)',
+                  (update_shard(update), json.dumps(update, ensure_ascii=False)))
+
+
+def enqueue_fanout(room_id: str, msg_id: int):
+    # по задаче на каждый воркер: получатель m достаётся воркеру m % WORKERS
+    for shard in range(WORKERS):
+        _db().execute('INSERT INTO jobs (shard, room, msg_id) VALUES (?, ?, ?)', (shard, room_id, msg_id))
+
+
+async def run_fanout_job(job_id: int, room_id: str, msg_id: int):
+    async with store_lock():
+        refresh_data()
+        room = data.get('rooms', {}).get(room_id)
+        msg = find_chat(room, msg_id) if room is not None else None
+        if msg is None:
+            _db().execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+            return
+        done = msg.get('delivered', {})
+        recipients = [m for m in room.get('members', []) if m % WORKERS == WORKER_SHARD and str(m) not in done]
+        # очередь дайджестов пишется сразу: после рассылки комната будет перечитана
+        queued = len(recipients)
+        recipients = queue_digest(room, msg, recipients)
+        if len(recipients) < queued:
+            await save_data(room_id)
+        snapshot = dict(msg, delivered={})
+    # рассылка идёт без блокировки, остальные воркеры в это время обрабатывают обновления
+    await broadcast_entry(room, snapshot, recipients, digest=False)
+    async with store_lock():
+        refresh_data()
+        room = data.get('rooms', {}).get(room_id)
+        msg = find_chat(room, msg_id) if room is not None else None
+        if msg is not None:
+            msg.setdefault('delivered', {}).update(snapshot['delivered'])
+            await save_data(room_id)
+        _db().execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+
+async def fanout_job_loop():
+    while True:
+        row = _db().execute('SELECT id, room, msg_id FROM jobs WHERE shard = ? ORDER BY id LIMIT 1', (WORKER_SHARD,)).fetchone()
+        if row is None:
+            await asyncio.sleep(0.2)
+            continue
+        try:
+            await run_fanout_job(*row)
+        except Exception as e:
+            print(f'Fan-out job {row[0]} failed: {e}')
+            await asyncio.sleep(1)
+
+
+async def worker_main():
+    if not hold_store():
+        raise SystemExit('The store is being restored from a snapshot (--restore); start the bot after it finishes.')
+    start_audit_log()
+    # токен бота общий: каждый воркер получает свою долю SEND_RATE
+    rate_limiter.rate = rate_limiter.tokens = SEND_RATE / WORKERS
+    await load_data()
+    load_activity()
+    asyncio.create_task(activity_loop())
+    asyncio.create_task(fanout_job_loop())
+    asyncio.create_task(draft_expiry_loop())
+    if SNAPSHOT_INTERVAL and WORKER_SHARD == 0:
+        asyncio.create_task(snapshot_loop())
+    if WORKER_SHARD == 0:
+        asyncio.create_task(digest_loop())
+    print(f'Воркер {WORKER_SHARD}/{WORKERS} запущен')
+    db = _db()
+    while True:
+        row = db.execute('SELECT id, body FROM updates WHERE shard = ? ORDER BY id LIMIT 1', (WORKER_SHARD,)).fetchone()
+        if row is None:
+            await asyncio.sleep(0.1)
+            continue
+        # состояние меняется под блокировкой хранилища; на время каждого вызова Bot API
+        # транзакция фиксируется и блокировка отпускается (StoreReleaseMiddleware),
+        # так что воркеры не ждут чужих сетевых запросов
+        async with store_lock() as tx:
+            refresh_data()
+            token = store_tx.set((tx, asyncio.current_task()))
+            try:
+                await dp.feed_raw_update(bot, json.loads(row[1]))
+            except Exception as e:
+                print(f'Update {row[0]} failed: {e}')
+                # незафиксированные изменения упавшего обработчика откатываются
+                await tx.rollback()
+            finally:
+                store_tx.reset(token)
+            db.execute('DELETE FROM updates WHERE id = ?', (row[0],))
+
+
+async def frontend_main():
+    _db()
+    if WEBHOOK_URL:
+        from aiohttp import web
+
+        async def on_update(request):
+            # принимаем только запросы Telegram: он присылает секрет, заданный в set_webhook
+            if not hmac.compare_digest(request.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), WEBHOOK_SECRET):
+                return web.Response(status=403)
+            enqueue_update(await request.json())
+            return web.Response()
+
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, on_update)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, port=WEBHOOK_PORT).start()
+        await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+        print(f'Фронтенд: вебхук {WEBHOOK_URL}, {WORKERS} воркеров')
+        await asyncio.Event().wait()
+    await bot.delete_webhook()
+    print(f'Фронтенд: polling, {WORKERS} воркеров')
+    offset = None
+    while True:
+        try:
+            # запрос висит до 30 с long polling, поэтому общий API_TIMEOUT к нему не подходит
+            updates = await bot.get_updates(offset=offset, timeout=30, request_timeout=30 + API_TIMEOUT)
+        except Exception as e:
+            print(f'getUpdates failed: {e}')
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            enqueue_update(update.model_dump(mode='json', exclude_none=True))
+            offset = update.update_id + 1
+
 
 async def main():
+    if not hold_store():
+        raise SystemExit('The store is being restored from a snapshot (--restore); start the bot after it finishes.')
+    start_audit_log()
     await load_data()
+    load_activity()
     asyncio.create_task(autosave_loop())
+    asyncio.create_task(activity_loop())
+    asyncio.create_task(draft_expiry_loop())
+    asyncio.create_task(digest_loop())
+    if SNAPSHOT_INTERVAL:
+        asyncio.create_task(snapshot_loop())
     print('Бот запущен')
     try:
-        await dp.start_polling(bot)
+        await dp.start_polling(bot, tasks_concurrency_limit=UPDATE_QUEUE_LIMIT)
     finally:
         await save_data()
+        await save_activity()
+        stop_audit_log()
 
 
 if __name__ == '__main__':
+    if '--snapshots' in sys.argv:
+        for snap in list_snapshots():
+            print(f"{snap['id']}  {snap['timestamp']}  {snap['reason']}")
+        sys.exit(0)
+    if '--restore' in sys.argv:
+        if not hold_store(exclusive=True):
+            raise SystemExit('The bot is running on this store: stop it before --restore '
+                             '(or restore from the admin panel), otherwise its saves overwrite the snapshot.')
+
+        async def _restore(snap_id):
+            start_audit_log()
+            try:
+                await load_data()
+                changed = await restore_snapshot(snap_id)
+                audit('restore', snapshot=snap_id, docs_rewritten=changed, source='cli')
+                print(f'Перезаписано документов: {changed}')
+            finally:
+                stop_audit_log()
+        asyncio.run(_restore(sys.argv[sys.argv.index('--restore') + 1]))
+        sys.exit(0)
+    if '--bench-memory' in sys.argv:
+        bench_memory()
+        sys.exit(0)
+    if '--bench-storage' in sys.argv:
+        bench_storage(int(sys.argv[-1]) if sys.argv[-1].isdigit() else 50000)
+        sys.exit(0)
+    if '--frontend' in sys.argv or '--worker' in sys.argv:
+        if STORE_BACKEND != 'sqlite':
+            raise RuntimeError('--frontend/--worker need STORE_BACKEND=sqlite')
+        if '--worker' in sys.argv:
+            WORKER_SHARD = int(sys.argv[sys.argv.index('--worker') + 1])
+            asyncio.run(worker_main())
+        else:
+            asyncio.run(frontend_main())
+        sys.exit(0)
     # start console watcher thread to allow typing 'exit' or 'quit' to stop
     loop = asyncio.new_event_loop()
     try: